@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+# Batch profiling.  Runs tpprof.py's stages on every trace of a directory or
+# glob, several traces at a time, and writes a summary index of the batch:
+# each trace's states, top subsequences and stage timings.
+#
+# The heavy imports are paid once: every trace runs in a process forked from
+# this one, so it starts with them loaded, and exits when the trace is done,
+# so nothing a trace allocates outlives it.  A trace that fails, runs out of
+# its memory limit or crashes its process is recorded as failed in the index
+# and the batch carries on.  Cluster and subsequence results go through the
+# same content-addressed cache as tpprof.py, so rerunning a batch only
+# computes the traces that changed.
+
+import argparse
+import glob
+import json
+import matplotlib
+matplotlib.use('Agg') # never open plots from the workers
+import multiprocessing as mp
+from multiprocessing.connection import wait
+import os
+import resource
+import sys
+import tempfile
+import time
+import traceback
+
+import tpprof
+from lib.common import *
+# loaded once here, for every forked trace
+import hyperopt
+import lib.clustering
+import lib.drawing
+import lib.local_trials
+import lib.statestats
+import lib.subsequence_objective
+import lib.subsequencing
+
+
+BATCH_DIR = 'tmp/batch'
+BATCH_JOBS = None # traces profiled at once. None => one per core
+TOP_SUBSEQUENCES = 20 # subsequences per trace in the index
+INDEX_FILE = 'summary.json'
+
+
+def findTraces(patterns):
+    """
+    The trace files named by patterns: directories (every file in them,
+    hidden files aside), globs or file names.  In order, without repeats.
+    """
+    traces = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            names = [os.path.join(pattern, name)
+                     for name in sorted(os.listdir(pattern))
+                     if not name.startswith('.')]
+        else:
+            names = sorted(glob.glob(pattern))
+        for name in names:
+            if os.path.isfile(name) and os.path.realpath(name) not in seen:
+                seen.add(os.path.realpath(name))
+                traces.append(name)
+    return traces
+
+def resultPrefixes(traces, outdir):
+    """ Distinct result prefixes in outdir for traces, named by file. """
+    prefixes = []
+    taken = set()
+    for trace in traces:
+        name = os.path.basename(trace).rpartition('.')[0] or \
+               os.path.basename(trace)
+        prefix, n = name, 1
+        while prefix in taken: # same name in another directory
+            n += 1
+            prefix = '%s-%d' % (name, n)
+        taken.add(prefix)
+        prefixes.append(os.path.join(outdir, prefix))
+    return prefixes
+
+def traceSummary(cluster_results, subsequences, topN = TOP_SUBSEQUENCES):
+    """
+    State statistics, transitions and top subsequences of a profiled trace,
+    as JSON types.
+    """
+    Y = cluster_results['clustered_pts']
+    summary = lib.statestats.StateStats(Y).summary()
+
+    coverage = subsequences['coverage_sum']
+    top = sorted(coverage, key = coverage.get, reverse = True)[:topN]
+    # merged subsequences: (state, log10 of its run length) pairs
+    summary['subsequences'] = [
+            {'states' : [[int(state), int(run)] for state, run in seq],
+             'coverage' : float(coverage[seq]),
+             'frequency' : int(subsequences['merged_freq'].get(seq, 0))}
+            for seq in top]
+    summary['min_frequency_thresh'] = \
+            float(subsequences['min_frequency_thresh'])
+    return summary
+
+def writeJson(filename, value):
+    """ Replace filename with value as JSON atomically. """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(value, f, indent = 1)
+    os.replace(tmp, filename)
+
+# ===================================
+# =           trace jobs.           =
+# ===================================
+
+def runTrace(conn, trace, prefix, options):
+    """
+    Profile one trace in a forked process and send its index entry on conn.
+    Its output goes to <prefix>.log.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log = os.open(prefix + '.log', os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                  0o644)
+    os.dup2(log, 1) # the trace's pool workers inherit these
+    os.dup2(log, 2)
+    os.close(log)
+
+    if options['memory']:
+        limit = options['memory'] * 2**20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    # the cores are shared between the traces running at once
+    lib.clustering.BIC_WORKERS = options['workers']
+
+    entry = {'trace' : trace, 'prefix' : prefix, 'log' : prefix + '.log'}
+    start = time.time()
+    try:
+        cluster_results, subsequences, stages = tpprof.profile_trace(
+                trace, prefix, options['seed'], options['engine'],
+                options['search'], options['trials'], options['workers'],
+                options['cachedir'], options['draw'], False,
+                options['model'], options['rle'])
+        entry.update(traceSummary(cluster_results, subsequences))
+        entry['stages'] = stages
+        entry['status'] = 'ok'
+    except BaseException:
+        traceback.print_exc()
+        entry['status'] = 'failed'
+        entry['error'] = traceback.format_exc().strip().rpartition('\n')[2]
+    entry['seconds'] = time.time() - start
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.send(entry)
+    conn.close()
+
+def runBatch(traces, prefixes, options, jobs, indexFile):
+    """
+    Profile traces, at most jobs at a time.  The index is rewritten as every
+    trace finishes.  Returns the index.
+    """
+    ctx = mp.get_context('fork')
+    start = time.time()
+    entries = [None for trace in traces]
+    pending = list(range(len(traces)))
+    running = {} # connection -> (trace number, process)
+
+    def update():
+        index = {'created' : start,
+                 'seconds' : time.time() - start,
+                 'options' : options,
+                 'done' : sum(e is not None for e in entries),
+                 'failed' : sum(e is not None and e['status'] != 'ok'
+                                for e in entries),
+                 'traces' : [e for e in entries if e is not None]}
+        writeJson(indexFile, index)
+        return index
+
+    index = update()
+    while pending or running:
+        while pending and len(running) < jobs:
+            i = pending.pop(0)
+            reader, writer = ctx.Pipe(duplex = False)
+            process = ctx.Process(target = runTrace,
+                                  args = (writer, traces[i], prefixes[i],
+                                          options))
+            process.start()
+            writer.close()
+            running[reader] = (i, process)
+
+        for reader in wait(list(running)):
+            i, process = running.pop(reader)
+            try:
+                entry = reader.recv()
+            except EOFError: # died before reporting, e.g. killed
+                entry = None
+            reader.close()
+            process.join()
+            if entry is None:
+                entry = {'trace' : traces[i], 'prefix' : prefixes[i],
+                         'log' : prefixes[i] + '.log', 'status' : 'failed',
+                         'error' : 'process exited with code %d' %
+                                   process.exitcode}
+            entries[i] = entry
+            print("[%d/%d] %s: %s" % (sum(e is not None for e in entries),
+                                      len(traces), traces[i],
+                                      "%.1fs" % entry['seconds']
+                                      if entry['status'] == 'ok'
+                                      else "FAILED, " + entry['error']))
+            index = update()
+    return index
+
+# ======  End of trace jobs.  =======
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('traces', type=str, nargs='+',
+                        help='trace files, directories of traces or globs.')
+    parser.add_argument('--outdir', type=str, default=BATCH_DIR,
+                        help='directory of the result files, logs and ' \
+                             'the summary index.')
+    parser.add_argument('--jobs', type=int, default=BATCH_JOBS,
+                        help='traces profiled at once. Default is one per ' \
+                             'core.')
+    parser.add_argument('--memory', type=int,
+                        help='address space limit of each trace, in MiB. ' \
+                             'A trace going over fails on its own.')
+    parser.add_argument('--seed', type=int, help='seed for hyperopt')
+    parser.add_argument('--engine', type=str, default=SUBSEQUENCE_ENGINE,
+                        choices=sorted(lib.subsequencing.SUBSEQUENCE_ENGINES),
+                        help='subsequence miner.')
+    parser.add_argument('--rle', dest='rle', action='store_true',
+                        help='mine run-length encoded sequences.')
+    parser.add_argument('--norle', dest='rle', action='store_false',
+                        help='mine every sample.')
+    parser.add_argument('--search', type=str, default=SUBSEQUENCE_SEARCH,
+                        choices=['sweep', 'hyperopt'],
+                        help='how to pick min_frequency_thresh.')
+    parser.add_argument('--trials', type=str, default='local',
+                        choices=['serial', 'local'],
+                        help='where hyperopt trials run.')
+    parser.add_argument('--model', type=str,
+                        help='label every trace with this model file ' \
+                             'instead of fitting one per trace.')
+    parser.add_argument('--cachedir', type=str, default=CACHE_DIR,
+                        help='directory of cached stage results.')
+    parser.add_argument('--nocache', action='store_true',
+                        help='recompute every stage, ignoring and not ' \
+                             'updating the cache.')
+    parser.add_argument('--nodraw', dest='draw', action='store_false',
+                        help='skip drawing the profile of each trace.')
+    parser.set_defaults(rle=SUBSEQUENCE_RLE)
+    return parser.parse_args()
+
+def main():
+    args = argParser()
+
+    traces = findTraces(args.traces)
+    if not traces:
+        sys.exit("no traces found in %s" % ' '.join(args.traces))
+    os.makedirs(args.outdir, exist_ok = True)
+    prefixes = resultPrefixes(traces, args.outdir)
+    jobs = max(1, min(args.jobs or os.cpu_count(), len(traces)))
+    options = {'seed' : args.seed,
+               'engine' : args.engine,
+               'rle' : args.rle,
+               'search' : args.search,
+               'trials' : args.trials,
+               'workers' : max(1, os.cpu_count() // jobs),
+               'memory' : args.memory,
+               'cachedir' : None if args.nocache else args.cachedir,
+               'draw' : args.draw,
+               'model' : args.model}
+    indexFile = os.path.join(args.outdir, INDEX_FILE)
+
+    print ("BATCH PARAMETERS: ")
+    print ("--------------------")
+    print ("\ttraces: %d" % len(traces))
+    print ("\toutput: %s" % args.outdir)
+    print ("\tjobs: %d, %d worker(s) each" % (jobs, options['workers']))
+    print ("\tmemory limit: %s" % ("%d MiB per trace" % args.memory
+                                   if args.memory else "none"))
+    print ("\tmodel: %s" % (args.model if args.model else "fit per trace"))
+    print ("\tcache: %s" % ("disabled" if args.nocache else args.cachedir))
+    print ("--------------------")
+
+    index = runBatch(traces, prefixes, options, jobs, indexFile)
+    print ("%d traces in %.1fs, %d failed; index: %s" %
+           (len(traces), index['seconds'], index['failed'], indexFile))
+    if index['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+# Benchmarks of every stage of the profiler: parsing, each stage of the
+# clustering pipeline, subsequence mining, merging and drawing, on the
+# bundled traces and on synthetic ones (lib.synthetic) of growing size.
+# Every stage is timed, then run again under tracemalloc for its peak memory
+# (what it allocates on top of its inputs; the BIC pool's workers are
+# separate processes and not counted).  The results are written as JSON, and
+# --baseline compares them stage by stage with an earlier run's.
+
+import argparse
+import glob
+import json
+import matplotlib
+matplotlib.use('Agg') # never open plots
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from lib.common import *
+import lib.cache
+import lib.clustering
+import lib.drawing
+import lib.parsing
+import lib.subsequencing
+import lib.synthetic
+import lib.tracefile
+
+
+BENCHMARK_VERSION = 1
+SIZES = '1e4,1e5,1e6'
+STAGE_BUDGET = 60.0 # seconds; a stage that takes longer stops growing
+# fixed threshold, at the mode of the hyperopt prior qlognormal(4, 0.6)
+MIN_FREQUENCY_THRESH = 55
+PIPELINE_STAGES = [('project', lib.clustering.Project),
+                   ('dedup', lib.clustering.Dedup),
+                   ('selectk', lib.clustering.SelectK),
+                   ('cluster', lib.clustering.Cluster)]
+
+
+def measure(fcn, *args, memory = True):
+    """
+    Run fcn(*args) for its seconds, then, with memory, again for its peak
+    traced allocation in bytes.  Returns (result, seconds, peak bytes).
+    """
+    start = time.perf_counter()
+    result = fcn(*args)
+    seconds = time.perf_counter() - start
+    peak = None
+    if memory:
+        del result # not part of the second run's peak
+        tracemalloc.start()
+        try:
+            result = fcn(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+def environment():
+    """ What the numbers were measured on. """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                capture_output = True, text = True,
+                                cwd = os.path.dirname(os.path.abspath(
+                                                      __file__))).stdout
+    except OSError:
+        commit = ''
+    return {'commit' : commit.strip() or None,
+            'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'cpus' : os.cpu_count(),
+            'packages' : lib.cache.packageVersions('numpy', 'scikit-learn',
+                                                   'matplotlib')}
+
+# ===================================
+# =             stages.             =
+# ===================================
+
+class Bench(object):
+    """
+    Runs the stages of one trace in order, each on the previous stages'
+    output, recording them into stages.  A stage in skip, or whose input
+    is missing, is recorded as skipped.
+    """
+    def __init__(self, engines, skip, memory = True):
+        self.engines = engines
+        self.skip = skip
+        self.memory = memory
+        self.stages = {}
+
+    def run(self, name, fcn, *args):
+        if name in self.skip:
+            self.stages[name] = {'skipped' : self.skip[name]}
+            return None
+        print ("\t%s..." % name)
+        sys.stdout.flush()
+        try:
+            result, seconds, peak = measure(fcn, *args, memory = self.memory)
+        except MemoryError:
+            self.stages[name] = {'skipped' : 'out of memory'}
+            return None
+        self.stages[name] = {'seconds' : seconds, 'peakBytes' : peak}
+        print ("\t%s: %.3fs%s" % (name, seconds, "" if peak is None
+                                  else ", peak %.1f MiB" % (peak / 2**20)))
+        return result
+
+    def profile(self, X, textfile = None, labels = None):
+        """
+        Bench every stage on samples X (parsed from textfile, if given).
+        Subsequences are mined from the fitted labels or, if clustering was
+        skipped, from labels (the generator's).
+        """
+        if textfile is not None:
+            parsed = self.run('parse', lib.parsing.parseSwitchTrace, textfile)
+            X = X if parsed is None else parsed
+
+        # the pipeline's stages, threaded as MlPipeline.runStages does
+        pl = lib.clustering.build3StagePipe(bGmmConf)
+        def normalize(X):
+            pl.setX(X)
+            return dict(pl.stageArgs[0])
+        args = self.run('normalize', normalize, X)
+        for name, stage in PIPELINE_STAGES:
+            args = None if args is None else self.run(name, stage, args)
+            if args is None:
+                self.stages.setdefault(name, {'skipped' : 'no input'})
+        if args is not None:
+            labels = args['Y']
+        if labels is None:
+            return
+
+        sequence = np.asarray(labels)
+        mined = None
+        for engine in self.engines:
+            result = self.run('subsequence-' + engine,
+                              lib.subsequencing.SUBSEQUENCE_ENGINES[engine],
+                              sequence, len(sequence) - 1,
+                              MIN_FREQUENCY_THRESH)
+            mined = mined or result
+        if mined is None:
+            return
+        merged = self.run('merge', lib.subsequencing.merge_stable,
+                          mined[0], mined[1])
+        if merged is None:
+            return
+
+        with tempfile.TemporaryDirectory() as tmp:
+            self.run('draw', lib.drawing.plot, X, sequence, merged[0],
+                     merged[1], os.path.join(tmp, 'profile.pdf'), False)
+
+def overBudget(results, budget):
+    """ Stages of a finished trace that took longer than budget seconds. """
+    return {name : 'took %.1fs at %d samples' % (stage['seconds'],
+                                                 results['samples'])
+            for name, stage in results['stages'].items()
+            if stage.get('seconds', 0) > budget}
+
+# ===================================
+# =             traces.             =
+# ===================================
+
+def benchTrace(trace, engines, memory):
+    """ Bench a trace file, parse included. """
+    print ("%s" % trace)
+    bench = Bench(engines, {}, memory)
+    X = lib.parsing.parseSwitchTrace(trace)
+    bench.profile(X, trace)
+    return {'trace' : trace, 'samples' : len(X), 'switches' : X.shape[1],
+            'stages' : bench.stages}
+
+def benchSynthetic(gen, n, engines, skip, memory):
+    """
+    Bench an n sample trace of generator gen, parse included.  The trace is
+    written chunk by chunk to a trace file and memory-mapped, so generating
+    it takes no memory of its own at any size.
+    """
+    print ("synthetic: %d samples x %d switches, %d states" %
+           (n, gen.nSwitches, gen.nStates))
+    bench = Bench(engines, skip, memory)
+    with tempfile.TemporaryDirectory() as tmp:
+        tracefile = os.path.join(tmp, 'synthetic.trace')
+        labelfile = os.path.join(tmp, 'labels.trace')
+        gen.writeTrace(tracefile, n, labelfile)
+        X = lib.tracefile.openTrace(tracefile)[0]
+        Y = lib.tracefile.openTrace(labelfile)[0][:, 0]
+        textfile = None
+        if 'parse' not in skip:
+            textfile = os.path.join(tmp, 'synthetic.data')
+            gen.writeText(textfile, n)
+        bench.profile(X, textfile, Y)
+    return {'trace' : 'synthetic', 'samples' : n,
+            'switches' : gen.nSwitches, 'states' : gen.nStates,
+            'dwell' : gen.dwell, 'noise' : gen.noise, 'seed' : gen.seed,
+            'stages' : bench.stages}
+
+def compare(baseline, results):
+    """ Print each stage's time and peak memory relative to baseline. """
+    def key(run):
+        return tuple(run.get(k) for k in ('trace', 'samples', 'switches',
+                                          'states', 'dwell', 'noise'))
+    old = {key(run) : run for run in baseline['runs']}
+    print ("%-40s %-20s %10s %10s" % ("trace", "stage", "time", "memory"))
+    for run in results['runs']:
+        if key(run) not in old:
+            continue
+        name = '%s:%d' % (os.path.basename(run['trace']), run['samples'])
+        for stage, new in run['stages'].items():
+            prev = old[key(run)]['stages'].get(stage, {})
+            if 'seconds' not in new or 'seconds' not in prev:
+                continue
+            ratio = lambda a, b: '%.2fx' % (a / b) if a and b else '-'
+            print ("%-40s %-20s %10s %10s" %
+                   (name, stage, ratio(new['seconds'], prev['seconds']),
+                    ratio(new['peakBytes'], prev['peakBytes'])))
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--out', type=str, default='tmp/benchmark.json',
+                        help='where to write the results.')
+    parser.add_argument('--traces', type=str, nargs='*',
+                        default=sorted(glob.glob('data/*.data')),
+                        help='trace files to bench.')
+    parser.add_argument('--sizes', type=str, default=SIZES,
+                        help='comma separated synthetic trace sizes, in ' \
+                             'samples (1e4 to 1e8); empty for none.')
+    parser.add_argument('--switches', type=int, default=4,
+                        help='counters per synthetic sample.')
+    parser.add_argument('--states', type=int, nargs='+', default=[4],
+                        help='states of the synthetic traces, one set of ' \
+                             'sizes each.')
+    parser.add_argument('--dwell', type=float, default=100.0,
+                        help='mean samples per visit to a synthetic state.')
+    parser.add_argument('--noise', type=float, default=0.05,
+                        help='relative noise of synthetic counters.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--engines', type=str, nargs='+',
+                        default=[SUBSEQUENCE_ENGINE],
+                        choices=sorted(lib.subsequencing.SUBSEQUENCE_ENGINES),
+                        help='subsequence miners to bench.')
+    parser.add_argument('--budget', type=float, default=STAGE_BUDGET,
+                        help='seconds; a stage that takes longer is not ' \
+                             'run at larger synthetic sizes.')
+    parser.add_argument('--nomemory', dest='memory', action='store_false',
+                        help='only time the stages, without the ' \
+                             'tracemalloc run.')
+    parser.add_argument('--baseline', type=str,
+                        help='results of an earlier run to compare with.')
+    return parser.parse_args()
+
+def main():
+    args = argParser()
+
+    sizes = sorted(int(float(s)) for s in args.sizes.split(',') if s.strip())
+    results = {'version' : BENCHMARK_VERSION,
+               'created' : time.time(),
+               'environment' : environment(),
+               'config' : {'bGmmConf' : lib.cache.describe(bGmmConf),
+                           'minFrequencyThresh' : MIN_FREQUENCY_THRESH,
+                           'budget' : args.budget,
+                           'memory' : args.memory},
+               'runs' : []}
+
+    def save():
+        if os.path.dirname(args.out):
+            os.makedirs(os.path.dirname(args.out), exist_ok = True)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent = 1)
+
+    for trace in args.traces:
+        results['runs'].append(benchTrace(trace, args.engines, args.memory))
+        save()
+    for nStates in args.states:
+        gen = lib.synthetic.MarkovTrace(args.switches, nStates, args.dwell,
+                                        args.noise, args.seed)
+        skip = {}
+        for n in sizes:
+            run = benchSynthetic(gen, n, args.engines, skip, args.memory)
+            results['runs'].append(run)
+            save()
+            skip.update(overBudget(run, args.budget))
+    print ("wrote %s" % args.out)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
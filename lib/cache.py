@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# Content-addressed cache for stage results.  An entry is keyed by a sha256
+# of everything the result depends on (the bytes of the input trace, the
+# stage configuration and the key of the stage it was computed from), so a
+# changed trace or config can never pick up a stale result, and traces that
+# share a file name never collide.
+#
+# Entries are files in one directory, pickles unless the caller gives an
+# EntryFormat of its own (lib.results stores arrays as .npz).  They are
+# written to a temporary file and renamed into place, so a reader sees a
+# whole entry or none, even with several runs sharing the directory.
+# Reading an entry bumps its mtime; once the directory grows past maxBytes
+# the least recently used entries are removed.
+
+import hashlib
+import inspect
+import os
+import pickle
+import sys
+import tempfile
+
+
+# bump to invalidate every entry, e.g. when a stage's algorithm changes
+CACHE_VERSION = 3
+ENTRY_SUFFIXES = ('.pkl', '.npz') # of the entry formats in use
+
+
+def hashFile(filename, blockBytes = 2**24):
+    """ sha256 hex digest of a file's contents. """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(blockBytes)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+def describe(value):
+    """
+    Stable text form of a config value for hashing.  Functions and classes
+    are named by module and qualified name, plus the version of the package
+    they come from, so a config holding lib.clustering.pcaProject or
+    sklearn's GaussianMixture hashes the same in every process.  Names given
+    as strings hash as strings; add packageVersions to such keys.
+    """
+    if isinstance(value, dict):
+        return '{' + ','.join('%s:%s' % (describe(k), describe(value[k]))
+                              for k in sorted(value, key = str)) + '}'
+    if isinstance(value, (list, tuple)):
+        return '[' + ','.join(describe(v) for v in value) + ']'
+    if isinstance(value, range):
+        return 'range(%d,%d,%d)' % (value.start, value.stop, value.step)
+    if inspect.isfunction(value) or inspect.isclass(value):
+        package = sys.modules.get(value.__module__.partition('.')[0])
+        return '%s.%s@%s' % (value.__module__, value.__qualname__,
+                             getattr(package, '__version__', ''))
+    return repr(value)
+
+def packageVersions(*names):
+    """
+    {distribution: version} of installed packages, None if missing, read
+    from their metadata without importing them.
+    """
+    import importlib.metadata # slow to import, only needed for keys
+    versions = {}
+    for name in names:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+def cacheKey(*parts):
+    """ Key of a result computed from parts (hashes, configs, names). """
+    digest = hashlib.sha256(b'tpprof cache %d' % CACHE_VERSION)
+    for part in parts:
+        digest.update(b'\0' + describe(part).encode())
+    return digest.hexdigest()
+
+class EntryFormat(object):
+    """
+    How entries are stored: the suffix of their files (one of
+    ENTRY_SUFFIXES), save(value, f) writing a value to a file object and
+    load(path) reading it back, raising ValueError if it cannot.
+    """
+    def __init__(self, suffix, save, load):
+        self.suffix = suffix
+        self.save = save
+        self.load = load
+
+def loadPickle(path):
+    with open(path, 'rb') as f:
+        try:
+            return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError) as e:
+            raise ValueError("%s: %s" % (path, e))
+
+PICKLE_ENTRIES = EntryFormat('.pkl', lambda value, f: pickle.dump(
+                                 value, f, protocol = pickle.HIGHEST_PROTOCOL),
+                             loadPickle)
+
+class ResultCache(object):
+    """ Results by key in directory, at most about maxBytes. """
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        os.makedirs(directory, exist_ok = True)
+
+    def path(self, key, entries = PICKLE_ENTRIES):
+        return os.path.join(self.directory, key + entries.suffix)
+
+    def get(self, key, entries = PICKLE_ENTRIES):
+        """ The result stored under key, or None. """
+        path = self.path(key, entries)
+        try:
+            value = entries.load(path)
+            os.utime(path) # most recently used
+        except (OSError, ValueError):
+            return None
+        return value
+
+    def put(self, key, value, entries = PICKLE_ENTRIES):
+        """ Store value under key, then evict down to maxBytes. """
+        fd, tmp = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+        try:
+            os.fchmod(fd, 0o644) # mkstemp makes it private
+            with os.fdopen(fd, 'wb') as f:
+                entries.save(value, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path(key, entries))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        self.evict(keep = self.path(key, entries))
+
+    def evict(self, keep = None):
+        """ Remove least recently used entries, except path keep, to fit. """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_SUFFIXES):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError: # evicted by a concurrent run
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            if keep and name == os.path.basename(keep):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -1,32 +1,67 @@
 import argparse
+import importlib
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import numpy as np
 from numpy import matlib as mlb
 import os
-import pandas as pd
-import pickle
-from sklearn.decomposition import PCA
-from sklearn.mixture import BayesianGaussianMixture
+from sklearn.decomposition import IncrementalPCA, PCA
+from sklearn.cluster import KMeans
+from sklearn.metrics import adjusted_rand_score
+from sklearn.mixture import BayesianGaussianMixture, GaussianMixture
 import sys
+import time
 
+import lib.instrument
 import lib.parsing
+import lib.tracefile
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# processes for the (trial, k) BIC grid. None => one per core.
+BIC_WORKERS = None
+# scoreBicKneeAdaptive stops once the knee has held for this many more k
+KNEE_PATIENCE = 2
+# rows per transform / predict call when labelling a trace from a coreset fit
+PREDICT_CHUNK = 2**16
 
 
 def runPipeline(plConf, X):
     """ Run an ML pipeline defined by plConf, get Y vec """
+    return fitPipeline(plConf, X)[0]
+
+def fitPipeline(plConf, X):
+    """
+    Run an ML pipeline defined by plConf, get Y vec and the fitted model
+    (normalization, projection and clustering), to label new samples with
+    lib.model.StateModel.fromFitted.
+    """
     pl = build3StagePipe(plConf)
     pl.setX(X)
     pl.runStages()
     Y = pl.finalOut["Y"]
-    return Y
+    model = {k : pl.finalOut[k] for k in ("maxX", "projector", "clf")}
+    return Y, model
+
+def resolve(name):
+    """ The function or class named by a dotted path. """
+    module, _, attr = name.rpartition('.')
+    return getattr(importlib.import_module(module), attr)
 
 def build3StagePipe(pipeConfigDict):
-    # build pipe
-    pl = MlPipeline(3)
+    # build pipe.  Dedup passes X on as it is unless dedup is set.
+    pl = MlPipeline(4)
     pl.stageType[0] = Project
-    pl.stageType[1] = SelectK
-    pl.stageType[2] = Cluster
+    pl.stageType[1] = Dedup
+    pl.stageType[2] = SelectK
+    pl.stageType[3] = Cluster
     for k, v in pipeConfigDict.items():
+        # functions and classes may be given by name (lib.common.bGmmConf)
+        if k.endswith("Fcn") and isinstance(v, str):
+            v = resolve(v)
         pl.stageArgs[0][k] = v
     return pl
 
@@ -36,6 +71,135 @@ class RegBayesianGmm(BayesianGaussianMixture):
         super(RegBayesianGmm, self).__init__(*args, reg_covar = 5*10**-4,
                                              **kwargs)
 
+# ===================================
+# =        weighted mixtures.       =
+# ===================================
+
+class WeightedMixture(object):
+    """
+    Mixin for the sklearn mixtures, which take no sample weights (as of
+    1.1): fit(X, sample_weight = counts) fits rows X as if row i occurred
+    counts[i] times, by weighting the responsibilities of each row in the
+    initialization and M step, and the per-row terms of the lower bound.
+    """
+    _sampleWeight = None
+
+    def fit(self, X, y = None, sample_weight = None):
+        self._sampleWeight = None if sample_weight is None \
+                             else np.asarray(sample_weight, dtype = np.float64)
+        try:
+            return super(WeightedMixture, self).fit(X)
+        finally:
+            self._sampleWeight = None
+
+    def _weights(self, X):
+        if self._sampleWeight is None:
+            return np.ones(len(X))
+        return self._sampleWeight
+
+    def _initialize_parameters(self, X, random_state):
+        if self.init_params != "kmeans":
+            # the other inits draw responsibilities or rows, which
+            # _initialize weights
+            return super(WeightedMixture, self)._initialize_parameters(
+                            X, random_state)
+        label = KMeans(n_clusters = self.n_components, n_init = 1,
+                       random_state = random_state).fit(
+                    X, sample_weight = self._weights(X)).labels_
+        resp = np.zeros((len(X), self.n_components))
+        resp[np.arange(len(X)), label] = 1
+        self._initialize(X, resp)
+
+    def _initialize(self, X, resp):
+        super(WeightedMixture, self)._initialize(
+                X, resp * self._weights(X)[:, np.newaxis])
+
+    def _e_step(self, X):
+        log_prob_norm, log_resp = self._estimate_log_prob_resp(X)
+        return np.average(log_prob_norm, weights = self._weights(X)), log_resp
+
+    def _m_step(self, X, log_resp):
+        # exp(log_resp + log w) = w * resp
+        super(WeightedMixture, self)._m_step(
+                X, log_resp + np.log(self._weights(X))[:, np.newaxis])
+
+    def score(self, X, y = None, sample_weight = None):
+        return np.average(self.score_samples(X), weights = sample_weight)
+
+class WeightedGaussianMixture(WeightedMixture, GaussianMixture):
+    """ GaussianMixture with sample weights. """
+    def _initialize(self, X, resp):
+        super(WeightedGaussianMixture, self)._initialize(X, resp)
+        if self.weights_init is None: # GaussianMixture divides by len(X)
+            self.weights_ = self.weights_ / self.weights_.sum()
+
+    def bic(self, X, sample_weight = None):
+        """ BIC of X, row i counted sample_weight[i] times. """
+        weights = np.ones(len(X)) if sample_weight is None \
+                  else np.asarray(sample_weight, dtype = np.float64)
+        return -2 * np.dot(self.score_samples(X), weights) + \
+               self._n_parameters() * np.log(weights.sum())
+
+class WeightedBayesianGmm(WeightedMixture, BayesianGaussianMixture):
+    """ BayesianGaussianMixture with sample weights. """
+    def _check_parameters(self, X):
+        super(WeightedBayesianGmm, self)._check_parameters(X)
+        if self._sampleWeight is None:
+            return
+        # priors from the data, as if every row occurred its weight times
+        if self.mean_prior is None:
+            self.mean_prior_ = np.average(X, axis = 0,
+                                          weights = self._sampleWeight)
+        if self.covariance_prior is None:
+            counts = np.rint(self._sampleWeight).astype(np.int64)
+            covariance = np.atleast_2d(np.cov(X.T, fweights = counts))
+            self.covariance_prior_ = {
+                "full" : covariance,
+                "tied" : covariance,
+                "diag" : np.diag(covariance),
+                "spherical" : np.diag(covariance).mean(),
+            }[self.covariance_type]
+
+    def _compute_lower_bound(self, log_resp, log_prob_norm):
+        # the entropy term, -sum(resp * log_resp), counts each row w times
+        bound = super(WeightedBayesianGmm, self)._compute_lower_bound(
+                    log_resp, log_prob_norm)
+        if self._sampleWeight is None:
+            return bound
+        return bound - np.sum((self._sampleWeight - 1)[:, np.newaxis] *
+                              np.exp(log_resp) * log_resp)
+
+class WeightedRegBayesianGmm(WeightedBayesianGmm, RegBayesianGmm):
+    """ RegBayesianGmm with sample weights. """
+
+WEIGHTED_MIXTURES = {GaussianMixture : WeightedGaussianMixture,
+                     BayesianGaussianMixture : WeightedBayesianGmm,
+                     RegBayesianGmm : WeightedRegBayesianGmm}
+
+def weightedMixture(clusterFcn):
+    """ The version of mixture class clusterFcn that takes sample weights. """
+    if isinstance(clusterFcn, type) and issubclass(clusterFcn,
+                                                   WeightedMixture):
+        return clusterFcn
+    if clusterFcn not in WEIGHTED_MIXTURES:
+        raise ValueError("no weighted version of %s to fit de-duplicated "
+                         "rows with; set dedup to False" %
+                         getattr(clusterFcn, "__name__", clusterFcn))
+    return WEIGHTED_MIXTURES[clusterFcn]
+
+def fitWeighted(clf, X, sampleWeight = None):
+    """ clf.fit(X), with sample weights if given. """
+    if sampleWeight is None:
+        return clf.fit(X)
+    return clf.fit(X, sample_weight = sampleWeight)
+
+def bicWeighted(clf, X, sampleWeight = None):
+    if sampleWeight is None:
+        return clf.bic(X)
+    return clf.bic(X, sample_weight = sampleWeight)
+
+# ======  End of weighted mixtures.  =======
+
 def findKnee(values):
     # source: https://dataplatform.cloud.ibm.com/analytics/notebooks/54d79c2a-f155-40ec-93ec-ed05b58afa39/view?access_token=6d8ec910cf2a1b3901c721fcb94638563cd646fe14400fecbb76cea6aaae2fb1
     #get coordinates of all the points
@@ -87,21 +251,28 @@ class MlPipeline(object):
         self.finalOut = None
     
     def setX(self, X):
-        """ Set X from loaded data """
-        maxX = np.max(X) # global normalization.
-        X = X / maxX
-        self.stageArgs[0]["X"] = X        
+        """
+        Set X from loaded data.  Out of core, X is kept as it is (e.g. a
+        memory-mapped trace) and only its maximum is found, a block at a time;
+        the stages normalize it block by block.
+        """
+        args = self.stageArgs[0]
+        if args.get("outOfCore"):
+            maxX = blockMax(X, args.get("predictChunk", PREDICT_CHUNK))
+        else:
+            maxX = np.max(X) # global normalization.
+            X = X / maxX if args.get("dtype") is None \
+                else np.true_divide(X, maxX, dtype = args["dtype"])
+        args["X"] = X
+        args["maxX"] = maxX
         return
 
     def loadRaw(self, inputFn):
-        """ Load a .raw (csv) from RawData dir """
-        X = parsing.parseSwitchTrace(inputFn)
-        X = np.array(X)
+        """ Load a trace, text or trace file (lib.tracefile) """
+        X = lib.tracefile.loadTrace(inputFn)
         # maxX = np.array([np.max(X[:, i]) for i in range(4)])
-        maxX = np.max(X) # global normalization.
-        X = X / maxX
         print ("inputs[0] (original input) loaded (shape: %s)"%str(X.shape))
-        self.stageArgs[0]["X"] = X
+        self.setX(X)
         self.stageArgs[0]["trace"] = inputFn
         
     def runStages(self):
@@ -111,7 +282,8 @@ class MlPipeline(object):
                 return
         for sIdx, s in enumerate(self.stageType):
             # run stage, get output.
-            outDict = s(self.stageArgs[sIdx])             
+            with lib.instrument.span(s.__name__):
+                outDict = s(self.stageArgs[sIdx])             
             # populate dictionary for next stage. 
             if (sIdx +1 == len(self.stageType)):
                 self.finalOut = {k:v for k, v in outDict.items()}
@@ -127,21 +299,77 @@ class MlPipeline(object):
 
 # STAGE ENGINES.
 def Project(inpDict):
+    """
+    Project X.  With a sampleSize, the projection is fit on a coreset of X
+    only, and the coreset rows are passed on as "sample" for the later
+    stages to fit on.  projectFcn returns the fitted projection (with a
+    transform method) too, as "projector".  Out of core, projectFcn gets the
+    raw X and normalizes it itself, a block at a time.
+    """
     X = inpDict["X"]
     projectFcn, n_dim = inpDict["projectFcn"], inpDict["n_dim"]
-    Xp = projectFcn(X, n_dim)
+    chunk = inpDict.get("predictChunk", PREDICT_CHUNK)
     outDict = {k:v for k, v in inpDict.items()}
+    kwargs = {}
+    if inpDict.get("outOfCore"):
+        kwargs = {"outOfCore" : True, "maxX" : inpDict["maxX"],
+                  "dtype" : inpDict.get("dtype") or np.float64,
+                  "chunk" : chunk}
+    if inpDict.get("sampleSize") is None:
+        Xp, projector = projectFcn(X, n_dim, returnModel = True, **kwargs)
+    else:
+        sample = sampleRows(len(X), inpDict["sampleSize"],
+                            inpDict.get("sampleMethod", "stratified"))
+        print ("fitting on a coreset of %s of %s rows"%(len(sample), len(X)))
+        kwargs["chunk"] = chunk
+        Xp, projector = projectFcn(X, n_dim, sample = sample,
+                                   returnModel = True, **kwargs)
+        outDict["sample"] = sample
     outDict["X"] = Xp
+    outDict["projector"] = projector
+    return outDict
+
+def Dedup(inpDict):
+    """
+    With dedup, collapse the rows the later stages fit on (X, or its coreset
+    rows) into unique rows, "unique", and how often each occurs, "counts",
+    and the index of every row's unique row, "inverse".  The mixtures are
+    then fit on the unique rows, weighted by their counts.  dedupDecimals
+    rounds the projected rows first, so near identical rows collapse too.
+    """
+    outDict = {k:v for k, v in inpDict.items()}
+    if not inpDict.get("dedup"):
+        return outDict
+    X = inpDict["X"]
+    rows = X if inpDict.get("sample") is None else X[inpDict["sample"]]
+    if inpDict.get("dedupDecimals") is not None:
+        rows = np.round(rows, inpDict["dedupDecimals"])
+    unique, inverse, counts = np.unique(rows, axis = 0, return_inverse = True,
+                                        return_counts = True)
+    if len(unique) < max(inpDict["kRange"]):
+        # too few to fit the largest k on; fit on every row instead
+        print ("only %s unique rows, not de-duplicating"%len(unique))
+        return outDict
+    print ("fitting on %s unique of %s rows"%(len(unique), len(rows)))
+    outDict["unique"] = unique
+    outDict["counts"] = counts
+    outDict["inverse"] = inverse.reshape(-1) # (n, 1) in some NumPy versions
     return outDict
 
 # can a scoring function return a vector for all Ks instead of a single score?
 # need to pass the cluster function _to_ the scoring function.
 def SelectK(inpDict):
     X = inpDict['X']
+    if inpDict.get("sample") is not None:
+        X = X[inpDict["sample"]]
     clusterFcn, scoreFcn = inpDict["scoreClusterFcn"], inpDict["scoreFcn"]
     kRange, nTrials = inpDict["kRange"], inpDict["nTrials"]
     nInit = inpDict['n_init_search']
-    scores, kOpt = scoreFcn(X, clusterFcn, kRange, nTrials, nInit)
+    scoreArgs = dict(inpDict.get("scoreArgs", {}))
+    if inpDict.get("counts") is not None:
+        X, clusterFcn = inpDict["unique"], weightedMixture(clusterFcn)
+        scoreArgs["sampleWeight"] = inpDict["counts"]
+    scores, kOpt = scoreFcn(X, clusterFcn, kRange, nTrials, nInit, **scoreArgs)
     outDict = {k:v for k, v in inpDict.items()}
     outDict["scores"] = scores
     outDict["k"] = kOpt
@@ -152,39 +380,381 @@ def Cluster(inpDict):
     X, clusterFcn = inpDict["X"], inpDict["clusterFcn"]
     k, n_init = inpDict["k"], inpDict['n_init']
     random_state = 1
+    counts = inpDict.get("counts")
+    if counts is not None:
+        clusterFcn = weightedMixture(clusterFcn)
     clf = clusterFcn(n_components = k, n_init = n_init, random_state = random_state)
-    clf.fit(X)
-    Y = clf.predict(X)
+    if counts is not None:
+        clf.fit(inpDict["unique"], sample_weight = counts)
+    else:
+        clf.fit(X if inpDict.get("sample") is None else X[inpDict["sample"]])
+    if inpDict.get("sample") is None and counts is not None:
+        # every row is labelled as its unique row
+        Y = clf.predict(inpDict["unique"])[inpDict["inverse"]]
+    elif inpDict.get("sample") is None and not inpDict.get("outOfCore"):
+        Y = clf.predict(X)
+    else:
+        Y = applyChunked(clf.predict, X,
+                         inpDict.get("predictChunk", PREDICT_CHUNK))
     outDict = {k:v for k, v in inpDict.items()}
     outDict['Y'] = Y
+    outDict['clf'] = clf
     return outDict
 
-def scoreBicKnee(X, clusterFcn, kRange, nTrials, nInit):
-    """ Calculate BIC score, report k at knee """
-    scoreVecs = []
-    for t in range(nTrials):
-        args = [(X, clusterFcn, k, nInit, t) for k in kRange]
-        pool = mp.Pool(1)
-        scores = pool.map(scoreBic_inner, args)
-        scoreVecs.append(scores)
-        pool.close()
-    scoreVecs = np.array(scoreVecs)
+def scoreBicKnee(X, clusterFcn, kRange, nTrials, nInit, sampleWeight = None):
+    """
+    Calculate BIC score, report k at knee.  With sampleWeight, row i of X
+    counts as sampleWeight[i] rows (clusterFcn must take sample weights).
+    """
+    # every (trial, k) fit is independent: run them all on one pool. Trial t
+    # is seeded with t, as when trials ran one after another.
+    tasks = [(clusterFcn, k, nInit, t) for t in range(nTrials) for k in kRange]
+    with SharedXPool(X, min(len(tasks), BIC_WORKERS or os.cpu_count()),
+                     sampleWeight) as pool:
+        scores = pool.map(scoreBic_shared, tasks)
+    scoreVecs = np.array(scores).reshape(nTrials, len(kRange))
     kOpt = kRange[findKnee(np.average(scoreVecs, 0))]
     print ("K: %s"%kOpt)
     return scoreVecs, kOpt
 
 def scoreBic_inner(params):
     X, clusterFcn, k, n_init, random_state = params
+    return scoreBic_shared(X, (clusterFcn, k, n_init, random_state))
+
+def scoreBic_shared(X, params, sampleWeight = None):
+    clusterFcn, k, n_init, random_state = params
     # print ("getting BIC score with n_init = %s"%n_init)
     # random_state = random.randint(0, 2**32)
     gmm = clusterFcn(n_components=k, n_init=n_init, random_state = random_state)
-    gmm.fit(X)
-    return gmm.bic(X)
+    fitWeighted(gmm, X, sampleWeight)
+    return bicWeighted(gmm, X, sampleWeight)
+
+def scoreBicKneeAdaptive(X, clusterFcn, kRange, nTrials, nInit,
+                         patience = KNEE_PATIENCE, sampleWeight = None):
+    """
+    Calculate BIC score for k in order, report k at knee.  Each trial fits k
+    warm-started from its own fit at the previous k, and the sweep stops once
+    the knee has stayed put for patience more k.
+    """
+    kRange = list(kRange)
+    scoreCols = [] # nTrials scores per k fitted so far
+    fits = [None for t in range(nTrials)]
+    knees = []
+    with SharedXPool(X, min(nTrials, BIC_WORKERS or os.cpu_count()),
+                     sampleWeight) as pool:
+        for k in kRange:
+            tasks = [(clusterFcn, k, nInit, t, fits[t]) for t in range(nTrials)]
+            results = pool.map(scoreBic_warm, tasks)
+            scoreCols.append([score for score, fit in results])
+            fits = [fit for score, fit in results]
+
+            if len(scoreCols) >= 3:
+                knees.append(findKnee(np.average(scoreCols, 1)))
+                if len(knees) > patience and \
+                   len(set(knees[-patience - 1:])) == 1:
+                    break
+    scoreVecs = np.array(scoreCols).T
+    kOpt = kRange[findKnee(np.average(scoreVecs, 0))]
+    print ("K: %s (fitted k up to %s)"%(kOpt, kRange[len(scoreCols) - 1]))
+    return scoreVecs, kOpt
 
-def pcaProject(X, n_dim):
-    """ PCA projection. """
+def scoreBic_warm(X, params, sampleWeight = None):
+    """
+    BIC of a k component fit started from a fit with fewer components
+    (weights, means, covariances), its widest component split until it has
+    k, and the better of it and a fit with the n_init - 1 random inits left.
+    Without a previous fit, or if the warm fit fails or does not converge,
+    BIC of a cold fit with n_init inits.
+    """
+    clusterFcn, k, n_init, random_state, prev = params
+    gmm, bic = None, np.inf
+    if prev is not None:
+        weights, means, covariances = prev
+        while len(weights) < k:
+            weights, means, covariances = splitWidest(weights, means,
+                                                      covariances)
+        try:
+            warm = clusterFcn(n_components = k, n_init = 1,
+                              random_state = random_state,
+                              weights_init = weights, means_init = means)
+        except TypeError: # clusterFcn takes no initial solution
+            warm = None
+        if warm is not None:
+            try:
+                warm.precisions_init = np.linalg.inv(covariances)
+                fitWeighted(warm, X, sampleWeight)
+                if warm.converged_:
+                    gmm, bic = warm, bicWeighted(warm, X, sampleWeight)
+            except (ValueError, np.linalg.LinAlgError): # a degenerate split
+                pass
+
+    nCold = n_init if gmm is None else n_init - 1
+    if nCold > 0:
+        cold = clusterFcn(n_components = k, n_init = nCold,
+                          random_state = random_state)
+        fitWeighted(cold, X, sampleWeight)
+        coldBic = bicWeighted(cold, X, sampleWeight)
+        if coldBic < bic:
+            gmm, bic = cold, coldBic
+
+    fit = None
+    if getattr(gmm, 'covariance_type', None) == 'full':
+        fit = (gmm.weights_, gmm.means_, gmm.covariances_)
+    return bic, fit
+
+def splitWidest(weights, means, covariances):
+    """
+    Split the widest component, by weight times variance along its main
+    axis, in two along that axis: into the halves of the Gaussian on either
+    side of its mean.  A heavy but tight component gains nothing by a split.
+    """
+    i = np.argmax(weights * np.linalg.eigvalsh(covariances)[:, -1])
+    vals, vecs = np.linalg.eigh(covariances[i])
+    axis = vecs[:, -1]
+    sigma = np.sqrt(max(vals[-1], 0))
+    # a half normal has mean sigma*sqrt(2/pi), variance sigma**2*(1-2/pi)
+    offset = axis * sigma * np.sqrt(2 / np.pi)
+    covariance = covariances[i] - np.outer(axis, axis) * vals[-1] * 2 / np.pi
+    weights = np.append(weights, weights[i] / 2)
+    weights[i] /= 2
+    means = np.vstack((means, means[i] + offset))
+    means[i] = means[i] - offset
+    covariances = np.concatenate((covariances, covariances[i:i + 1]))
+    covariances[i] = covariances[-1] = covariance
+    return weights, means, covariances
+
+# ===================================
+# =            coresets.            =
+# ===================================
+
+def sampleRows(n, size, method = "stratified", random_state = 1):
+    """
+    Sorted indices of a coreset of size of n rows.  "stratified" takes one
+    row from each of size equal slices of the trace, so every phase of it is
+    represented; "reservoir" is a uniform sample, drawn in one pass.
+    """
+    if size >= n:
+        return np.arange(n)
+    rng = np.random.RandomState(random_state)
+    if method == "stratified":
+        edges = np.linspace(0, n, size + 1).astype(np.int64)
+        return edges[:-1] + \
+               (rng.random_sample(size) * np.diff(edges)).astype(np.int64)
+    if method == "reservoir":
+        # algorithm R with all slots drawn at once.  A slot drawn more than
+        # once keeps its last row, as in the row by row loop.
+        reservoir = np.arange(size)
+        rows = np.arange(size, n)
+        slots = (rng.random_sample(len(rows)) * (rows + 1)).astype(np.int64)
+        keep = slots < size
+        rows, slots = rows[keep][::-1], slots[keep][::-1]
+        slots, last = np.unique(slots, return_index = True)
+        reservoir[slots] = rows[last]
+        return np.sort(reservoir)
+    raise ValueError("unknown sampleMethod: %s" % method)
+
+def applyChunked(fcn, X, chunk = PREDICT_CHUNK):
+    """ fcn(X) in blocks of chunk rows, e.g. predict on a long trace. """
+    return np.concatenate([fcn(X[start:start + chunk])
+                           for start in range(0, max(len(X), 1), chunk)])
+
+def compareSampled(plConf, X, sampleSize, sampleMethod = "stratified"):
+    """
+    Run plConf on X with and without a coreset.  Returns the adjusted rand
+    score of the coreset labels against the full fit labels, and both.
+    """
+    Yfull = runPipeline(dict(plConf, sampleSize = None), X)
+    Ysample = runPipeline(dict(plConf, sampleSize = sampleSize,
+                               sampleMethod = sampleMethod), X)
+    return adjusted_rand_score(Yfull, Ysample), Yfull, Ysample
+
+# ======  End of coresets.  =======
+
+# ===================================
+# =          out of core.           =
+# ===================================
+
+def blockBounds(n, chunk = PREDICT_CHUNK, minRows = 1):
+    """
+    (start, end) of blocks of chunk rows covering n rows, a last block of
+    fewer than minRows joined to the one before it.
+    """
+    starts = list(range(0, n, chunk))
+    if len(starts) > 1 and n - starts[-1] < minRows:
+        starts.pop()
+    return list(zip(starts, starts[1:] + [n]))
+
+def blockMax(X, chunk = PREDICT_CHUNK):
+    """ np.max(X), reading X a block of chunk rows at a time. """
+    return np.max([np.max(X[start:end])
+                   for start, end in blockBounds(len(X), chunk)])
+
+def normalizedBlocks(X, maxX, chunk = PREDICT_CHUNK, dtype = np.float64,
+                     rows = None, minRows = 1):
+    """
+    (start, block) of blocks of X / maxX as dtype, NaNs as 0: X[start:end],
+    or X[rows[start:end]] if rows are given.  Only one block is in memory at
+    a time, so X can be a memory-mapped trace of any length.
+    """
+    for start, end in blockBounds(len(X) if rows is None else len(rows),
+                                  chunk, minRows):
+        block = np.array(X[start:end] if rows is None else X[rows[start:end]],
+                         dtype = dtype)
+        block /= maxX
+        block[np.isnan(block)] = 0
+        yield start, block
+
+def incrementalPcaProject(X, n_dim, maxX, sample = None, chunk = PREDICT_CHUNK,
+                          dtype = np.float64, returnModel = False):
+    """
+    pcaProject of raw samples X / maxX, a block at a time: an IncrementalPCA
+    is fit block by block (on the rows in sample if given), then every block
+    is projected into an n x n_dim array of dtype.
+    """
+    pca = IncrementalPCA(n_dim)
+    for start, block in normalizedBlocks(X, maxX, chunk, dtype, sample,
+                                         minRows = n_dim):
+        pca.partial_fit(block)
+    Xp = np.empty((len(X), n_dim), dtype = dtype)
+    for start, block in normalizedBlocks(X, maxX, chunk, dtype):
+        Xp[start:start + len(block)] = pca.transform(block)
+    if returnModel:
+        return Xp, pca
+    return Xp
+
+# ======  End of out of core.  =======
+
+# ===================================
+# =        shared X workers.        =
+# ===================================
+
+class SharedXPool(object):
+    """
+    Process pool whose workers read X from shared memory, instead of getting
+    a pickled copy of it with every task.  map(fcn, tasks) runs
+    fcn(X, task) in the workers, or fcn(X, task, sampleWeight) if the pool
+    shares sampleWeight (one per row of X) too; fcn must be a module level
+    function.
+    """
+    def __init__(self, X, nWorkers, sampleWeight = None):
+        self.shms = []
+        arrays = [self.share(X)]
+        if sampleWeight is not None:
+            arrays.append(self.share(sampleWeight))
+        self.pool = mp.Pool(max(1, nWorkers), initializer = _attachSharedX,
+                            initargs = (arrays,))
+
+    def share(self, array):
+        """ Copy array to a new shared memory segment, returns its spec. """
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create = True,
+                                         size = max(1, array.nbytes))
+        self.shms.append(shm)
+        np.ndarray(array.shape, array.dtype, buffer = shm.buf)[...] = array
+        return shm.name, array.shape, array.dtype.str
+
+    def map(self, fcn, tasks):
+        return self.pool.map(_callSharedX, [(fcn, task) for task in tasks],
+                             chunksize = 1)
+
+    def submit(self, fcn, task, callback = None, error_callback = None):
+        """ Start fcn(X, task) in a worker, returns its AsyncResult. """
+        return self.pool.apply_async(_callSharedX, ((fcn, task),),
+                                     callback = callback,
+                                     error_callback = error_callback)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for shm in self.shms:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is not None:
+            self.pool.terminate()
+        self.close()
+
+_sharedShms = []
+_sharedArrays = []
+
+def _attachSharedX(arrays):
+    global _sharedShms, _sharedArrays
+    # pool workers share the parent's resource tracker, which owns the
+    # segments and unlinks them in close()
+    _sharedShms = [shared_memory.SharedMemory(name = name)
+                   for name, shape, dtype in arrays]
+    _sharedArrays = [np.ndarray(shape, np.dtype(dtype), buffer = shm.buf)
+                     for shm, (name, shape, dtype) in zip(_sharedShms, arrays)]
+    # one BLAS thread per worker, the pool already fills the cores
+    if threadpool_limits is not None:
+        threadpool_limits(1)
+
+def _callSharedX(args):
+    fcn, task = args
+    return fcn(*_sharedArrays[:1], task, *_sharedArrays[1:])
+
+# ======  End of shared X workers.  =======
+
+def pcaProject(X, n_dim, sample = None, chunk = PREDICT_CHUNK,
+               returnModel = False, outOfCore = False, maxX = 1.0,
+               dtype = np.float64):
+    """
+    PCA projection, fit on the rows in sample if given.  With returnModel,
+    returns the fitted PCA too.  outOfCore projects raw samples X / maxX
+    with incrementalPcaProject instead.
+    """
+    if outOfCore:
+        return incrementalPcaProject(X, n_dim, maxX, sample, chunk, dtype,
+                                     returnModel)
     where_are_NaNs = np.isnan(X)        
     X[where_are_NaNs] = 0
     pca = PCA(n_dim)
-    X = pca.fit_transform(X)
+    if sample is None:
+        X = pca.fit_transform(X)
+    else:
+        pca.fit(X[sample])
+        X = applyChunked(pca.transform, X, chunk)
+    if returnModel:
+        return X, pca
     return X
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                    description='Compare coreset clustering to clustering ' \
+                                'every sample.')
+    parser.add_argument('datafiles', type=str, nargs='+',
+                        help='The raw data files.')
+    parser.add_argument('--sampleSize', type=int, nargs='+',
+                        default=[1000, 2000, 4000], help='coreset sizes.')
+    parser.add_argument('--sampleMethod', type=str, nargs='+',
+                        default=['stratified', 'reservoir'],
+                        choices=['stratified', 'reservoir'],
+                        help='coreset samplers.')
+    return parser.parse_args()
+
+def main():
+    from lib.common import bGmmConf
+
+    args = argParser()
+    print ("trace\tmethod\tsize\tk full\tk coreset\tARI\tseconds")
+    for datafile in args.datafiles:
+        X = lib.tracefile.loadTrace(datafile)
+        for sampleMethod in args.sampleMethod:
+            for sampleSize in args.sampleSize:
+                start = time.time()
+                score, Yfull, Ysample = compareSampled(bGmmConf, X,
+                                                       sampleSize,
+                                                       sampleMethod)
+                print ("%s\t%s\t%s\t%s\t%s\t%.3f\t%.1f"%(
+                       datafile, sampleMethod, sampleSize,
+                       len(set(Yfull)), len(set(Ysample)), score,
+                       time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
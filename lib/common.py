@@ -1,25 +1,68 @@
 DEBUG = False
 PARALLEL = False
 
-import lib.clustering as cluster
-from sklearn.mixture import GaussianMixture
-
 
 # hyperparameter tuning for subsequencing
 SUBSEQUENCE_EVALS = 10
+# subsequence miner, a key of lib.subsequencing.SUBSEQUENCE_ENGINES.
+# 'reference' is the original window-by-window miner.
+SUBSEQUENCE_ENGINE = 'suffix'
+# how min_frequency_thresh is picked: 'sweep' scores every threshold of a
+# geometric grid (min, max, steps) in one call, 'hyperopt' runs
+# SUBSEQUENCE_EVALS trials of fmin.  The grid spans the bulk of the hyperopt
+# prior, qlognormal(4, 0.6).
+SUBSEQUENCE_SEARCH = 'sweep'
+SUBSEQUENCE_SWEEP = (20, 150, 20)
+# mine run-length encoded sequences, one (state, log10 run length) symbol
+# per run (lib.subsequencing.RunLengthSequence), instead of every sample
+SUBSEQUENCE_RLE = False
+# where hyperopt trials run: 'serial' in this process, 'local' on a process
+# pool of SUBSEQUENCE_JOBS (None => one per core), 'mongo' through MongoDB
+# and hyperopt.sh workers
+SUBSEQUENCE_TRIALS = 'mongo' if PARALLEL else 'local'
+SUBSEQUENCE_JOBS = None
 GMM_TRIALS = 10
+# stage results are cached by content (lib.cache) in CACHE_DIR, evicting the
+# least recently used ones beyond CACHE_MAX_BYTES
+CACHE_DIR = 'tmp/cache'
+CACHE_MAX_BYTES = 2**30
 
-# configuration for GMM pipeline
+# configuration for GMM pipeline.  Functions and classes are named by their
+# dotted path and only imported when the pipeline is built
+# (lib.clustering.build3StagePipe), so reading the config stays cheap.
 bGmmConf = {
-    "projectFcn" : cluster.pcaProject,
+    "projectFcn" : "lib.clustering.pcaProject",
     "n_dim" : 2,
-    "scoreClusterFcn" : GaussianMixture,
-    "scoreFcn" : cluster.scoreBicKnee,
+    "scoreClusterFcn" : "sklearn.mixture.GaussianMixture",
+    "scoreFcn" : "lib.clustering.scoreBicKnee",
+    # lib.clustering.scoreBicKneeAdaptive fits k in order, warm-started, and
+    # stops once the knee has held for a few more k, e.g. {"patience" : 2}
+    "scoreArgs" : {},
     "kRange" : range(2, 11),
     "nTrials" : GMM_TRIALS,
-    "clusterFcn" : cluster.RegBayesianGmm,
+    "clusterFcn" : "lib.clustering.RegBayesianGmm",
     "n_init" : 10,
-    "n_init_search" : 1
+    "n_init_search" : 1,
+    # fit on a coreset of sampleSize rows (None: every row), drawn by
+    # sampleMethod "stratified" (one row per time slice) or "reservoir",
+    # then label the whole trace predictChunk rows at a time
+    "sampleSize" : None,
+    "sampleMethod" : "stratified",
+    "predictChunk" : 2**16, # lib.clustering.PREDICT_CHUNK
+    # out of core: find the normalization constant, fit the projection (an
+    # IncrementalPCA) and project and label the trace predictChunk rows at a
+    # time, reading the raw trace (memory-mapped, for a trace file) block by
+    # block instead of copying it whole.  With a sampleSize, the GMM fits
+    # stay bounded too.
+    "outOfCore" : False,
+    # float type of the normalized and projected samples: None as the
+    # division gives it (float64 for integer traces), or "float32"
+    "dtype" : None,
+    # fit the GMMs on the unique projected rows, weighted by how often each
+    # occurs, and label every row as its unique row.  dedupDecimals rounds
+    # the rows first, to collapse near identical ones too.
+    "dedup" : False,
+    "dedupDecimals" : None
 }
 
 class DummyFile(object):
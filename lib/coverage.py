@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# Coverage of a sequence by taken ranges, as the subsequence miners use it.
+# A taken range (start, end) holds the windows inside [start, end): a window
+# is covered, and skipped by the miners, if it lies inside one taken range.
+# For coverage totals the same range counts positions start..end inclusive,
+# as the miners have always counted it.
+#
+# CoverageIndex keeps, for every position p, the furthest end of any range
+# starting at or before p (its reach).  Whether a window is covered and the
+# next window that is not are then one lookup each, however many ranges were
+# taken, and adding a batch of ranges is one O(n) NumPy pass.  unionSize
+# counts the positions of a set of ranges in one vectorized pass, and
+# unionSizes those of many sets at once.  The miners return their taken
+# ranges as TakenRanges, which keep the index they came from, so totalling
+# them reads its arrays instead of the tuples.
+
+import itertools
+import numpy as np
+
+
+def rangeArray(ranges, count = None):
+    """ count x 2 array of an iterable of count (start, end) tuples. """
+    if count is None:
+        ranges = list(ranges)
+        count = len(ranges)
+    # fromiter over the flattened pairs is several times faster than
+    # np.array on a list of tuples
+    return np.fromiter(itertools.chain.from_iterable(ranges), np.int64,
+                       2 * count).reshape(count, 2)
+
+def newPositions(starts, ends):
+    """
+    For ranges (starts[i], ends[i]), ends inclusive: the order they start
+    in, and in that order, how many positions each covers that the ranges
+    before it do not.
+    """
+    order = np.argsort(starts, kind = 'stable')
+    starts, ends = starts[order], ends[order]
+    # the furthest position covered before each range
+    before = np.concatenate(([-1], np.maximum.accumulate(ends)[:-1]))
+    return order, np.maximum(ends - np.maximum(starts - 1, before), 0)
+
+def unionSize(starts, ends):
+    """ Positions covered by ranges (starts[i], ends[i]), ends inclusive. """
+    starts = np.asarray(starts, dtype = np.int64)
+    ends = np.asarray(ends, dtype = np.int64)
+    if not len(starts):
+        return 0
+    return int(newPositions(starts, ends)[1].sum())
+
+def rangesUnionSize(ranges):
+    """ unionSize of a list of (start, end) tuples. """
+    return unionSizes([ranges])[0]
+
+def unionSizes(rangeLists):
+    """
+    unionSize of every list of (start, end) tuples in rangeLists, in one
+    pass: each list is shifted past the ones before it, so their ranges
+    never overlap, and the new positions are summed per list.
+    """
+    counts = [len(ranges) for ranges in rangeLists]
+    if not sum(counts):
+        return [0] * len(counts)
+    ranges = rangeArray(itertools.chain.from_iterable(rangeLists),
+                        sum(counts))
+    lists = np.repeat(np.arange(len(counts)), counts)
+    return groupUnionSizes(ranges[:, 0], ranges[:, 1], lists,
+                           len(counts)).tolist()
+
+def groupUnionSizes(starts, ends, groups, nGroups):
+    """
+    unionSize of the ranges (starts[i], ends[i]) of each group, groups[i]
+    being the group (0..nGroups-1) of range i.
+    """
+    starts = np.asarray(starts, dtype = np.int64)
+    ends = np.asarray(ends, dtype = np.int64)
+    groups = np.asarray(groups, dtype = np.int64)
+    if not len(starts):
+        return np.zeros(nGroups, dtype = np.int64)
+    shift = groups * (ends.max() - min(starts.min(), 0) + 2)
+    order, new = newPositions(starts + shift, ends + shift)
+    return np.bincount(groups[order], weights = new,
+                       minlength = nGroups).astype(np.int64)
+
+class TakenRanges(list):
+    """ The (start, end) tuples of a CoverageIndex, and the index. """
+    def __init__(self, ranges, index):
+        super(TakenRanges, self).__init__(ranges)
+        self.index = index
+
+class CoverageIndex(object):
+    """ Taken ranges over positions 0..n-1 of a sequence. """
+    def __init__(self, n):
+        self.n = n
+        # furthest end of a range starting at p, and its prefix max, the
+        # furthest end of a range starting at or before p
+        self.furthest = np.zeros(n + 1, dtype = np.int64)
+        self.reach = np.zeros(n + 1, dtype = np.int64)
+        self.starts = []
+        self.ends = []
+        self.stale = False
+        self.reachList = None
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.starts)
+
+    def add(self, starts, ends):
+        """ Take the ranges (starts[i], ends[i]). """
+        starts = np.asarray(starts, dtype = np.int64)
+        ends = np.asarray(ends, dtype = np.int64)
+        if not len(starts):
+            return
+        np.maximum.at(self.furthest, starts, ends)
+        self.starts.append(starts)
+        self.ends.append(ends)
+        self.stale = True
+
+    def update(self):
+        """ Bring reach up to date with the ranges added. """
+        if self.stale:
+            np.maximum.accumulate(self.furthest, out = self.reach)
+            self.reachList = None
+            self.stale = False
+
+    def reachAt(self):
+        """
+        reach as a list, for loops that look up one position at a time:
+        window [p, p + length) is covered iff reach[p] >= p + length.
+        """
+        self.update()
+        if self.reachList is None:
+            self.reachList = self.reach.tolist()
+        return self.reachList
+
+    def covered(self, start, length):
+        """ Whether window [start, start + length) is inside a taken range. """
+        return self.reachAt()[start] >= start + length
+
+    def coveredWindows(self, length):
+        """ Whether each window of length, by start, is covered. """
+        self.update()
+        starts = np.arange(self.n - length + 1)
+        return self.reach[starts] >= starts + length
+
+    def nextUncovered(self, start, length):
+        """
+        The first start from start on whose window of length is not covered
+        (n - length + 1 if none).  Every window skipped lies inside the range
+        that reaches furthest from the previous one.
+        """
+        reach = self.reachAt()
+        while start <= self.n - length and reach[start] >= start + length:
+            start = reach[start] - length + 1
+        return start
+
+    def ranges(self):
+        """ The taken ranges by start, the longer first if starts tie. """
+        if not self.starts:
+            return TakenRanges([], self)
+        starts = np.concatenate(self.starts)
+        ends = np.concatenate(self.ends)
+        order = np.lexsort((-ends, starts))
+        return TakenRanges(zip(starts[order].tolist(), ends[order].tolist()),
+                           self)
+
+    def unionSize(self):
+        """ Positions covered by the taken ranges, ends inclusive. """
+        if not self.starts:
+            return 0
+        return unionSize(np.concatenate(self.starts),
+                         np.concatenate(self.ends))
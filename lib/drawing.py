@@ -10,6 +10,8 @@ import numpy as np
 from matplotlib import pyplot as plt
 from matplotlib.patches import FancyArrowPatch 
 
+import lib.statestats
+
 
 LABEL_WIDTH = 1.2
 LABEL_HEIGHT = .6
@@ -52,17 +54,12 @@ def main():
 
 def plot(original_pts, clustered_pts, merged_freq, coverage_sum,
          outfile, plot = True):
-    # compute state frequencies
-    state_frequencies = {}
-
-    for state in clustered_pts:
-        if state not in state_frequencies:
-            state_frequencies[state] = 0
-        state_frequencies[state] += 1
+    # compute state frequencies, means and stability
+    stats = lib.statestats.StateStats(clustered_pts, original_pts)
 
     # generate state positioning data structures
-    ordered_states = sorted(state_frequencies.items(),
-                            key = lambda tup : tup[1])[::-1]
+    ordered_states = [(state, int(stats.counts[state]))
+                      for state in stats.ordered()]
     state_to_position = {val[0]:key for (key, val) in enumerate(ordered_states)}
 
     # generate sequence positioning data structures
@@ -81,7 +78,8 @@ def plot(original_pts, clustered_pts, merged_freq, coverage_sum,
     # label axes. 
     label_axes(max_y)
     # render states at the top of the canvas.
-    render_clustered_states(original_pts, clustered_pts, ordered_states, max_y)
+    render_clustered_states(original_pts, clustered_pts, ordered_states, max_y,
+                            stats)
 
     # render each sequence.
     min_y = render_subsequences(state_to_position, ordered_sequences,
@@ -102,23 +100,20 @@ def label_axes(max_y):
     # render text.
     plt.text(0, max_y + STATE_PADDED_HEIGHT, "% time:\nstability:")
 
-def render_clustered_states(original_pts, clustered_pts, ordered_states, max_y):
+def render_clustered_states(original_pts, clustered_pts, ordered_states, max_y,
+                            stats = None):
     # render heatmaps of clusters found by the algorithm
     # TODO: why 8?
     max_sample = max(np.max(original_pts, 0) * 8.0)
     # print(max_sample)
 
-    original_pts = np.array(original_pts)
-    clustered_pts = np.array(clustered_pts)
+    if stats is None:
+        stats = lib.statestats.StateStats(clustered_pts, original_pts)
     # generate a PNG image for each cluster.
     for idx, (state_id, state_freq) in enumerate(ordered_states):
-        # select all the samples that belong to this cluster.
-        clustered_sample_idx = np.where(clustered_pts == state_id)[0]
-        original_sample = original_pts[clustered_sample_idx]
-
         # calculate the heatmap grid: get average, normalize, and reshape into a
         # 2x2 grid.
-        average_sample = np.average(original_sample, 0) * 8.0
+        average_sample = stats.means[state_id] * 8.0
         average_sample = average_sample / max_sample
         average_hm = np.flip(np.split(average_sample, 2), 0)
 
@@ -155,17 +150,9 @@ def render_clustered_states(original_pts, clustered_pts, ordered_states, max_y):
                                  facecolor = 'none')
         ax.add_patch(rect)
 
-        # calculate frequency and stability
-        freq = len(clustered_sample_idx) / float(len(clustered_pts))
-
-        selfCt = 0
-        selfLoopCt = 0
-        for i in range(len(clustered_pts) - 1):
-            if (clustered_pts[i] == state_id):
-                selfCt += 1
-                if (clustered_pts[i+1] == state_id):
-                    selfLoopCt += 1
-        stab = float(selfLoopCt) / float(selfCt)
+        # frequency and stability
+        freq = stats.frequencies[state_id]
+        stab = stats.stability[state_id]
 
         plt.text(left + STATE_PADDED_WIDTH/2, max_y + STATE_PADDED_HEIGHT,
                  str(round(freq * 100, 1)) + "%\n" + \
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+# Opt-in instrumentation of a run.  Stages are timed by wrapping them in
+# span(name), which records their wall time, CPU time (of this process, and
+# of its child processes that finished meanwhile, e.g. a pool's workers) and
+# peak RSS; hot loops add to counters with count(name, n), which go to the
+# innermost open span.  Until enable() is called both do nothing, so the
+# hooks stay in the code for free.  report() returns what was recorded as
+# JSON types, chromeTrace() as a Chrome trace (chrome://tracing, Perfetto).
+#
+# Peak RSS is per span on Linux, which can reset the process's high water
+# mark (/proc/self/clear_refs); elsewhere it is the process's peak so far.
+# Spans and counters of pool workers are not collected.
+
+import contextlib
+import json
+import os
+import re
+import resource
+import threading
+import time
+
+
+REPORT_VERSION = 1
+
+_recorder = None
+
+
+# ===================================
+# =            peak RSS.            =
+# ===================================
+
+def resetPeakRss():
+    """ Reset the process's peak RSS to its current RSS; False if unable. """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peakRss():
+    """ Peak RSS of this process in bytes, since the last reset if any. """
+    try:
+        with open('/proc/self/status') as f:
+            return int(re.search(r'VmHWM:\s+(\d+) kB', f.read()).group(1)) \
+                   * 1024
+    except (OSError, AttributeError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def childCpu():
+    times = os.times()
+    return times.children_user + times.children_system
+
+# ======  End of peak RSS.  =======
+
+class Span(object):
+    """ One timed region: a stage, a trial, a call. """
+    def __init__(self, name, parent, start, args):
+        self.name = name
+        self.parent = parent
+        self.start = start
+        self.args = args
+        self.wall = self.cpu = self.childCpu = None
+        self.peakRss = 0
+        self.counters = {}
+        self.thread = threading.get_ident()
+
+    def asDict(self):
+        return {'name' : self.name,
+                'parent' : self.parent, # index of the enclosing span
+                'start' : self.start,
+                'wall' : self.wall,
+                'cpu' : self.cpu,
+                'childCpu' : self.childCpu,
+                'peakRssBytes' : self.peakRss,
+                'args' : self.args,
+                'counters' : self.counters}
+
+class Recorder(object):
+    """ The spans and counters of a run, from enable() on. """
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.spans = [] # in the order they started
+        self.open = [] # indices into spans, innermost last
+        self.counters = {}
+        self.exactRss = resetPeakRss()
+
+    def foldRss(self):
+        """ Credit the peak RSS since the last reset to every open span. """
+        rss = peakRss()
+        for i in self.open:
+            self.spans[i].peakRss = max(self.spans[i].peakRss, rss)
+
+    @contextlib.contextmanager
+    def span(self, name, args):
+        if self.exactRss:
+            # the enclosing spans keep the peak so far, then measure anew
+            self.foldRss()
+            resetPeakRss()
+        span = Span(name, self.open[-1] if self.open else None,
+                    time.perf_counter() - self.origin, args)
+        self.spans.append(span)
+        self.open.append(len(self.spans) - 1)
+        wall, cpu, child = time.perf_counter(), time.process_time(), \
+                           childCpu()
+        try:
+            yield span
+        finally:
+            span.wall = time.perf_counter() - wall
+            span.cpu = time.process_time() - cpu
+            span.childCpu = childCpu() - child
+            self.foldRss()
+            self.open.pop()
+
+    def count(self, name, n):
+        self.counters[name] = self.counters.get(name, 0) + n
+        if self.open:
+            counters = self.spans[self.open[-1]].counters
+            counters[name] = counters.get(name, 0) + n
+
+    def report(self):
+        return {'version' : REPORT_VERSION,
+                'pid' : os.getpid(),
+                'wall' : time.perf_counter() - self.origin,
+                'exactPeakRss' : self.exactRss,
+                'peakRssBytes' : resource.getrusage(
+                                    resource.RUSAGE_SELF).ru_maxrss * 1024,
+                'counters' : self.counters,
+                'spans' : [span.asDict() for span in self.spans]}
+
+    def chromeTrace(self):
+        """ The spans as complete events, peak RSS as a counter track. """
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            if span.wall is None:
+                continue # still open
+            args = dict(span.args, cpu = span.cpu, childCpu = span.childCpu,
+                        peakRssBytes = span.peakRss, **span.counters)
+            events.append({'name' : span.name, 'ph' : 'X', 'pid' : pid,
+                           'tid' : span.thread, 'ts' : span.start * 1e6,
+                           'dur' : span.wall * 1e6, 'args' : args})
+            events.append({'name' : 'peak RSS (MiB)', 'ph' : 'C',
+                           'pid' : pid, 'ts' : (span.start + span.wall) * 1e6,
+                           'args' : {'peak' : span.peakRss / 2**20}})
+        return {'traceEvents' : events, 'displayTimeUnit' : 'ms'}
+
+# ===================================
+# =              hooks.             =
+# ===================================
+
+def enable():
+    """ Start recording; spans and counters before this are not recorded. """
+    global _recorder
+    _recorder = Recorder()
+
+def enabled():
+    return _recorder is not None
+
+def span(name, **args):
+    """ Context manager timing the region it wraps, if enabled. """
+    if _recorder is None:
+        return contextlib.nullcontext()
+    return _recorder.span(name, args)
+
+def count(name, n = 1):
+    """ Add n to counter name, if enabled. """
+    if _recorder is not None:
+        _recorder.count(name, n)
+
+def report():
+    """ What was recorded, as JSON types; None if not enabled. """
+    return None if _recorder is None else _recorder.report()
+
+def write(filename, chrome = False):
+    """ Write what was recorded to filename, as a Chrome trace if chrome. """
+    if _recorder is None:
+        return
+    value = _recorder.chromeTrace() if chrome else _recorder.report()
+    with open(filename, 'w') as f:
+        json.dump(value, f, indent = None if chrome else 1)
+
+# ======  End of hooks.  =======
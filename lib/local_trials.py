@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+# hyperopt trials on a local process pool, in place of MongoTrials and the
+# hyperopt.sh worker farm.  fmin's own asynchronous mode polls its trials
+# once a second, so this drives the suggest / evaluate loop directly: up to
+# jobs trials run at once, and each new trial is suggested from all the
+# trials finished so far.
+
+from hyperopt import base, pyll, tpe, Trials
+from hyperopt.utils import coarse_utcnow
+import numpy as np
+import queue
+
+
+def trial_params(domain, doc):
+    """ The params fn is called with for a suggested trial document. """
+    memo = domain.memo_from_config(base.spec_from_misc(doc['misc']))
+    return pyll.rec_eval(domain.expr, memo = memo)
+
+def fmin_local(fn, space, max_evals, pool, jobs, rstate = None,
+               algo = tpe.suggest):
+    """
+    Minimize fn over space with max_evals trials on pool, a
+    lib.clustering.SharedXPool: each trial runs fn(X, params) in a worker,
+    where X is the pool's shared array.  fn returns a result dict as for
+    fmin, attachments included.  Returns (best, trials) like fmin with
+    return_argmin.
+    """
+    if rstate is None:
+        rstate = np.random.RandomState()
+    trials = Trials()
+    domain = base.Domain(fn, space)
+    finished = queue.Queue() # (tid, result, error) from the pool's callbacks
+    running = {}
+
+    n_queued = 0
+    while n_queued < max_evals or running:
+        while n_queued < max_evals and len(running) < jobs:
+            tid, = trials.new_trial_ids(1)
+            trials.refresh()
+            doc, = algo([tid], domain, trials, rstate.randint(2**31 - 1))
+            running[tid] = doc
+            pool.submit(fn, trial_params(domain, doc),
+                        callback = lambda result, tid = tid:
+                                   finished.put((tid, result, None)),
+                        error_callback = lambda error, tid = tid:
+                                         finished.put((tid, None, error)))
+            n_queued += 1
+
+        tid, result, error = finished.get()
+        doc = running.pop(tid)
+        if error is not None:
+            raise error
+        result = dict(result)
+        attachments = result.pop('attachments', {})
+        # trials only enter the history once done: suggestions are made
+        # from finished trials anyway
+        doc['state'] = base.JOB_STATE_DONE
+        doc['result'] = result
+        doc['refresh_time'] = coarse_utcnow()
+        trials.insert_trial_docs([doc])
+        trials.refresh()
+        for key, value in attachments.items():
+            trials.trial_attachments(doc)[key] = value
+
+    return trials.argmin, trials
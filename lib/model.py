@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# Fitted state model.  What labelling a sample needs from a fitted pipeline
+# (lib.clustering.fitPipeline): the global normalization constant, the
+# projection and the mixture, as plain arrays.  A model file is an .npz of
+# those arrays, a few KB, loaded without pickle or sklearn.
+#
+# Labelling is vectorized NumPy: a sample x goes to the component k with the
+# highest weighted log likelihood, which for every mixture sklearn fits
+# (GaussianMixture and BayesianGaussianMixture, any covariance type) is
+#     logConst[k] - |(x' - means[k]) @ precisionsChol[k]|^2 / 2
+# where x' = (x / maxX - mean) @ projection is the projected sample and
+# logConst[k] holds every term that does not depend on x.
+
+import argparse
+import numpy as np
+
+import lib.tracefile
+
+
+MODEL_VERSION = 1
+MODEL_ARRAYS = ('maxX', 'mean', 'projection', 'means', 'precisionsChol',
+                'logConst')
+PREDICT_CHUNK = 2**16 # samples labelled per block
+
+
+class StateModel(object):
+    """ Normalization, linear projection and mixture of a fitted pipeline. """
+    def __init__(self, maxX, mean, projection, means, precisionsChol,
+                 logConst):
+        self.maxX = float(maxX)
+        self.mean = np.asarray(mean, dtype = np.float64)
+        self.projection = np.asarray(projection, dtype = np.float64)
+        self.means = np.asarray(means, dtype = np.float64)
+        self.precisionsChol = np.asarray(precisionsChol, dtype = np.float64)
+        self.logConst = np.asarray(logConst, dtype = np.float64)
+
+    @property
+    def nSwitches(self):
+        return self.projection.shape[0]
+
+    @property
+    def nStates(self):
+        return len(self.means)
+
+    @classmethod
+    def fromFitted(cls, model):
+        """
+        From the fitted model of lib.clustering.fitPipeline, a dict of maxX,
+        projector (a PCA) and clf (a sklearn mixture).
+        """
+        projector, clf = model["projector"], model["clf"]
+        if not hasattr(projector, "components_"):
+            raise ValueError("only linear projections (PCA) can be exported, "
+                             "got %s" % type(projector).__name__)
+        projection = projector.components_.T
+        if getattr(projector, "whiten", False):
+            projection = projection / np.sqrt(projector.explained_variance_)
+
+        nStates, nDims = clf.means_.shape
+        # every covariance type as one Cholesky factor per component
+        chol = clf.precisions_cholesky_
+        if clf.covariance_type == "tied":
+            chol = np.broadcast_to(chol, (nStates, nDims, nDims))
+        elif clf.covariance_type == "diag":
+            chol = chol[:, :, np.newaxis] * np.eye(nDims)
+        elif clf.covariance_type == "spherical":
+            chol = chol[:, np.newaxis, np.newaxis] * np.eye(nDims)
+        # log weight and Gaussian normalizer, log det(chol) - d log(2 pi) / 2
+        logConst = np.log(np.diagonal(chol, axis1 = 1, axis2 = 2)).sum(1) - \
+                   0.5 * nDims * np.log(2 * np.pi)
+        if hasattr(clf, "weight_concentration_"):
+            logConst = logConst + variationalLogTerms(clf)
+        else:
+            logConst = logConst + np.log(clf.weights_)
+
+        return cls(model["maxX"], projector.mean_, projection, clf.means_,
+                   chol, logConst)
+
+    @classmethod
+    def fromArrays(cls, arrays, name = "model"):
+        """ From the arrays() of a model, any mapping of name to array. """
+        version = int(arrays["version"])
+        if version > MODEL_VERSION:
+            raise ValueError("%s has model version %d, newest supported is %d"
+                             % (name, version, MODEL_VERSION))
+        return cls(*(arrays[array] for array in MODEL_ARRAYS))
+
+    def arrays(self):
+        """ The model as {name: array}, version included. """
+        arrays = {name : getattr(self, name) for name in MODEL_ARRAYS}
+        arrays["version"] = MODEL_VERSION
+        return arrays
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename, allow_pickle = False) as f:
+            return cls.fromArrays(f, filename)
+
+    def save(self, filename):
+        # through a file object, so np.savez does not append .npz
+        with open(filename, 'wb') as f:
+            np.savez_compressed(f, **self.arrays())
+
+    def project(self, X):
+        """ Normalized, projected samples. """
+        X = np.asarray(X, dtype = np.float64) / self.maxX
+        X[np.isnan(X)] = 0
+        return (X - self.mean) @ self.projection
+
+    def logLikelihood(self, X):
+        """ samples x states weighted log likelihoods of raw samples X. """
+        Xp = self.project(X)
+        L = np.empty((len(Xp), self.nStates))
+        for k in range(self.nStates):
+            whitened = Xp @ self.precisionsChol[k] - \
+                       self.means[k] @ self.precisionsChol[k]
+            L[:, k] = self.logConst[k] - 0.5 * np.einsum('ij,ij->i', whitened,
+                                                         whitened)
+        return L
+
+    def predict(self, X, chunk = PREDICT_CHUNK):
+        """ State of every raw sample in X, chunk samples at a time. """
+        X = np.asarray(X)
+        Y = np.empty(len(X), dtype = np.int64)
+        for start in range(0, len(X), chunk):
+            Y[start:start + chunk] = \
+                    self.logLikelihood(X[start:start + chunk]).argmax(1)
+        return Y
+
+def variationalLogTerms(clf):
+    """
+    The terms of a fitted BayesianGaussianMixture's weighted log likelihood,
+    per component, that a GaussianMixture's has not: expected log weights
+    and precision corrections, from its posterior parameters.
+    """
+    from scipy.special import digamma # only needed to export a model
+
+    nStates, nDims = clf.means_.shape
+    if clf.weight_concentration_prior_type == "dirichlet_process":
+        a, b = clf.weight_concentration_
+        logSum = digamma(a + b)
+        logWeights = digamma(a) - logSum + \
+                     np.concatenate(([0], np.cumsum(digamma(b) - logSum)[:-1]))
+    else:
+        logWeights = digamma(clf.weight_concentration_) - \
+                     digamma(np.sum(clf.weight_concentration_))
+    # a tied covariance has one number of degrees of freedom for all
+    dof = np.broadcast_to(clf.degrees_of_freedom_, (nStates,))
+    logLambda = nDims * np.log(2) + \
+                digamma(0.5 * (dof - np.arange(nDims)[:, np.newaxis])).sum(0)
+    return logWeights - 0.5 * nDims * np.log(dof) + \
+           0.5 * (logLambda - nDims / clf.mean_precision_)
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('model', type=str, help='The model file.')
+    parser.add_argument('datafile', type=str, nargs='?',
+                        help='a trace to label, printing one state per line.')
+    return parser.parse_args()
+
+def main():
+    args = argParser()
+
+    model = StateModel.load(args.model)
+    print ("MODEL: %s" % args.model)
+    print ("--------------------")
+    print ("\tswitches: %d" % model.nSwitches)
+    print ("\tprojected dimensions: %d" % model.projection.shape[1])
+    print ("\tstates: %d" % model.nStates)
+    print ("\tnormalization: %g" % model.maxX)
+    print ("--------------------")
+    if args.datafile:
+        Y = model.predict(lib.tracefile.loadTrace(args.datafile))
+        print ('\n'.join(str(y) for y in Y.tolist()))
+
+
+if __name__ == '__main__':
+    main()
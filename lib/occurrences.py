@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+# Compact storage of the occurrences of mined subsequences.  The miners used
+# to return subsequence_coverage as a dict of lists of (start, end) tuples,
+# about 100 bytes per occurrence once pickled and unpickled.  An
+# OccurrenceStore keeps the same thing in four flat arrays:
+#
+#     symbols      uint8   every key's states, one key after the other
+#     keyBounds    int64   key i is symbols[keyBounds[i]:keyBounds[i + 1]]
+#     starts       int32   every key's occurrence starts, sorted per key
+#     startBounds  int64   key i starts at starts[startBounds[i]:...[i + 1]]
+#
+# Ends are not stored: an occurrence of key i ends len(key i) after it
+# starts.  The store reads like the dict it replaces (store[key] is the list
+# of (start, end) tuples, made on demand), so code written for the dict keeps
+# working, while merging and coverage work on the arrays directly.  save()
+# writes the arrays to an uncompressed .npz, which load() memory-maps instead
+# of reading; dumps() and loads() do the same in memory, for hyperopt
+# attachments.
+
+import argparse
+import collections.abc
+import io
+import numpy as np
+import pickle
+
+import lib.results
+
+
+OCCURRENCE_VERSION = 1
+ARRAYS = ('symbols', 'keyBounds', 'starts', 'startBounds')
+
+
+def startsType(maxStart):
+    """ int32 unless a start does not fit. """
+    return np.int32 if maxStart < 2**31 else np.int64
+
+class OccurrenceStore(collections.abc.Mapping):
+    """ Occurrences of subsequences, read like subsequence_coverage. """
+    def __init__(self, symbols, keyBounds, starts, startBounds):
+        self.symbols = symbols
+        self.keyBounds = keyBounds
+        self.starts = starts
+        self.startBounds = startBounds
+        self._index = None # key -> i, made on the first lookup
+
+    @classmethod
+    def fromGroups(cls, groups):
+        """ From (key, starts) pairs, key and starts any int sequences. """
+        keys, starts = [], []
+        for key, keyStarts in groups:
+            keys.append(np.asarray(key, dtype = np.uint8))
+            starts.append(np.asarray(keyStarts, dtype = np.int64))
+        bounds = lambda arrays: np.concatenate(
+                    ([0], np.cumsum([len(a) for a in arrays],
+                                    dtype = np.int64)))
+        symbols = np.concatenate(keys) if keys else np.zeros(0, np.uint8)
+        allStarts = np.concatenate(starts) if starts \
+                    else np.zeros(0, np.int64)
+        allStarts = allStarts.astype(startsType(allStarts.max(initial = 0)))
+        return cls(symbols, bounds(keys), allStarts, bounds(starts))
+
+    @classmethod
+    def fromCoverage(cls, subsequence_coverage):
+        """
+        From a subsequence_coverage dict, {key: [(start, end), ...]}; a
+        store is returned as it is.
+        """
+        if isinstance(subsequence_coverage, cls):
+            return subsequence_coverage
+        return cls.fromGroups((key, [start for start, end in ranges])
+                              for key, ranges in subsequence_coverage.items())
+
+    # ===================================
+    # =          dict interface.        =
+    # ===================================
+
+    def __len__(self):
+        return len(self.keyBounds) - 1
+
+    def key(self, i):
+        """ Key i as a tuple of ints. """
+        return tuple(self.symbols[self.keyBounds[i]:
+                                  self.keyBounds[i + 1]].tolist())
+
+    def __iter__(self):
+        symbols, bounds = self.symbols.tolist(), self.keyBounds.tolist()
+        for i in range(len(self)):
+            yield tuple(symbols[bounds[i]:bounds[i + 1]])
+
+    def index(self, key):
+        """ i of key; KeyError if it is not stored. """
+        if self._index is None:
+            self._index = {k : i for i, k in enumerate(self)}
+        return self._index[tuple(key)]
+
+    def occurrences(self, i):
+        """ Starts of the occurrences of key i. """
+        return self.starts[self.startBounds[i]:self.startBounds[i + 1]]
+
+    def __getitem__(self, key):
+        i = self.index(key)
+        length = int(self.keyBounds[i + 1] - self.keyBounds[i])
+        return [(start, start + length)
+                for start in self.occurrences(i).tolist()]
+
+    # ======  End of dict interface.  =======
+
+    def lengths(self):
+        """ Length of every key. """
+        return np.diff(self.keyBounds)
+
+    def counts(self):
+        """ Occurrences of every key. """
+        return np.diff(self.startBounds)
+
+    def ranges(self):
+        """ (starts, ends) of every occurrence, key by key. """
+        starts = self.starts.astype(np.int64)
+        return starts, starts + np.repeat(self.lengths(), self.counts())
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def arrays(self):
+        """ The store as {name: array}, version included. """
+        arrays = {name : np.asarray(getattr(self, name)) for name in ARRAYS}
+        arrays['version'] = OCCURRENCE_VERSION
+        return arrays
+
+    @classmethod
+    def fromArrays(cls, arrays, name = 'occurrence data'):
+        """ From the arrays() of a store, any mapping of name to array. """
+        version = int(arrays['version'])
+        if version > OCCURRENCE_VERSION:
+            raise ValueError("%s has occurrence version %d, newest supported "
+                             "is %d" % (name, version, OCCURRENCE_VERSION))
+        return cls(*(arrays[array] for array in ARRAYS))
+
+    def __getstate__(self):
+        # the index is rebuilt on demand
+        return self.arrays()
+
+    def __setstate__(self, state):
+        self.__init__(*(state[name] for name in ARRAYS))
+
+    # ===================================
+    # =            .npz files.          =
+    # ===================================
+
+    def _write(self, f):
+        np.savez(f, **self.arrays())
+
+    def save(self, filename):
+        # through a file object, so np.savez does not append .npz
+        with open(filename, 'wb') as f:
+            self._write(f)
+
+    @classmethod
+    def load(cls, filename, mmap = True):
+        """ A saved store, its arrays memory-mapped if mmap. """
+        if mmap:
+            return cls.fromArrays(lib.results.mapNpz(filename), filename)
+        with np.load(filename, allow_pickle = False) as f:
+            return cls.fromArrays({name : f[name] for name in f.files},
+                                  filename)
+
+    def dumps(self):
+        f = io.BytesIO()
+        self._write(f)
+        return f.getvalue()
+
+    @classmethod
+    def loads(cls, data):
+        with np.load(io.BytesIO(data), allow_pickle = False) as f:
+            return cls.fromArrays({name : f[name] for name in f.files})
+
+    # ======  End of .npz files.  =======
+
+# ===================================
+# =       hyperopt attachments.     =
+# ===================================
+
+def dumps(subsequence_coverage):
+    """ subsequence_coverage as bytes: a store as .npz, a dict pickled. """
+    if isinstance(subsequence_coverage, OccurrenceStore):
+        return subsequence_coverage.dumps()
+    return pickle.dumps(subsequence_coverage)
+
+def loads(data):
+    """ subsequence_coverage from dumps() bytes. """
+    if data[:2] == b'PK': # a zip archive, i.e. an .npz
+        return OccurrenceStore.loads(data)
+    return pickle.loads(data)
+
+# ======  End of hyperopt attachments.  =======
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('infile', type=str,
+                        help='an occurrence file, e.g. tmp/<NAME>.occurrences')
+    parser.add_argument('--top', type=int, default=20,
+                        help='keys to list, most occurrences first.')
+    return parser.parse_args()
+
+def main():
+    args = argParser()
+
+    store = OccurrenceStore.load(args.infile)
+    counts, lengths = store.counts(), store.lengths()
+    print("%s: %d subsequences, %d occurrences, %.1f KiB" %
+          (args.infile, len(store), counts.sum(), store.nbytes() / 2**10))
+    for i in np.argsort(-counts, kind = 'stable')[:args.top].tolist():
+        starts = store.occurrences(i)
+        print("\t%6d x %4d states from %d: %s" %
+              (counts[i], lengths[i], starts[0],
+               ' '.join(str(s) for s in store.key(i))))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,133 @@
 #!/usr/bin/python3
+import gzip
+import io
 import math
+import numpy as np
+import warnings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+CHUNK_BYTES = 64 * 2**20 # text read per chunk by iterSwitchTrace
 
 
 def parseSwitchTrace(filename):
     """
     Parse a file containing network samples.  Assumes one sample per line.
-    Different switches are separated by spaces.
+    Different switches are separated by spaces.  Returns an int64 array with
+    one row per sample.
+    """
+    return loadSwitchTrace(filename)
+
+def openText(filename):
+    """ Open a text trace, decompressing gzip and zstd input. """
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(filename, 'rt')
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ImportError("%s is zstd compressed; reading it needs the "
+                              "zstandard package" % filename)
+        stream = zstandard.ZstdDecompressor().stream_reader(
+                    open(filename, 'rb'), closefd = True)
+        return io.TextIOWrapper(stream)
+    return open(filename, 'r')
+
+def lineFieldCounts(text, sep = None):
+    """
+    Number of fields on every line of text (str or bytes) that is not blank:
+    its runs of non-whitespace, or with sep, one more than its sep characters.
+    """
+    if isinstance(text, str):
+        text = text.encode()
+    data = np.frombuffer(text, dtype = np.uint8)
+    lineStarts = np.concatenate(([0], np.flatnonzero(data == ord('\n')) + 1))
+    lineStarts = lineStarts[lineStarts < len(data)]
+    if not len(lineStarts):
+        return np.zeros(0, dtype = np.int64)
+    space = data <= ord(' ') # whitespace, and control bytes no number has
+    # the first byte of every run of non-whitespace, counted per line
+    tokens = ~space
+    tokens[1:] &= space[:-1]
+    counts = np.add.reduceat(tokens, lineStarts, dtype = np.int64)
+    nonBlank = counts > 0
+    if sep is not None:
+        counts = np.add.reduceat(data == ord(sep), lineStarts,
+                                 dtype = np.int64) + 1
+    return counts[nonBlank]
+
+def iterSwitchTrace(filename, dtype = np.int64, chunkBytes = CHUNK_BYTES,
+                    progress = False):
+    """
+    Parse a trace in chunks of about chunkBytes of text.  Yields one
+    (samples x switches) array of dtype per chunk, so files larger than
+    memory can be streamed.
     """
     print("parsing input file: %s" % filename)
 
-    switchFeaturesVec = []
-    with open(filename, 'r') as data_file:
-        for line in data_file:
-            tokens = [int(i) for i in line.split()]
-            switchFeaturesVec.append(tokens)
+    nSwitches = None
+    nSamples = 0
+    with openText(filename) as data_file:
+        tail = ''
+        while True:
+            text = data_file.read(chunkBytes)
+            if not text:
+                text, tail = tail, ''
+                if not text.strip():
+                    break
+            else:
+                # only parse whole lines, carry the rest to the next chunk
+                cut = text.rfind('\n') + 1
+                text, tail = tail + text[:cut], text[cut:]
+                if not text.strip():
+                    continue
 
-    return switchFeaturesVec
+            if nSwitches is None:
+                nSwitches = len(text.lstrip().split('\n', 1)[0].split())
+            with warnings.catch_warnings():
+                # malformed text stops the parse early; caught below
+                warnings.simplefilter('ignore', DeprecationWarning)
+                values = np.fromstring(text, sep = ' ',
+                                       dtype = np.int64
+                                       if np.dtype(dtype).kind in 'iu'
+                                       else dtype)
+            # every line must hold nSwitches values, and all of them parsed
+            counts = lineFieldCounts(text)
+            bad = np.flatnonzero(counts != nSwitches)
+            if len(bad) or values.size != counts.sum():
+                raise ValueError("%s: expected %d values on every line after "
+                                 "sample %d" % (filename, nSwitches,
+                                                nSamples + (bad[0] if len(bad)
+                                                            else 0)))
+            nRows = len(counts)
+            if values.dtype != dtype:
+                limits = np.iinfo(dtype)
+                if values.size and (values.min() < limits.min or
+                                    values.max() > limits.max):
+                    raise ValueError("%s: values after sample %d do not fit "
+                                     "in %s" % (filename, nSamples,
+                                                np.dtype(dtype).name))
+                values = values.astype(dtype)
+            nSamples += nRows
+            if progress:
+                print("\tparsed %d samples" % nSamples)
+            yield values.reshape(nRows, nSwitches)
+
+def loadSwitchTrace(filename, dtype = np.int64, chunkBytes = CHUNK_BYTES,
+                    progress = False):
+    """
+    Parse a whole trace into one (samples x switches) array of dtype
+    (int64 or uint32 for counters).
+    """
+    chunks = list(iterSwitchTrace(filename, dtype, chunkBytes, progress))
+    if not chunks:
+        return np.empty((0, 0), dtype = dtype)
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks)
@@ -0,0 +1,272 @@
+#!/usr/bin/python3
+# Result files and cache entries as typed arrays.  tpprof.py's cluster
+# results (<NAME>.cluster: the raw samples, their labels and the model) and
+# subsequences (<NAME>.subsequence) used to be pickles, the labels a pickle
+# inside the pickle, so plotting or summarizing a large trace first rebuilt
+# it object by object.  Now each is an uncompressed .npz: one member per
+# array, plus 'manifest', a JSON document with the kind of result, its
+# version and its scalar values.  Reading one memory-maps its arrays, so
+# only the pages that are used are ever read.  Result files written as
+# pickles by older versions are converted in place the first time they are
+# read.
+#
+# The cache stores the same format (CLUSTER_ENTRIES, SUBSEQUENCE_ENTRIES), so
+# a cached result is mapped, not rebuilt, too.
+
+import json
+import numpy as np
+import os
+import pickle
+import struct
+import tempfile
+import zipfile
+
+import lib.cache
+import lib.model
+
+
+RESULT_VERSION = 1
+MANIFEST = 'manifest'
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+
+
+# ===================================
+# =           containers.           =
+# ===================================
+
+def mapNpz(filename):
+    """
+    The arrays of an uncompressed .npz, memory-mapped: np.savez stores each
+    array as a .npy member, so the array's data is a contiguous run of the
+    file right after the member's local header and .npy header.
+    """
+    arrays = {}
+    with zipfile.ZipFile(filename) as archive, open(filename, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+            shape = ()
+            if info.compress_type == zipfile.ZIP_STORED:
+                f.seek(info.header_offset)
+                header = ZIP_LOCAL_HEADER.unpack(
+                            f.read(ZIP_LOCAL_HEADER.size))
+                nameLength, extraLength = header[-2:]
+                f.seek(info.header_offset + ZIP_LOCAL_HEADER.size +
+                       nameLength + extraLength)
+                version = np.lib.format.read_magic(f)
+                shape, fortran, dtype = \
+                        (np.lib.format.read_array_header_1_0
+                         if version == (1, 0) else
+                         np.lib.format.read_array_header_2_0)(f)
+            if not shape or 0 in shape:
+                # compressed, a scalar or empty: nothing worth mapping
+                with archive.open(info) as member:
+                    arrays[name] = np.load(member, allow_pickle = False)
+                continue
+            arrays[name] = np.memmap(filename, dtype = dtype, mode = 'r',
+                                     offset = f.tell(), shape = shape,
+                                     order = 'F' if fortran else 'C')
+    return arrays
+
+def isResultFile(filename):
+    """ Whether filename is a result file (of any kind). """
+    with zipfile.ZipFile(filename) as archive:
+        return MANIFEST + '.npy' in archive.namelist()
+
+def jsonValue(value):
+    """ value with NumPy scalars as Python ones, for json. """
+    return value.item() if isinstance(value, np.generic) else value
+
+def writeResult(f, kind, arrays, values):
+    """ Write {name: array} and JSON values as a result of kind to f. """
+    manifest = json.dumps({'kind' : kind, 'version' : RESULT_VERSION,
+                           'values' : {k : jsonValue(v)
+                                       for k, v in values.items()}})
+    arrays = dict(arrays)
+    arrays[MANIFEST] = np.frombuffer(manifest.encode(), dtype = np.uint8)
+    np.savez(f, **arrays)
+
+def readResult(filename, kind):
+    """
+    (arrays, values) of a result of kind, its arrays memory-mapped.  Raises
+    ValueError if filename is not one.
+    """
+    try:
+        arrays = mapNpz(filename)
+    except zipfile.BadZipFile:
+        raise ValueError("%s is not a result file" % filename)
+    if MANIFEST not in arrays:
+        raise ValueError("%s is not a result file" % filename)
+    manifest = json.loads(bytes(arrays.pop(MANIFEST)).decode())
+    if manifest['kind'] != kind:
+        raise ValueError("%s holds %s results, not %s" %
+                         (filename, manifest['kind'], kind))
+    if manifest['version'] > RESULT_VERSION:
+        raise ValueError("%s has result version %d, newest supported is %d" %
+                         (filename, manifest['version'], RESULT_VERSION))
+    return arrays, manifest['values']
+
+def saveAtomic(filename, save):
+    """
+    save(f) into a temporary file that then replaces filename, so readers,
+    and arrays mapped from the old file, never see a partial one.
+    """
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(filename) or '.',
+                               suffix = '.tmp')
+    try:
+        os.fchmod(fd, 0o644) # mkstemp makes it private
+        with os.fdopen(fd, 'wb') as f:
+            save(f)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def migrate(filename, convert, save):
+    """
+    The result in pickle filename as convert() makes it, rewritten in place
+    with save(value, f) if the file can be written.
+    """
+    with open(filename, 'rb') as f:
+        value = convert(pickle.load(f))
+    try:
+        saveAtomic(filename, lambda f: save(value, f))
+        print("converted %s from pickle to arrays" % filename)
+    except OSError as e:
+        print("WARNING: could not convert %s from pickle: %s" % (filename, e))
+    return value
+
+# ======  End of containers.  =======
+
+
+# ===================================
+# =         cluster results.        =
+# ===================================
+
+CLUSTER_ARRAYS = ('original_pts', 'clustered_pts')
+MODEL_PREFIX = 'model.'
+
+def writeCluster(cluster_results, f):
+    """ cluster_results of tpprof.run_clustering as a result file. """
+    arrays = {name : np.asarray(cluster_results[name])
+              for name in CLUSTER_ARRAYS}
+    if cluster_results.get('model') is not None:
+        arrays.update((MODEL_PREFIX + name, value) for name, value in
+                      cluster_results['model'].arrays().items())
+    values = {k : v for k, v in cluster_results.items()
+              if k not in CLUSTER_ARRAYS + ('model',)}
+    writeResult(f, 'cluster', arrays, values)
+
+def readCluster(filename):
+    arrays, values = readResult(filename, 'cluster')
+    cluster_results = dict(values)
+    for name in CLUSTER_ARRAYS:
+        cluster_results[name] = arrays[name]
+    model = {name[len(MODEL_PREFIX):] : value for name, value in arrays.items()
+             if name.startswith(MODEL_PREFIX)}
+    if model:
+        cluster_results['model'] = lib.model.StateModel.fromArrays(model,
+                                                                   filename)
+    return cluster_results
+
+def fromPickledCluster(cluster_results):
+    """ Cluster results as older versions pickled them, as arrays. """
+    cluster_results = dict(cluster_results)
+    cluster_results['original_pts'] = \
+            np.asarray(cluster_results['original_pts'])
+    clustered_pts = cluster_results['clustered_pts']
+    if isinstance(clustered_pts, bytes):
+        clustered_pts = pickle.loads(clustered_pts)
+    cluster_results['clustered_pts'] = np.asarray(clustered_pts)
+    if isinstance(cluster_results.get('model'), dict): # fitted sklearn objects
+        cluster_results['model'] = \
+                lib.model.StateModel.fromFitted(cluster_results['model'])
+    return cluster_results
+
+def saveCluster(filename, cluster_results):
+    saveAtomic(filename, lambda f: writeCluster(cluster_results, f))
+
+def loadCluster(filename):
+    """
+    Cluster results of a .cluster file, the samples and labels memory-mapped.
+    A pickled one is converted first.
+    """
+    if not zipfile.is_zipfile(filename):
+        return migrate(filename, fromPickledCluster, writeCluster)
+    return readCluster(filename)
+
+CLUSTER_ENTRIES = lib.cache.EntryFormat('.npz', writeCluster, readCluster)
+
+# ======  End of cluster results.  =======
+
+
+# ===================================
+# =           subsequences.         =
+# ===================================
+
+# merged keys are tuples of (state, bucket) pairs: all of their pairs are
+# stored as one n x 2 array, and key i is runs[keyBounds[i]:keyBounds[i+1]]
+OCCURRENCE_PREFIX = 'occurrences.'
+
+def writeSubsequences(subsequences, f):
+    """ subsequences of tpprof.run_subsequencing as a result file. """
+    merged_freq = subsequences['merged_freq']
+    coverage_sum = subsequences['coverage_sum']
+    keys = list(merged_freq)
+    runs = np.array([run for key in keys for run in key],
+                    dtype = np.int64).reshape(-1, 2)
+    arrays = {'runs' : runs,
+              'keyBounds' : np.concatenate(([0], np.cumsum(
+                                [len(key) for key in keys], dtype = np.int64))),
+              'frequencies' : np.array([merged_freq[key] for key in keys],
+                                       dtype = np.int64),
+              'coverage' : np.array([coverage_sum[key] for key in keys],
+                                    dtype = np.int64)}
+    if subsequences.get('occurrences') is not None:
+        arrays.update((OCCURRENCE_PREFIX + name, value) for name, value in
+                      subsequences['occurrences'].arrays().items())
+    values = {k : v for k, v in subsequences.items()
+              if k not in ('merged_freq', 'coverage_sum', 'occurrences')}
+    writeResult(f, 'subsequence', arrays, values)
+
+def readSubsequences(filename):
+    from lib.occurrences import OccurrenceStore
+    arrays, values = readResult(filename, 'subsequence')
+    runs = [tuple(run) for run in arrays['runs'].tolist()]
+    bounds = arrays['keyBounds'].tolist()
+    keys = [tuple(runs[bounds[i]:bounds[i + 1]])
+            for i in range(len(bounds) - 1)]
+    subsequences = dict(values)
+    subsequences['merged_freq'] = dict(zip(keys,
+                                           arrays['frequencies'].tolist()))
+    subsequences['coverage_sum'] = dict(zip(keys,
+                                            arrays['coverage'].tolist()))
+    occurrences = {name[len(OCCURRENCE_PREFIX):] : value
+                   for name, value in arrays.items()
+                   if name.startswith(OCCURRENCE_PREFIX)}
+    if occurrences:
+        subsequences['occurrences'] = OccurrenceStore.fromArrays(occurrences,
+                                                                 filename)
+    return subsequences
+
+def fromPickledSubsequences(subsequences):
+    """ Subsequences as older versions pickled them, keys as plain ints. """
+    subsequences = dict(subsequences)
+    for name in ('merged_freq', 'coverage_sum'):
+        subsequences[name] = {tuple((int(state), int(bucket))
+                                    for state, bucket in key) : int(value)
+                              for key, value in subsequences[name].items()}
+    return subsequences
+
+def saveSubsequences(filename, subsequences):
+    saveAtomic(filename, lambda f: writeSubsequences(subsequences, f))
+
+def loadSubsequences(filename):
+    """ Subsequences of a .subsequence file; a pickled one is converted. """
+    if not zipfile.is_zipfile(filename):
+        return migrate(filename, fromPickledSubsequences, writeSubsequences)
+    return readSubsequences(filename)
+
+SUBSEQUENCE_ENTRIES = lib.cache.EntryFormat('.npz', writeSubsequences,
+                                            readSubsequences)
+
+# ======  End of subsequences.  =======
@@ -0,0 +1,627 @@
+#!/usr/bin/python3
+# snapGrep without Hyperscan or a C++ build.  Same inputs and output as
+# snapGrep/snapGrep.cpp: every snapshot is labelled with the symbol of its
+# nearest signature state (mean L1 distance), the symbols are matched against
+# the signature's regular expressions as one stream, and every match is
+# printed with the mean similarity, 1/(1-distance), of its snapshots.
+#
+# As in snapGrep.cpp, a break character that no state uses is fed to the
+# stream before the first symbol and after every match, so matches never
+# overlap, and a match is reported for every pattern at the first position
+# where it ends, starting at its leftmost start.
+#
+# Snapshots are labelled in batches with NumPy.  Patterns are compiled to one
+# DFA over the state symbols, which is stepped once per symbol; leftmost
+# starts come from running a DFA of the reversed pattern back from the end of
+# a match.  Similarities are kept in a ring buffer of the last SCORE_BUFFER
+# snapshots.
+
+import argparse
+import copy
+import csv
+import numpy as np
+import sys
+import warnings
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+
+BREAK_CHAR = '-'
+SCORE_BUFFER = 1000000 # snapshots whose similarity is kept, as snapGrep.cpp
+FEED_CHUNK = 2**16 # snapshots labelled per batch
+VALUE_SCALE = 1e9 # state and snapshot values are divided by this
+KDTREE_MIN_STATES = 64 # "auto" labels with a KD-tree from this many states
+READ_BYTES = 2**20
+FLAGS = 'imsHV8W' # snapGrep.cpp's pattern flags
+
+
+# ===================================
+# =        signature files.         =
+# ===================================
+
+def loadStates(filename, numSwitches):
+    """
+    Signature states, one per line: symbol, switch count, values.  Like
+    snapGrep.cpp, the vector of a state is the numSwitches fields after the
+    symbol, parsed as float and divided by VALUE_SCALE.  Returns (symbols,
+    states x numSwitches array).
+    """
+    symbols, vectors = [], []
+    with open(filename, 'r') as f:
+        for row in csv.reader(f):
+            if not row:
+                continue
+            symbols.append(row[0][0])
+            vectors.append([float(v) for v in row[1:1 + numSwitches]])
+    states = np.array(vectors, dtype = np.float32).astype(np.float64)
+    return symbols, states / VALUE_SCALE
+
+def loadPatterns(filename):
+    """
+    Patterns, one per line as ID:/regex/flags; empty lines and lines
+    starting with # are skipped.  Returns [(id, regex, flags)].
+    """
+    patterns = []
+    with open(filename, 'r') as f:
+        for lineNo, line in enumerate(f, 1):
+            line = line.rstrip('\r\n')
+            if not line or line.startswith('#'):
+                continue
+            pid, colon, expr = line.partition(':')
+            end = expr.rfind('/')
+            if not colon or not expr.startswith('/') or end < 1:
+                raise ValueError("%s:%d: expected ID:/regex/flags" %
+                                 (filename, lineNo))
+            flags = expr[end + 1:]
+            for flag in flags:
+                if flag not in FLAGS:
+                    raise ValueError("%s:%d: unsupported flag '%s'" %
+                                     (filename, lineNo, flag))
+            patterns.append((int(pid), expr[1:end], flags))
+    return patterns
+
+# ======  End of signature files.  =======
+
+# ===================================
+# =        pattern compiler.        =
+# ===================================
+
+# A regex is parsed into a tree of ('set', chars), ('cat', [nodes]),
+# ('alt', [nodes]) and ('rep', node, min, max or None), then built into a
+# Thompson NFA whose edges are labelled with sets of alphabet indices.
+
+class _RegexParser(object):
+    """ Recursive descent parser for the regex subset snapGrep needs. """
+    def __init__(self, regex, alphabet, caseless):
+        self.regex = regex
+        self.pos = 0
+        self.alphabet = alphabet
+        self.caseless = caseless
+
+    def parse(self):
+        node = self.alternation()
+        if self.pos != len(self.regex):
+            self.fail("unexpected '%s'" % self.regex[self.pos])
+        return node
+
+    def fail(self, message):
+        raise ValueError("pattern /%s/, position %d: %s" %
+                         (self.regex, self.pos, message))
+
+    def peek(self):
+        return self.regex[self.pos] if self.pos < len(self.regex) else None
+
+    def take(self):
+        char = self.peek()
+        if char is None:
+            self.fail("unexpected end")
+        self.pos += 1
+        return char
+
+    def alternation(self):
+        branches = [self.concatenation()]
+        while self.peek() == '|':
+            self.pos += 1
+            branches.append(self.concatenation())
+        return branches[0] if len(branches) == 1 else ('alt', branches)
+
+    def concatenation(self):
+        items = []
+        while self.peek() not in (None, '|', ')'):
+            items.append(self.repetition())
+        return ('cat', items)
+
+    def repetition(self):
+        node = self.atom()
+        while True:
+            char = self.peek()
+            if char == '*':
+                bounds = (0, None)
+            elif char == '+':
+                bounds = (1, None)
+            elif char == '?':
+                bounds = (0, 1)
+            elif char == '{' and self.isBound():
+                bounds = self.bound()
+            else:
+                return node
+            if char != '{':
+                self.pos += 1
+            if self.peek() in ('?', '+'): # lazy / possessive: same matches
+                self.pos += 1
+            node = ('rep', node) + bounds
+
+    def isBound(self):
+        end = self.regex.find('}', self.pos)
+        body = self.regex[self.pos + 1:end]
+        return end > 0 and body != '' and \
+               all(part.isdigit() or part == '' for part in body.split(',')) \
+               and body.count(',') <= 1 and body[0].isdigit()
+
+    def bound(self):
+        end = self.regex.index('}', self.pos)
+        lo, comma, hi = self.regex[self.pos + 1:end].partition(',')
+        self.pos = end + 1
+        lo = int(lo)
+        hi = lo if not comma else (int(hi) if hi else None)
+        if hi is not None and hi < lo:
+            self.fail("bad repeat bounds")
+        return (lo, hi)
+
+    def atom(self):
+        char = self.take()
+        if char == '(':
+            if self.regex.startswith('?:', self.pos):
+                self.pos += 2
+            node = self.alternation()
+            if self.take() != ')':
+                self.fail("missing )")
+            return node
+        if char == '[':
+            return ('set', self.charClass())
+        if char == '.':
+            return ('set', self.chars(None, negate = True))
+        if char == '\\':
+            return ('set', self.chars([self.take()]))
+        if char in '^$':
+            self.fail("anchors are not supported")
+        if char in '*+?|)':
+            self.fail("nothing to repeat")
+        return ('set', self.chars([char]))
+
+    def charClass(self):
+        negate = self.peek() == '^'
+        if negate:
+            self.pos += 1
+        members = []
+        first = True
+        while first or self.peek() != ']':
+            first = False
+            char = self.take()
+            if char == '\\':
+                char = self.take()
+            if self.peek() == '-' and \
+               self.regex[self.pos + 1:self.pos + 2] not in ('', ']'):
+                self.pos += 1
+                last = self.take()
+                if last == '\\':
+                    last = self.take()
+                members.extend(chr(c) for c in range(ord(char),
+                                                     ord(last) + 1))
+            else:
+                members.append(char)
+        self.pos += 1
+        return self.chars(members, negate)
+
+    def chars(self, members, negate = False):
+        """ Alphabet indices matched by members (None: every char). """
+        if members is None:
+            members = set()
+        else:
+            members = set(members)
+            if self.caseless:
+                members |= {c.lower() for c in members} | \
+                           {c.upper() for c in members}
+        return frozenset(i for i, c in enumerate(self.alphabet)
+                         if (c in members) != negate)
+
+class _Nfa(object):
+    """ Thompson NFA: per state, epsilon targets and (chars, target). """
+    def __init__(self):
+        self.eps = []
+        self.edges = []
+
+    def newState(self):
+        self.eps.append([])
+        self.edges.append([])
+        return len(self.eps) - 1
+
+    def build(self, node, start):
+        """ Add node's automaton after start, returns its end state. """
+        kind = node[0]
+        if kind == 'set':
+            end = self.newState()
+            self.edges[start].append((node[1], end))
+            return end
+        if kind == 'cat':
+            for child in node[1]:
+                start = self.build(child, start)
+            return start
+        if kind == 'alt':
+            end = self.newState()
+            for child in node[1]:
+                branch = self.newState()
+                self.eps[start].append(branch)
+                self.eps[self.build(child, branch)].append(end)
+            return end
+        child, lo, hi = node[1:]
+        for i in range(lo):
+            start = self.build(child, start)
+        if hi is None:
+            loop = self.newState()
+            self.eps[start].append(loop)
+            self.eps[self.build(child, loop)].append(loop)
+            return loop
+        end = self.newState()
+        for i in range(hi - lo):
+            self.eps[start].append(end)
+            start = self.build(child, start)
+        self.eps[start].append(end)
+        return end
+
+    def closure(self, states):
+        stack = list(states)
+        seen = set(states)
+        while stack:
+            for target in self.eps[stack.pop()]:
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return frozenset(seen)
+
+    def reversed(self):
+        """ The NFA with every edge reversed. """
+        rev = _Nfa()
+        for state in range(len(self.eps)):
+            rev.newState()
+        for state in range(len(self.eps)):
+            for target in self.eps[state]:
+                rev.eps[target].append(state)
+            for chars, target in self.edges[state]:
+                rev.edges[target].append((chars, state))
+        return rev
+
+    def determinize(self, starts, accepts, nSymbols):
+        """
+        Subset construction.  accepts maps NFA states to tags.  Returns
+        (delta, tags): delta[state][symbol] is the next DFA state, and
+        tags[state] the tuple of tags accepted in it.  DFA state 0 is the
+        start; the empty set, if reachable, is a dead state with no tags.
+        """
+        start = self.closure(starts)
+        index = {start : 0}
+        queue = [start]
+        delta, tags = [], []
+        while len(delta) < len(queue):
+            current = queue[len(delta)]
+            row = []
+            for symbol in range(nSymbols):
+                moved = self.closure([target for state in current
+                                      for chars, target in self.edges[state]
+                                      if symbol in chars])
+                if moved not in index:
+                    index[moved] = len(queue)
+                    queue.append(moved)
+                row.append(index[moved])
+            delta.append(row)
+            tags.append(tuple(sorted({accepts[s] for s in current
+                                      if s in accepts})))
+        return delta, tags
+
+class PatternSet(object):
+    """
+    Regexes over an alphabet of single characters, compiled to a DFA that
+    finds, scanning one symbol at a time, where any of them ends; and one
+    reverse DFA per pattern to find the leftmost start of a match.
+    """
+    def __init__(self, patterns, alphabet):
+        self.alphabet = alphabet
+        self.ids = [pid for pid, regex, flags in patterns]
+        self.singleMatch = ['H' in flags for pid, regex, flags in patterns]
+        nSymbols = len(alphabet)
+
+        nfa = _Nfa()
+        scanStart = nfa.newState()
+        # unanchored: the scan may start a match at any symbol
+        nfa.edges[scanStart].append((frozenset(range(nSymbols)), scanStart))
+        bounds = []
+        for p, (pid, regex, flags) in enumerate(patterns):
+            tree = _RegexParser(regex, alphabet, 'i' in flags).parse()
+            start = nfa.newState()
+            end = nfa.build(tree, start)
+            if end in nfa.closure([start]):
+                raise ValueError("pattern /%s/ matches the empty string" %
+                                 regex)
+            nfa.eps[scanStart].append(start)
+            bounds.append((start, end))
+        self.delta, self.accepts = nfa.determinize(
+                [scanStart], {end : p for p, (start, end) in
+                              enumerate(bounds)}, nSymbols)
+
+        rev = nfa.reversed()
+        self.reverse = []
+        for p, (start, end) in enumerate(bounds):
+            delta, tags = rev.determinize([end], {start : p}, nSymbols)
+            dead = [all(target == state for target in row) and not tags[state]
+                    for state, row in enumerate(delta)]
+            self.reverse.append((delta, [bool(t) for t in tags], dead))
+
+    def leftmostStart(self, p, history, end, oldest):
+        """
+        Leftmost start of a match of pattern p ending at stream offset end
+        (exclusive).  history[offset % len(history)] holds the symbols of
+        offsets from oldest on.
+        """
+        delta, accepting, dead = self.reverse[p]
+        size = len(history)
+        state = 0
+        start = end
+        for offset in range(end - 1, oldest - 1, -1):
+            state = delta[state][history[offset % size]]
+            if dead[state]:
+                break
+            if accepting[state]:
+                start = offset
+        return start
+
+# ======  End of pattern compiler.  =======
+
+class StateClassifier(object):
+    """
+    Nearest signature state by mean L1 distance, for a batch of snapshots
+    at once.  method is "brute", "kdtree" (needs scipy) or "auto".
+    """
+    def __init__(self, states, method = "auto"):
+        self.states = np.asarray(states, dtype = np.float64)
+        if method == "auto":
+            method = "kdtree" if cKDTree is not None and \
+                     len(self.states) >= KDTREE_MIN_STATES else "brute"
+        if method == "kdtree":
+            if cKDTree is None:
+                raise ImportError("the kdtree method needs scipy")
+            self.tree = cKDTree(self.states)
+        elif method != "brute":
+            raise ValueError("unknown method: %s" % method)
+        self.method = method
+
+    def nearest(self, X):
+        """ (index of the nearest state, its distance) per row of X. """
+        nStates, nSwitches = self.states.shape
+        if self.method == "kdtree":
+            dist, idx = self.tree.query(X, p = 1)
+            return idx, dist / nSwitches
+        # summed switch by switch, in snapGrep.cpp's order
+        dist = np.zeros((len(X), nStates))
+        for j in range(nSwitches):
+            dist += np.abs(X[:, j, None] - self.states[None, :, j])
+        dist /= nSwitches
+        idx = np.argmin(dist, 1) # first of equals, as snapGrep.cpp
+        return idx, dist[np.arange(len(X)), idx]
+
+class StreamMatcher(object):
+    """
+    snapGrep over a stream of snapshots: feed() batches of them, get back
+    the matches ended in each, as (pattern id, start, end, score) with start
+    and end counted in snapshots (end exclusive).
+    """
+    def __init__(self, symbols, states, patterns, method = "auto",
+                 bufferSize = SCORE_BUFFER):
+        if BREAK_CHAR in symbols:
+            raise ValueError("state symbol %s is the break character" %
+                             BREAK_CHAR)
+        alphabet = sorted(set(symbols)) + [BREAK_CHAR]
+        self.patterns = PatternSet(patterns, alphabet)
+        self.classifier = StateClassifier(states, method)
+        self.stateSymbols = np.array([alphabet.index(s) for s in symbols])
+        self.breakSymbol = len(alphabet) - 1
+        self.bufferSize = bufferSize
+        self.chunk = min(FEED_CHUNK, bufferSize)
+        self.reset()
+
+    def reset(self):
+        """ Start the stream over: no snapshots, no matches. """
+        self.scores = np.zeros(self.bufferSize)
+        self.history = bytearray(self.bufferSize) # stream symbols, by offset
+        self.nSamples = 0
+        self.offset = 0 # stream offset, snapshots plus breaks
+        self.nBreaks = 0
+        self.dfaState = 0
+        self.doBreak = True
+        self.fired = set() # single match patterns that matched
+
+    def fork(self):
+        """
+        A matcher for another stream: it shares this one's compiled patterns
+        and classifier, and has a stream state and score buffer of its own.
+        """
+        matcher = copy.copy(self)
+        matcher.reset()
+        return matcher
+
+    def feed(self, snapshots):
+        snapshots = np.asarray(snapshots, dtype = np.float64)
+        matches = []
+        for start in range(0, len(snapshots), self.chunk):
+            matches.extend(self.feedLabels(*self.classifier.nearest(
+                                snapshots[start:start + self.chunk])))
+        return matches
+
+    def feedLabels(self, idx, dist):
+        """
+        feed() of snapshots classified already, e.g. in one batch with other
+        streams': the index of each one's nearest state, and its distance.
+        """
+        matches = []
+        for start in range(0, len(idx), self.chunk):
+            matches.extend(self.feedChunk(idx[start:start + self.chunk],
+                                          dist[start:start + self.chunk]))
+        return matches
+
+    def feedChunk(self, idx, dist):
+        slots = np.arange(self.nSamples, self.nSamples + len(idx)) % \
+                len(self.scores)
+        self.scores[slots] = 1.0 / (1.0 - dist)
+        self.nSamples += len(idx)
+
+        matches = []
+        delta, accepts = self.patterns.delta, self.patterns.accepts
+        history, size = self.history, len(self.history)
+        brk = self.breakSymbol
+        state, offset, doBreak = self.dfaState, self.offset, self.doBreak
+        for symbol in self.stateSymbols[idx].tolist():
+            if doBreak:
+                state = delta[state][brk]
+                history[offset % size] = brk
+                offset += 1
+                # as snapGrep.cpp: a match ending at the break is counted
+                # before the break, and does not ask for another one
+                if accepts[state]:
+                    self.report(accepts[state], offset, matches)
+                self.nBreaks += 1
+                doBreak = False
+            state = delta[state][symbol]
+            history[offset % size] = symbol
+            offset += 1
+            if accepts[state]:
+                doBreak = self.report(accepts[state], offset, matches)
+        self.dfaState, self.offset, self.doBreak = state, offset, doBreak
+        return self.score(matches)
+
+    def report(self, patterns, end, matches):
+        """ Append the matches of patterns ending at end; True if any. """
+        oldest = max(0, end - len(self.history))
+        found = False
+        for p in patterns:
+            if self.patterns.singleMatch[p]:
+                if p in self.fired:
+                    continue
+                self.fired.add(p)
+            found = True
+            start = self.patterns.leftmostStart(p, self.history, end, oldest)
+            # offsets to snapshots, as snapGrep.cpp: minus breaks so far
+            matches.append((self.patterns.ids[p], start - self.nBreaks,
+                            end - self.nBreaks))
+        return found
+
+    def score(self, matches):
+        """ Add the mean similarity of its snapshots to every match. """
+        if not matches:
+            return []
+        ids, first, last = (np.array(column) for column in zip(*matches))
+        lengths = last - first
+        bounds = np.cumsum(lengths) - lengths
+        # every match's snapshots, one match after the other
+        slots = np.arange(lengths.sum()) + np.repeat(first - bounds, lengths)
+        sums = np.add.reduceat(self.scores[slots % len(self.scores)], bounds)
+        return list(zip(ids.tolist(), first.tolist(), last.tolist(),
+                        (sums / lengths).tolist()))
+
+class SnapshotParser(object):
+    """
+    Snapshots of snapGrep's CSV input (id, switch count, values...) from its
+    bytes as they are read: push() every read, then finish().  As
+    snapGrep.cpp, a snapshot is the numSwitches fields after the id, parsed
+    as float and divided by VALUE_SCALE.
+    """
+    def __init__(self, numSwitches):
+        self.numSwitches = numSwitches
+        self.tail = b''
+        self.nFields = None
+
+    def push(self, data):
+        """ Snapshots of the lines data completes, None if none. """
+        data = self.tail + data
+        cut = data.rfind(b'\n') + 1
+        text, self.tail = data[:cut], data[cut:]
+        return self.parse(text)
+
+    def finish(self):
+        """ Snapshot of an unterminated last line, None if none. """
+        text, self.tail = self.tail, b''
+        return self.parse(text)
+
+    def parse(self, text):
+        lines = text.split()
+        if not lines:
+            return None
+        if self.nFields is None:
+            self.nFields = lines[0].count(b',') + 1
+            if self.nFields < self.numSwitches + 1:
+                raise ValueError("expected at least %d fields per line" %
+                                 (self.numSwitches + 1))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            values = np.fromstring(b','.join(lines), sep = ',')
+        if values.size != len(lines) * self.nFields:
+            raise ValueError("expected %d fields on every line" % self.nFields)
+        values = values.reshape(len(lines),
+                                self.nFields)[:, 1:1 + self.numSwitches]
+        return values.astype(np.float32).astype(np.float64) / VALUE_SCALE
+
+def iterSnapshots(stream, numSwitches):
+    """ Snapshots of snapGrep's CSV input from a binary file, per read. """
+    parser = SnapshotParser(numSwitches)
+    while True:
+        data = stream.read(READ_BYTES)
+        snapshots = parser.push(data) if data else parser.finish()
+        if snapshots is not None:
+            yield snapshots
+        if not data:
+            return
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('numSwitches', type=int,
+                        help='number of switches in each sample.')
+    parser.add_argument('states', type=str, help='signature states file.')
+    parser.add_argument('pattern', type=str, help='signature pattern file.')
+    parser.add_argument('input', type=str, nargs='?',
+                        help='snapshots, as written by ' \
+                             'snapGrep/updateData.py. Default is stdin.')
+    parser.add_argument('--method', type=str, default='auto',
+                        choices=['auto', 'brute', 'kdtree'],
+                        help='nearest state search.')
+    return parser.parse_args()
+
+def main():
+    args = argParser()
+
+    print ("expecting files with %d switches in each samples" %
+           args.numSwitches)
+    symbols, states = loadStates(args.states, args.numSwitches)
+    print ("loaded %d target states" % len(symbols))
+    for symbol, state in zip(symbols, states):
+        print ("\tState symbol: %s utilization vector: { %s }" %
+               (symbol, ' '.join('%g' % v for v in state)))
+    print ("Pattern file: %s" % args.pattern)
+    matcher = StreamMatcher(symbols, states, loadPatterns(args.pattern),
+                            args.method)
+
+    print ("opening stream")
+    stream = open(args.input, 'rb') if args.input else sys.stdin.buffer
+    with stream:
+        for snapshots in iterSnapshots(stream, args.numSwitches):
+            matches = matcher.feed(snapshots)
+            if matches:
+                sys.stdout.write(''.join(
+                    "MATCH in range: %d - %d score: %g\n" % (start, end, score)
+                    for pid, start, end, score in matches))
+    print ("closing stream")
+
+
+if __name__ == '__main__':
+    main()
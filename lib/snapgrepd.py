@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+# snapGrep (lib.snapgrep) over many snapshot streams at once, e.g. one per
+# rack.  Every stream gets a matcher of its own (StreamMatcher.fork: its own
+# DFA state, symbol history and score buffer), all sharing one compiled
+# signature.  Streams are read concurrently with asyncio: files and named
+# pipes named on the command line, and connections to a unix socket, whose
+# first line may name the stream ("#<name>").  The snapshots that have
+# arrived from all streams are labelled together in one batch, and every
+# match goes to one output, tagged with its stream:
+#     <stream>: MATCH in range: <start> - <end> score: <score>
+# start and end counted in the snapshots of that stream, as snapGrep's.
+#
+# A regular file is read in a worker thread, as files cannot be polled;
+# pipes and sockets are polled by the event loop, so waiting streams cost
+# nothing.  A named pipe is read from its first writer until its last one
+# closes it.
+
+import argparse
+import asyncio
+import numpy as np
+import os
+import stat
+import sys
+
+from lib.snapgrep import READ_BYTES, SnapshotParser, StreamMatcher, \
+                         loadPatterns, loadStates
+
+
+BATCH_SNAPSHOTS = 2**16 # labelled at once, across streams
+QUEUE_READS = 256 # reads waiting to be labelled before readers wait
+
+
+class Stream(object):
+    """ One input: its name, matcher and parser, and what it has seen. """
+    def __init__(self, name, matcher, numSwitches):
+        self.name = name
+        self.matcher = matcher
+        self.parser = SnapshotParser(numSwitches)
+        self.nSnapshots = 0
+        self.nMatches = 0
+
+class MatchService(object):
+    """
+    Streams matched against one signature.  Readers queue the snapshots of
+    every read; label() takes whatever is queued, labels it in one batch and
+    feeds each stream's share to its matcher.
+    """
+    def __init__(self, matcher, numSwitches, out = sys.stdout,
+                 batch = BATCH_SNAPSHOTS):
+        self.matcher = matcher # forked for every stream, never fed
+        self.numSwitches = numSwitches
+        self.out = out
+        self.batch = batch
+        self.names = set()
+        self.queue = None # made in serve(), inside the event loop
+
+    def open(self, name):
+        """ A new stream, its name made unique. """
+        unique, n = name, 1
+        while unique in self.names:
+            n += 1
+            unique = '%s#%d' % (name, n)
+        self.names.add(unique)
+        print ("opening stream %s" % unique)
+        return Stream(unique, self.matcher.fork(), self.numSwitches)
+
+    async def read(self, stream, readChunk, data = b''):
+        """
+        Queue the snapshots of stream, read with readChunk() (a coroutine
+        returning bytes, b'' at the end) after data, then its end (None).
+        """
+        try:
+            while True:
+                data = data or await readChunk()
+                snapshots = stream.parser.push(data) if data \
+                            else stream.parser.finish()
+                if snapshots is not None:
+                    await self.queue.put((stream, snapshots))
+                if not data:
+                    break
+                data = b''
+        except (ValueError, OSError) as e:
+            print ("stream %s: %s" % (stream.name, e))
+        finally:
+            await self.queue.put((stream, None))
+
+    async def label(self):
+        """ Label and match queued snapshots, a batch at a time, forever. """
+        while True:
+            batch = [await self.queue.get()]
+            size = 0 if batch[0][1] is None else len(batch[0][1])
+            while size < self.batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                size += 0 if batch[-1][1] is None else len(batch[-1][1])
+            self.match(batch)
+            for item in batch:
+                self.queue.task_done()
+
+    def match(self, batch):
+        """ Match a batch of (stream, snapshots or None at its end). """
+        arrays = [snapshots for stream, snapshots in batch
+                  if snapshots is not None]
+        if arrays:
+            idx, dist = self.matcher.classifier.nearest(
+                            np.concatenate(arrays))
+        lines = []
+        offset = 0
+        for stream, snapshots in batch:
+            if snapshots is None:
+                self.close(stream)
+                continue
+            n = len(snapshots)
+            matches = stream.matcher.feedLabels(idx[offset:offset + n],
+                                                dist[offset:offset + n])
+            offset += n
+            stream.nSnapshots += n
+            stream.nMatches += len(matches)
+            lines.extend("%s: MATCH in range: %d - %d score: %g\n" %
+                         (stream.name, start, end, score)
+                         for pid, start, end, score in matches)
+        if lines:
+            self.out.write(''.join(lines))
+            self.out.flush()
+
+    def close(self, stream):
+        self.names.discard(stream.name)
+        print ("closing stream %s: %d snapshots, %d matches" %
+               (stream.name, stream.nSnapshots, stream.nMatches))
+
+    # ===================================
+    # =             inputs.             =
+    # ===================================
+
+    async def readPath(self, name, path):
+        """
+        Match a file or named pipe.  One that cannot be opened is reported
+        and closed like any failed stream, the others carry on.
+        """
+        stream = self.open(name)
+        try:
+            fifo = stat.S_ISFIFO(os.stat(path).st_mode)
+            # a non-blocking open returns at once; the loop polls the pipe,
+            # which is not readable until its first writer writes
+            f = os.fdopen(os.open(path, os.O_RDONLY | os.O_NONBLOCK), 'rb',
+                          0) if fifo else open(path, 'rb')
+        except OSError as e:
+            print ("stream %s: %s" % (stream.name, e))
+            await self.queue.put((stream, None))
+            return
+        if not fifo:
+            with f:
+                await self.read(stream, lambda: asyncio.to_thread(f.read,
+                                                                  READ_BYTES))
+            return
+        reader = asyncio.StreamReader(limit = READ_BYTES)
+        transport, protocol = await asyncio.get_running_loop() \
+                .connect_read_pipe(lambda: asyncio.StreamReaderProtocol(
+                                                reader), f)
+        try:
+            await self.read(stream, lambda: reader.read(READ_BYTES))
+        finally:
+            transport.close()
+
+    async def readConnection(self, reader, writer):
+        """ Match a socket connection; a first line "#<name>" names it. """
+        first = await reader.readline()
+        name = 'socket'
+        if first.startswith(b'#'):
+            name = first[1:].strip().decode(errors = 'replace') or name
+            first = b''
+        stream = self.open(name)
+        try:
+            await self.read(stream, lambda: reader.read(READ_BYTES), first)
+        finally:
+            writer.close()
+
+    # ======  End of inputs.  =======
+
+    async def serve(self, paths, socketPath = None):
+        """
+        Match every (name, path) of paths, and, with socketPath, every
+        connection to that unix socket.  Returns once the paths have ended
+        if there is no socket; serves until cancelled if there is.
+        """
+        self.queue = asyncio.Queue(QUEUE_READS)
+        labeller = asyncio.create_task(self.label())
+        readers = [asyncio.create_task(self.readPath(name, path))
+                   for name, path in paths]
+        try:
+            if socketPath:
+                if os.path.exists(socketPath):
+                    os.remove(socketPath)
+                server = await asyncio.start_unix_server(
+                                self.readConnection, socketPath,
+                                limit = READ_BYTES)
+                try:
+                    async with server:
+                        await server.serve_forever()
+                finally:
+                    os.remove(socketPath)
+            await asyncio.gather(*readers)
+            await self.queue.join()
+        finally:
+            labeller.cancel()
+
+def streamPaths(inputs):
+    """ (name, path) of inputs given as path or name=path. """
+    paths = []
+    for spec in inputs:
+        name, equals, path = spec.partition('=')
+        if not equals:
+            path = spec
+            name = os.path.basename(spec).partition('.')[0] or spec
+        paths.append((name, path))
+    return paths
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('numSwitches', type=int,
+                        help='number of switches in each sample.')
+    parser.add_argument('states', type=str, help='signature states file.')
+    parser.add_argument('pattern', type=str, help='signature pattern file.')
+    parser.add_argument('inputs', type=str, nargs='*',
+                        help='snapshot streams, files or named pipes, as ' \
+                             'path or name=path; the name tags their ' \
+                             'matches and defaults to the file name.')
+    parser.add_argument('--socket', type=str,
+                        help='also match every connection to this unix ' \
+                             'socket, until interrupted.')
+    parser.add_argument('--out', type=str,
+                        help='write the matches here instead of stdout.')
+    parser.add_argument('--batch', type=int, default=BATCH_SNAPSHOTS,
+                        help='snapshots labelled at once, across streams.')
+    parser.add_argument('--method', type=str, default='auto',
+                        choices=['auto', 'brute', 'kdtree'],
+                        help='nearest state search.')
+    return parser.parse_args()
+
+def main():
+    args = argParser()
+    if not args.inputs and not args.socket:
+        sys.exit("nothing to match: give input streams or --socket")
+
+    symbols, states = loadStates(args.states, args.numSwitches)
+    matcher = StreamMatcher(symbols, states, loadPatterns(args.pattern),
+                            args.method)
+    print ("MATCHING PARAMETERS: ")
+    print ("--------------------")
+    print ("\tsignature: %s, %s (%d states)" % (args.states, args.pattern,
+                                                 len(symbols)))
+    print ("\tstreams: %d%s" % (len(args.inputs),
+                                " and connections to " + args.socket
+                                if args.socket else ""))
+    print ("\tmatches: %s" % (args.out if args.out else "stdout"))
+    print ("--------------------")
+
+    out = open(args.out, 'a') if args.out else sys.stdout
+    service = MatchService(matcher, args.numSwitches, out, args.batch)
+    try:
+        asyncio.run(service.serve(streamPaths(args.inputs), args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.out:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
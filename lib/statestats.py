@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+# Per-state statistics of a clustered trace: how often each state occurs,
+# its mean sample, how stable it is (the chance that the next sample stays in
+# it) and the full state transition matrix.  Everything is computed in a few
+# vectorized passes over the labels, whatever the number of states.
+
+import argparse
+import numpy as np
+
+import lib.results
+
+
+def transitionCounts(Y, nStates, previous = None):
+    """
+    nStates x nStates counts of the transitions (Y[i], Y[i+1]) of labels Y.
+    With previous, the label before Y[0], its transition into Y is counted
+    too, for labels that arrive in batches.
+    """
+    Y = np.asarray(Y, dtype = np.int64)
+    if previous is not None and len(Y):
+        Y = np.concatenate(([previous], Y))
+    return np.bincount(Y[:-1] * nStates + Y[1:],
+                       minlength = nStates * nStates).reshape(nStates,
+                                                              nStates)
+
+def selfLoopStability(transitions):
+    """
+    Per state, the fraction of its transitions that stay in it.  NaN for a
+    state that is never left (absent, or only the last label).
+    """
+    transitions = np.asarray(transitions)
+    leaving = transitions.sum(1)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return np.where(leaving > 0, np.diag(transitions) / leaving, np.nan)
+
+def stateMeans(X, Y, nStates, counts = None):
+    """ nStates x features mean of the rows of X in each state; NaN if none. """
+    X = np.asarray(X)
+    Y = np.asarray(Y, dtype = np.int64)
+    if counts is None:
+        counts = np.bincount(Y, minlength = nStates)
+    sums = np.empty((nStates, X.shape[1]))
+    for j in range(X.shape[1]): # one pass per feature, no copy of X
+        sums[:, j] = np.bincount(Y, weights = X[:, j], minlength = nStates)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        return sums / counts[:, np.newaxis]
+
+class StateStats(object):
+    """
+    Statistics of labels Y, one per sample of X (optional, for the state
+    means).  States are 0..nStates-1; nStates defaults to max(Y) + 1.
+    """
+    def __init__(self, Y, X = None, nStates = None):
+        Y = np.asarray(Y, dtype = np.int64)
+        if nStates is None:
+            nStates = int(Y.max()) + 1 if len(Y) else 0
+        self.nStates = nStates
+        self.nSamples = len(Y)
+        self.counts = np.bincount(Y, minlength = nStates)
+        self.transitions = transitionCounts(Y, nStates)
+        self.means = None if X is None else stateMeans(X, Y, nStates,
+                                                       self.counts)
+        # index of the first sample of every state, nSamples if absent
+        self.firstSeen = np.full(nStates, len(Y), dtype = np.int64)
+        labels, first = np.unique(Y, return_index = True)
+        self.firstSeen[labels] = first
+
+    @property
+    def frequencies(self):
+        return self.counts / max(self.nSamples, 1)
+
+    @property
+    def stability(self):
+        return selfLoopStability(self.transitions)
+
+    def ordered(self):
+        """
+        The states that occur, most frequent first; of equally frequent
+        states, the one seen last first.
+        """
+        present = np.flatnonzero(self.counts)
+        order = np.lexsort((self.firstSeen[present], self.counts[present]))
+        return present[order[::-1]].tolist()
+
+    def summary(self):
+        """ The statistics as JSON types. """
+        states = {}
+        for k in range(self.nStates):
+            stability = self.stability[k]
+            states[str(k)] = {
+                'count' : int(self.counts[k]),
+                'frequency' : float(self.frequencies[k]),
+                'stability' : None if np.isnan(stability)
+                              else float(stability)}
+            if self.means is not None:
+                states[str(k)]['mean'] = self.means[k].tolist()
+        return {'samples' : self.nSamples,
+                'states' : states,
+                'transitions' : self.transitions.tolist()}
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('infile', type=str,
+                        help='cluster results (<NAME>.cluster) of a ' \
+                             'tpprof.py run.')
+    return parser.parse_args()
+
+def main():
+    args = argParser()
+
+    cluster_results = lib.results.loadCluster(args.infile)
+    stats = StateStats(cluster_results['clustered_pts'],
+                       cluster_results['original_pts'])
+    print ("%d samples, %d states" % (stats.nSamples, len(stats.ordered())))
+    for k in stats.ordered():
+        print ("\tstate %d: %.1f%% of time, %.1f%% stable, mean { %s }" %
+               (k, 100 * stats.frequencies[k], 100 * stats.stability[k],
+                ' '.join('%g' % v for v in stats.means[k])))
+    print ("transitions (from row to column):")
+    print (stats.transitions)
+
+
+if __name__ == '__main__':
+    main()
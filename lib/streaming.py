@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+# Streaming profiler.  Reads snapshots (one per line, whitespace separated
+# counters, as in data/*.data) from stdin or a unix socket, labels them with a
+# model fitted earlier by tpprof.py, and keeps a running profile: state
+# frequencies, self-loop stability, the state transition matrix, and the most
+# frequent state subsequences.  The profile is rewritten as JSON every
+# interval seconds.
+#
+# Everything kept is bounded: counts are per state or per state pair, and
+# subsequences are counted approximately with a fixed number of counters
+# (space saving).  Subsequences are n-grams of the run-length encoded state
+# sequence, i.e. sequences of state changes, so one long stable phase is one
+# symbol instead of a flood of repeats.  Input is labelled as soon as it is
+# read, in whatever batch of lines has arrived, so the latency of a sample is
+# bounded by one read of READ_BYTES.
+
+import argparse
+from collections import deque
+import json
+import numpy as np
+import os
+import select
+import socket
+import sys
+import tempfile
+import time
+import warnings
+import zipfile
+
+import lib.model
+import lib.parsing
+import lib.results
+import lib.statestats
+
+
+PROFILE_INTERVAL = 10.0 # seconds between profile writes
+MAX_NGRAM = 8 # longest subsequence counted, in state changes
+NGRAM_COUNTERS = 1000 # subsequences tracked by the space saving counter
+TOP_SUBSEQUENCES = 50 # subsequences written to the profile
+READ_BYTES = 2**16
+MAX_LINE_BYTES = 2**20
+
+
+def loadModel(filename):
+    """
+    The state model (lib.model.StateModel) in a model file or a cluster
+    results file written by tpprof.py.
+    """
+    if zipfile.is_zipfile(filename) and \
+       not lib.results.isResultFile(filename): # an .npz model file
+        return lib.model.StateModel.load(filename)
+    # older, pickled cluster results are converted
+    cluster_results = lib.results.loadCluster(filename)
+    if 'model' not in cluster_results:
+        raise ValueError("%s has no fitted model, rerun tpprof.py on its "
+                         "trace" % filename)
+    return cluster_results['model']
+
+class SpaceSaving(object):
+    """
+    Approximate counts of the most frequent keys of a stream, in at most
+    capacity counters (Metwally et al.).  A key's count is overestimated by
+    at most its error.  Keys are bucketed by count (the stream summary), so
+    finding the smallest counter is O(1).
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.buckets = {} # count -> keys with that count, oldest first
+        self.minCount = 0
+
+    def _move(self, key, count):
+        """ Move key from the bucket of count to the one of count + 1. """
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if self.minCount == count:
+                self.minCount = count + 1
+        self.buckets.setdefault(count + 1, {})[key] = None
+        self.counts[key] = count + 1
+
+    def add(self, key):
+        count = self.counts.get(key)
+        if count is not None:
+            self._move(key, count)
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = 1
+            self.errors[key] = 0
+            self.buckets.setdefault(1, {})[key] = None
+            self.minCount = 1
+        else:
+            # the new key takes over the smallest counter
+            floor = self.minCount
+            victim = next(iter(self.buckets[floor]))
+            del self.counts[victim]
+            del self.errors[victim]
+            self.buckets[floor][key] = self.buckets[floor].pop(victim)
+            self.counts[key] = floor
+            self.errors[key] = floor
+            self._move(key, floor)
+
+    def top(self, n):
+        """ [(key, count, error)] for the n largest counts. """
+        keys = sorted(self.counts, key = self.counts.get, reverse = True)[:n]
+        return [(key, self.counts[key], self.errors[key]) for key in keys]
+
+class StreamProfile(object):
+    """ Running profile of a stream of state labels, in bounded memory. """
+    def __init__(self, nStates, maxNgram = MAX_NGRAM,
+                 nCounters = NGRAM_COUNTERS):
+        self.nStates = nStates
+        self.counts = np.zeros(nStates, dtype = np.int64)
+        self.transitions = np.zeros((nStates, nStates), dtype = np.int64)
+        self.last = None
+        self.runs = deque(maxlen = maxNgram) # latest run-length symbols
+        self.ngrams = SpaceSaving(nCounters)
+        self.seconds = 0.0 # spent labelling and counting
+
+    def update(self, Y):
+        """ Count a batch of consecutive labels. """
+        Y = np.asarray(Y, dtype = np.int64)
+        if len(Y) == 0:
+            return
+        self.counts += np.bincount(Y, minlength = self.nStates)
+
+        self.transitions += lib.statestats.transitionCounts(Y, self.nStates,
+                                                            self.last)
+        seq = Y if self.last is None else np.concatenate(([self.last], Y))
+
+        runStarts = np.flatnonzero(seq[1:] != seq[:-1]) + 1
+        if self.last is None:
+            runStarts = np.concatenate(([0], runStarts))
+        for state in seq[runStarts].tolist():
+            self.runs.append(state)
+            runs = tuple(self.runs)
+            for n in range(2, len(runs) + 1):
+                self.ngrams.add(runs[-n:])
+        self.last = Y[-1]
+
+    def summary(self, topN = TOP_SUBSEQUENCES):
+        nSamples = int(self.counts.sum())
+        # chance that the next sample stays in state k
+        stability = lib.statestats.selfLoopStability(self.transitions)
+        states = {}
+        for k in range(self.nStates):
+            states[str(k)] = {
+                'count' : int(self.counts[k]),
+                'frequency' : self.counts[k] / nSamples if nSamples else 0.0,
+                'stability' : None if np.isnan(stability[k])
+                              else float(stability[k])}
+        return {'samples' : nSamples,
+                'updated' : time.time(),
+                'us_per_sample' : 1e6 * self.seconds / nSamples
+                                  if nSamples else None,
+                'states' : states,
+                'transitions' : self.transitions.tolist(),
+                'subsequences' : [{'states' : list(key), 'count' : count,
+                                   'error' : error}
+                                  for key, count, error in
+                                  self.ngrams.top(topN)]}
+
+def writeProfile(filename, profile):
+    """ Replace filename with the profile's JSON summary atomically. """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir = directory, suffix = '.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(profile.summary(), f, indent = 1)
+    os.replace(tmp, filename)
+
+def iterBatches(fd, nSwitches, timeout):
+    """
+    Yield the samples of the whole lines read from fd, as soon as they
+    arrive.  Yields None whenever nothing arrives for timeout seconds.
+    """
+    tail = b''
+    while True:
+        if not select.select([fd], [], [], timeout)[0]:
+            yield None
+            continue
+        data = os.read(fd, READ_BYTES)
+        if data:
+            # only parse whole lines, carry the rest to the next read
+            data = tail + data
+            cut = data.rfind(b'\n') + 1
+            text, tail = data[:cut], data[cut:]
+            if len(tail) > MAX_LINE_BYTES:
+                raise ValueError("input line longer than %d bytes" %
+                                 MAX_LINE_BYTES)
+        else:
+            text = tail
+        if text.strip():
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                values = np.fromstring(text, sep = ' ')
+            counts = lib.parsing.lineFieldCounts(text)
+            if (counts != nSwitches).any() or values.size != counts.sum():
+                raise ValueError("expected %d values on every line" %
+                                 nSwitches)
+            yield values.reshape(-1, nSwitches)
+        if not data:
+            return
+
+def profileStream(fd, model, profile, outfile, interval = PROFILE_INTERVAL):
+    """ Profile the snapshots read from fd until it ends. """
+    nSwitches = model.nSwitches
+    nextWrite = time.time() + interval
+    for samples in iterBatches(fd, nSwitches, interval):
+        if samples is not None:
+            start = time.time()
+            profile.update(model.predict(samples))
+            profile.seconds += time.time() - start
+        if time.time() >= nextWrite:
+            writeProfile(outfile, profile)
+            nextWrite = time.time() + interval
+    writeProfile(outfile, profile)
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('model', type=str,
+                        help='model (<NAME>.model) or cluster results ' \
+                             '(<NAME>.cluster) of a tpprof.py run, whose ' \
+                             'model labels the stream.')
+    parser.add_argument('outfile', type=str, help='The profile, as JSON.')
+    parser.add_argument('--socket', type=str,
+                        help='read from connections to this unix socket ' \
+                             'instead of stdin.')
+    parser.add_argument('--interval', type=float, default=PROFILE_INTERVAL,
+                        help='seconds between profile writes.')
+    parser.add_argument('--maxngram', type=int, default=MAX_NGRAM,
+                        help='longest subsequence counted, in state ' \
+                             'changes.')
+    parser.add_argument('--counters', type=int, default=NGRAM_COUNTERS,
+                        help='subsequences tracked.')
+    return parser.parse_args()
+
+def main():
+    args = argParser()
+
+    model = loadModel(args.model)
+    profile = StreamProfile(model.nStates, args.maxngram,
+                            args.counters)
+    print ("STREAMING PARAMETERS: ")
+    print ("--------------------")
+    print ("\tmodel: %s (%d states)" % (args.model, profile.nStates))
+    print ("\tinput: %s" % (args.socket if args.socket else "stdin"))
+    print ("\tprofile: %s every %gs" % (args.outfile, args.interval))
+    print ("--------------------")
+
+    if not args.socket:
+        profileStream(sys.stdin.fileno(), model, profile, args.outfile,
+                      args.interval)
+        return
+
+    # one feed at a time; the counts carry on across connections, but no
+    # transition or subsequence spans two feeds
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    server.listen(1)
+    try:
+        while True:
+            conn, addr = server.accept()
+            with conn:
+                profile.last = None
+                profile.runs.clear()
+                profileStream(conn.fileno(), model, profile, args.outfile,
+                              args.interval)
+    except KeyboardInterrupt:
+        writeProfile(args.outfile, profile)
+    finally:
+        server.close()
+        os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
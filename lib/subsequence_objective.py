@@ -1,4 +1,5 @@
 from lib.common import *
+import lib.occurrences
 import lib.subsequencing
 
 from hyperopt import STATUS_OK
@@ -9,11 +10,14 @@ import sys
 
 cacheDict = dict() # global so that we don't redo hyperparams
 def function(params):
-    params['clustered_pts'] = pickle.loads(params['clustered_pts'])
+    clustered_pts = params.pop('clustered_pts')
+    if isinstance(clustered_pts, bytes): # pickled for mongo workers
+        clustered_pts = pickle.loads(clustered_pts)
     print("Trial: " + str(params))
 
-    clustered_pts = params['clustered_pts']
     min_frequency_thresh = int(params['min_frequency_thresh'])
+    engine = params.get('engine', SUBSEQUENCE_ENGINE)
+    rle = params.get('rle', SUBSEQUENCE_RLE)
 
     # TODO: old code remove soon
     if min_frequency_thresh < 2:
@@ -37,7 +41,8 @@ def function(params):
         subsequence_freq, subsequence_coverage, score = \
                 lib.subsequencing.score_total_coverage(clustered_pts,
                                                        max_subsequence_len,
-                                                       min_frequency_thresh)
+                                                       min_frequency_thresh,
+                                                       engine, rle)
         if not DEBUG:
             sys.stdout = save_stdout
     except np.linalg.LinAlgError:
@@ -45,7 +50,11 @@ def function(params):
 
     cacheDict[min_frequency_thresh] = -score
     subsequence_freq = pickle.dumps(subsequence_freq)
-    subsequence_coverage = pickle.dumps(subsequence_coverage)
+    subsequence_coverage = lib.occurrences.dumps(subsequence_coverage)
     return {'loss' : (-score), 'input' : params, 'status': STATUS_OK,
             'attachments': {'subsequence_freq': subsequence_freq,
-                            'subsequence_coverage': subsequence_coverage}}
\ No newline at end of file
+                            'subsequence_coverage': subsequence_coverage}}
+
+def shared_function(clustered_pts, params):
+    """ function() for lib.clustering.SharedXPool workers """
+    return function(dict(params, clustered_pts = clustered_pts))
@@ -2,28 +2,78 @@
 
 import argparse
 from collections import defaultdict
-import heapq
-import math
 import numpy as np
-from operator import itemgetter
 import pickle
 import sys
 
+import lib.coverage
+import lib.instrument
+from lib.occurrences import OccurrenceStore
 
-def score_total_coverage(sequence, max_subseq_len, min_frequency_thresh):
-    subsequence_freq, subsequence_coverage, taken_ranges = \
-            get_subsequences(sequence, max_subseq_len, min_frequency_thresh)
 
-    prev_end = -1
-    total_coverage = 0
-    for start, end in taken_ranges:
-        if start > prev_end:
-            total_coverage += (end - start + 1)
+def score_total_coverage(sequence, max_subseq_len, min_frequency_thresh,
+                         engine = 'reference', rle = False):
+    with lib.instrument.span('mine', engine = engine, rle = rle,
+                             threshold = int(min_frequency_thresh)):
+        if rle:
+            subsequence_freq, subsequence_coverage, taken_ranges = \
+                    get_subsequences_rle(sequence, max_subseq_len,
+                                         min_frequency_thresh, engine)
         else:
-            total_coverage += (end - prev_end)
-        prev_end = end
+            subsequence_freq, subsequence_coverage, taken_ranges = \
+                    SUBSEQUENCE_ENGINES[engine](sequence, max_subseq_len,
+                                                min_frequency_thresh)
 
-    return subsequence_freq, subsequence_coverage, total_coverage
+    return subsequence_freq, subsequence_coverage, \
+           total_coverage(taken_ranges)
+
+def total_coverage(taken_ranges):
+    if isinstance(taken_ranges, lib.coverage.TakenRanges):
+        return taken_ranges.index.unionSize()
+    return lib.coverage.rangesUnionSize(taken_ranges)
+
+def sweep_thresholds(lo, hi, steps):
+    """ Geometric grid of steps integer thresholds from lo to hi. """
+    return sorted(set(max(2, int(round(t)))
+                      for t in np.geomspace(lo, hi, steps)))
+
+def sweep_total_coverage(sequence, max_subseq_len, thresholds,
+                         engine = 'suffix', rle = False):
+    """
+    score_total_coverage for every min_frequency_thresh in thresholds.
+    Returns {threshold: total coverage} and (threshold, subsequence_freq,
+    subsequence_coverage) of the best one; ties go to the first threshold.
+    With the suffix engine the occurrence index is built once and shared by
+    every threshold.
+    """
+    if rle:
+        runs = RunLengthSequence(sequence)
+        sequence = runs.codes
+    if engine == 'suffix':
+        with lib.instrument.span('suffix index'):
+            index = SuffixIndex(sequence)
+        mine = index.mine
+    else:
+        mine = lambda max_len, thresh: \
+                SUBSEQUENCE_ENGINES[engine](sequence, max_len, thresh)
+    if rle:
+        mine_runs = mine
+        mine = lambda max_len, thresh: runs.mine(mine_runs, max_len, thresh)
+
+    scores = {}
+    best = None
+    for min_frequency_thresh in thresholds:
+        with lib.instrument.span('mine', engine = engine, rle = rle,
+                                 threshold = int(min_frequency_thresh)):
+            subsequence_freq, subsequence_coverage, taken_ranges = \
+                    mine(max_subseq_len, min_frequency_thresh)
+        score = total_coverage(taken_ranges)
+        scores[min_frequency_thresh] = score
+        if best is None or score > scores[best[0]]:
+            best = (min_frequency_thresh, subsequence_freq,
+                    subsequence_coverage)
+
+    return scores, best
 
 
 # ===================================
@@ -34,13 +84,15 @@ def score_total_coverage(sequence, max_subseq_len, min_frequency_thresh):
 #   numpy sequence for fast slicing
 #   to_byte for fast immutability
 #   defaultdict is somehow faster, but using its features is slower...
-#   taken_candidate skip-ahead to not iterate through obvious taken ranges
+#   coverage index skip-ahead to not iterate through obvious taken ranges
 #@profile
 def get_subsequences(sequence, max_subseq_len, min_frequency_thresh):
     sequence = np.array(sequence, dtype=np.dtype('B'))
-    taken_ranges = [] # sorted (by starting index) list of everything
+    coverage = lib.coverage.CoverageIndex(len(sequence)) # everything taken
     subsequence_freq = dict()
     subsequence_coverage = dict()
+    # counted in plain locals, reported to lib.instrument once at the end
+    windows = skipped = skips = distinct_keys = 0
 
     # for every possible subsequence length (largest to smallest)
     # target_length = subsequence length
@@ -50,8 +102,8 @@ def get_subsequences(sequence, max_subseq_len, min_frequency_thresh):
 
         subsequence_candidates = defaultdict(list)
         new_taken = [] 
-        taken_index = 0
-        taken_candidates = [] # Heap => current set of overlapping ranges
+        # the window at p is inside a taken range iff reach[p] >= its end
+        reach = coverage.reachAt()
 
         # check every subseq starting from 0
         start_index = 0
@@ -59,19 +111,18 @@ def get_subsequences(sequence, max_subseq_len, min_frequency_thresh):
             end_index = start_index + target_length
 
             # if this is completely contained in a larger subseq, ignore
-            while taken_index < len(taken_ranges) and \
-                  taken_ranges[taken_index][0] <= start_index:
-                heapq.heappush(taken_candidates, taken_ranges[taken_index][1])
-                taken_index += 1
-            while taken_candidates and taken_candidates[0] < end_index:
-                heapq.heappop(taken_candidates)
-            if taken_candidates:
+            if reach[start_index] >= end_index:
                 # skip ahead
-                start_index = taken_candidates[0] - target_length + 1
+                next_index = coverage.nextUncovered(start_index,
+                                                    target_length)
+                skipped += next_index - start_index
+                start_index = next_index
+                skips += 1
                 continue
 
             # create the key.  numpy is really good at slicing and converting
             key = sequence[start_index:end_index:1].tobytes()
+            windows += 1
 
             if key not in subsequence_candidates:
                 # 1st instance of subsequence. Leave for now.
@@ -94,66 +145,597 @@ def get_subsequences(sequence, max_subseq_len, min_frequency_thresh):
 
             start_index += 1
 
-
-        taken_ranges.extend(new_taken)
-        taken_ranges.sort(key=lambda tup: tup[0])
+        distinct_keys += len(subsequence_candidates)
+        if new_taken:
+            coverage.add(*zip(*new_taken))
 
 
-    # convert back to tuples
+    # convert back to tuples, and the coverage to an occurrence store
     no_np_subsequence_freq = {}
-    no_np_subsequence_coverage = {}
     for k, v in subsequence_freq.items():
         no_np_key = tuple(np.frombuffer(k, dtype = sequence.dtype))
         no_np_subsequence_freq[no_np_key] = v
-        no_np_subsequence_coverage[no_np_key] = subsequence_coverage[k]
+    no_np_subsequence_coverage = OccurrenceStore.fromGroups(
+            (np.frombuffer(k, dtype = sequence.dtype),
+             [start for start, end in subsequence_coverage[k]])
+            for k in subsequence_freq)
 
-    return no_np_subsequence_freq, no_np_subsequence_coverage, taken_ranges
+    lib.instrument.count('windows examined', windows)
+    lib.instrument.count('windows skipped', skipped)
+    lib.instrument.count('keys emitted', len(subsequence_freq))
+    lib.instrument.count('skip-aheads', skips)
+    lib.instrument.count('distinct keys', distinct_keys)
+
+    return no_np_subsequence_freq, no_np_subsequence_coverage, \
+           coverage.ranges()
 
 def merge_stable(substring_freq, substring_coverage):
-    merged_freq = dict()
-    merged_coverage = dict()
+    # substring_coverage is an OccurrenceStore, or a dict of range lists
+    store = OccurrenceStore.fromCoverage(substring_coverage)
+    symbols = store.symbols
 
     # merge substrings of the form ABBA, ABBBA, ABBBBBA -> AB[O(1)]A
     # note that ABA -> AB[O(0)]
-    for key, value in substring_freq.items():
-        new_key = []
-        current = key[0]
-        count = 1
-
-        for i in range(1, len(key)):
-            if (key[i] == current):
-                count += 1
-            else:
-                new_key.append((current, int(math.ceil(math.log10(count)))))
-                current = key[i]
-                count = 1
+    # the runs of every key at once: one starts with each key and wherever
+    # the state changes within a key
+    new_run = np.ones(len(symbols), dtype = bool)
+    new_run[1:] = symbols[1:] != symbols[:-1]
+    new_run[store.keyBounds[:-1]] = True
+    run_starts = np.flatnonzero(new_run)
+    runs = list(zip(symbols[run_starts].tolist(),
+                    run_buckets(np.diff(np.append(run_starts,
+                                                  len(symbols)))).tolist()))
+    run_bounds = np.searchsorted(run_starts, store.keyBounds).tolist()
 
-        new_key.append((current, int(math.ceil(math.log10(count)))))
-
-        hashable_new_key = tuple(new_key)
+    merged_freq = dict()
+    merged_ids = dict() # merged key -> its group, in order of appearance
+    key_groups = []
+    for i, key in enumerate(store):
+        hashable_new_key = tuple(runs[run_bounds[i]:run_bounds[i + 1]])
         if hashable_new_key not in merged_freq:
-            merged_freq[hashable_new_key] = value
-            merged_coverage[hashable_new_key] = substring_coverage[key]
+            merged_ids[hashable_new_key] = len(merged_ids)
+            merged_freq[hashable_new_key] = substring_freq[key]
         else:
-            merged_freq[hashable_new_key] += value
-            merged_coverage[hashable_new_key].extend(substring_coverage[key])
+            merged_freq[hashable_new_key] += substring_freq[key]
+        key_groups.append(merged_ids[hashable_new_key])
 
+    # converts the occurrences of each merged key to a single number
+    # representing the number of unique states covered
+    starts, ends = store.ranges()
+    sums = lib.coverage.groupUnionSizes(
+                starts, ends, np.repeat(key_groups, store.counts()),
+                len(merged_ids))
+    return merged_freq, dict(zip(merged_ids, sums.tolist()))
+
+def merge_rle(subsequence_freq, subsequence_coverage):
+    """ merge_stable for run-length mode, whose keys are merged already. """
+    return dict(subsequence_freq), coverage_sums(subsequence_coverage)
+
+def coverage_sums(merged_coverage):
     # converts from a list of coverages to a single number representing the
     # number of unique states covered
-    coverage_sum = dict()
-    for key, range_list in merged_coverage.items():
-        range_list = sorted(range_list, key=itemgetter(0))
-        prev_end = -1
-        total = 0
-        for start, end in range_list:
-            if start > prev_end:
-                total += (end - start + 1)
-            else:
-                total += (end - prev_end)
-            prev_end = end
+    return dict(zip(merged_coverage,
+                    lib.coverage.unionSizes(list(merged_coverage.values()))))
 
-        coverage_sum[key] = total
+# ======  End of sequencing.  =======
 
-    return merged_freq, coverage_sum
 
-# ======  End of sequencing.  =======
+# ===================================
+# =      suffix array engine.       =
+# ===================================
+
+# Same output as get_subsequences, without visiting every window of every
+# length.  The windows of length L that are equal to each other are exactly
+# the runs of adjacent suffixes (in suffix array order) whose LCP is >= L, so
+# joining adjacent suffixes in decreasing LCP order builds the groups of every
+# length in one sweep.  A group only needs to be checked at the length where
+# it is formed: below that length it holds the same occurrences with shorter
+# windows, and a window that is contained in a taken range stays contained
+# when it gets shorter or when more ranges are taken.  So a group that misses
+# the threshold there never reaches it later, and a group that is taken
+# covers all of its occurrences at every shorter length.
+#
+# Occurrences that are found to be contained are dropped from their group for
+# good, so each position is only rechecked while it is still uncovered.
+
+def suffix_array(sequence):
+    """ Suffix array of an integer sequence by prefix doubling. """
+    n = len(sequence)
+    rank = np.unique(sequence, return_inverse = True)[1].astype(np.int64)
+    sa = np.argsort(rank, kind = 'stable')
+    step = 1
+    while n > 1 and rank.max() < n - 1 and step < n:
+        # sort by (rank of first half, rank of second half). -1 marks a
+        # second half that runs off the end, which sorts first.
+        second = np.full(n, -1, dtype = np.int64)
+        second[:n - step] = rank[step:]
+        key = rank * (n + 1) + (second + 1)
+        sa = np.argsort(key, kind = 'stable')
+        sorted_key = key[sa]
+        rank = np.empty(n, dtype = np.int64)
+        rank[sa] = np.concatenate(([0], np.cumsum(sorted_key[1:] !=
+                                                  sorted_key[:-1])))
+        step *= 2
+    return sa
+
+def lcp_array(sequence, sa):
+    """
+    lcp[i] is the longest common prefix of suffixes sa[i-1] and sa[i]
+    (lcp[0] = 0).  Kasai et al.
+    """
+    n = len(sa)
+    seq = sequence.tolist()
+    sa_list = sa.tolist()
+    rank = [0] * n
+    for i, p in enumerate(sa_list):
+        rank[p] = i
+
+    lcp = [0] * n
+    h = 0
+    for i in range(n):
+        r = rank[i]
+        if r == 0:
+            h = 0
+            continue
+        j = sa_list[r - 1]
+        while i + h < n and j + h < n and seq[i + h] == seq[j + h]:
+            h += 1
+        lcp[r] = h
+        if h > 0:
+            h -= 1
+    return np.array(lcp, dtype = np.int64)
+
+class _ReachTree(object):
+    """
+    Fenwick tree over start positions.  query(p) is the furthest end of any
+    range added with start <= p, so [p, p + L) is contained in a single added
+    range iff query(p) >= p + L.  Both calls take arrays and run in
+    O(log n) numpy ops.
+    """
+    def __init__(self, n):
+        self.tree = np.zeros(n + 1, dtype = np.int64)
+
+    def add(self, starts, ends):
+        i = np.asarray(starts, dtype = np.int64) + 1
+        ends = np.asarray(ends, dtype = np.int64)
+        while len(i):
+            np.maximum.at(self.tree, i, ends)
+            i = i + (i & -i)
+            keep = i < len(self.tree)
+            i, ends = i[keep], ends[keep]
+
+    def query(self, starts):
+        i = np.asarray(starts, dtype = np.int64) + 1
+        best = np.zeros(len(i), dtype = np.int64)
+        while i.any():
+            np.maximum(best, self.tree[i], out = best)
+            i = i - (i & -i)
+        return best
+
+class SuffixIndex(object):
+    """
+    Occurrence index of a cluster sequence: its suffix array, LCP array and
+    the tree of equal-window groups they induce.  The tree does not depend on
+    max_subseq_len or min_frequency_thresh, so one index can be mined with
+    any of them.
+    """
+    def __init__(self, sequence):
+        self.sequence = np.array(sequence, dtype=np.dtype('B'))
+        n = len(self.sequence)
+        self.sa = suffix_array(self.sequence)
+        self.lcp = lcp_array(self.sequence, self.sa)
+
+        # node i is the group of windows equal up to length node_len[i]: the
+        # groups node_children[i] plus the single suffixes node_leaves[i].
+        # These are the LCP intervals of the suffix array, built bottom-up
+        # with a stack (Abouelhoda et al.).  Nothing is grouped below length
+        # 2.  node_order lists the nodes by decreasing length, so children
+        # come before their parents.
+        self.node_len = []
+        self.node_children = []
+        self.node_leaves = []
+        self.node_parent_len = []
+
+        sa = self.sa.tolist()
+        lcp = self.lcp.tolist() + [0]
+        stack = [[0, [], []]] # [length, child nodes, leaves] of open intervals
+        for i in range(1, n + 1):
+            # suffix sa[i-1] belongs to the deepest interval holding it, the
+            # one of length max(lcp[i-1], lcp[i])
+            if lcp[i - 1] >= lcp[i]:
+                stack[-1][2].append(sa[i - 1])
+
+            last = None
+            while lcp[i] < stack[-1][0]:
+                length, children, leaves = stack.pop()
+                last = None
+                if length >= 2:
+                    last = len(self.node_len)
+                    for child in children:
+                        self.node_parent_len[child] = length
+                    self.node_len.append(length)
+                    self.node_children.append(children)
+                    self.node_leaves.append(leaves)
+                    self.node_parent_len.append(0)
+                if lcp[i] <= stack[-1][0] and last is not None:
+                    stack[-1][1].append(last)
+                    last = None
+            if lcp[i] > stack[-1][0]:
+                stack.append([lcp[i], [] if last is None else [last], []])
+            if lcp[i - 1] < lcp[i]:
+                stack[-1][2].append(sa[i - 1])
+
+        self.node_order = np.argsort(-np.array(self.node_len, dtype = np.int64),
+                                     kind = 'stable').tolist()
+
+    def mine(self, max_subseq_len, min_frequency_thresh):
+        """
+        get_subsequences on the indexed sequence.  Returns the same
+        subsequence_freq, subsequence_coverage and taken_ranges.
+        min_frequency_thresh must be at least 2, as in get_subsequences.
+        """
+        if min_frequency_thresh < 2:
+            raise ValueError("min_frequency_thresh must be at least 2, "
+                             "got %s" % min_frequency_thresh)
+
+        sequence = self.sequence
+        n = len(sequence)
+        # survivors[node] holds the starts of the group's occurrences that
+        # were not contained the last time the group (or a part of it) was
+        # checked.  Freed once the parent picks them up.
+        survivors = [None] * len(self.node_len)
+        reach = _ReachTree(n)
+        taken = [] # (length, starts) in the order get_subsequences finds them
+        windows = skipped = groups_checked = 0 # for lib.instrument
+
+        order = self.node_order
+        index = 0
+        while index < len(order):
+            target_length = min(self.node_len[order[index]], max_subseq_len)
+            if target_length < 2:
+                break
+
+            # check every group of this length against ranges taken at
+            # longer lengths only
+            checked = [] # nodes to check, their candidates in one array
+            candidates = []
+            while index < len(order) and \
+                  min(self.node_len[order[index]],
+                      max_subseq_len) == target_length:
+                node = order[index]
+                group = list(self.node_leaves[node])
+                for child in self.node_children[node]:
+                    group.extend(survivors[child])
+                    survivors[child] = None
+                survivors[node] = group
+
+                # a group longer than max_subseq_len is only mined at
+                # max_subseq_len, as part of the group holding it there
+                if (self.node_len[node] <= max_subseq_len or
+                    self.node_parent_len[node] < max_subseq_len) and \
+                   len(group) >= min_frequency_thresh:
+                    checked.append(node)
+                    candidates.extend(group)
+                index += 1
+
+            hits = []
+            if checked:
+                candidates = np.array(candidates, dtype = np.int64)
+                uncovered = reach.query(candidates) < \
+                            candidates + target_length
+                windows += len(candidates)
+                skipped += len(candidates) - int(uncovered.sum())
+                groups_checked += len(checked)
+                offset = 0
+                for checked_node in checked:
+                    group = survivors[checked_node]
+                    starts = candidates[offset:offset + len(group)]
+                    starts = starts[uncovered[offset:offset + len(group)]]
+                    offset += len(group)
+                    if len(starts) >= min_frequency_thresh:
+                        hits.append(sorted(starts.tolist()))
+                        survivors[checked_node] = []
+                    else:
+                        survivors[checked_node] = starts.tolist()
+
+            # get_subsequences records a key when its min_frequency_thresh-th
+            # occurrence is scanned
+            hits.sort(key = lambda alive: alive[min_frequency_thresh - 1])
+            for alive in hits:
+                taken.append((target_length, alive))
+            if hits:
+                starts = np.concatenate(hits)
+                reach.add(starts, starts + target_length)
+
+        subsequence_freq = dict()
+        groups = [] # (key, starts) of every subsequence, for the store
+        taken_ranges = lib.coverage.CoverageIndex(n)
+        for length, starts in taken:
+            key = sequence[starts[0]:starts[0] + length]
+            subsequence_freq[tuple(key)] = len(starts)
+            starts = np.array(starts, dtype = np.int64)
+            groups.append((key, starts))
+            taken_ranges.add(starts, starts + length)
+        subsequence_coverage = OccurrenceStore.fromGroups(groups)
+
+        lib.instrument.count('windows examined', windows)
+        lib.instrument.count('windows skipped', skipped)
+        lib.instrument.count('keys emitted', len(subsequence_freq))
+        lib.instrument.count('groups checked', groups_checked)
+
+        return subsequence_freq, subsequence_coverage, taken_ranges.ranges()
+
+def get_subsequences_sa(sequence, max_subseq_len, min_frequency_thresh):
+    """
+    Suffix array/LCP version of get_subsequences.  Returns the same
+    subsequence_freq, subsequence_coverage and taken_ranges.
+    min_frequency_thresh must be at least 2, as in get_subsequences.
+    """
+    return SuffixIndex(sequence).mine(max_subseq_len, min_frequency_thresh)
+
+# ======  End of suffix array engine.  =======
+
+
+# ===================================
+# =     rolling hash engine.        =
+# ===================================
+
+# get_subsequences one length at a time, but with every window of the length
+# handled in one batch of NumPy calls instead of one bytes slice and dict
+# lookup per window.  Windows are keyed by a polynomial hash mod 2**64 (uint64
+# arithmetic wraps for free).  Only keys that reach min_frequency_thresh come
+# back to Python, and those are compared element by element, so a hash
+# collision can never merge two different subsequences.
+
+HASH_BASE = 0x9E3779B97F4A7C15 # odd, so it has an inverse mod 2**64
+
+class _WindowHasher(object):
+    """ Hashes of arbitrary windows of a sequence, in O(1) numpy ops each. """
+    def __init__(self, sequence):
+        n = len(sequence)
+        base = np.uint64(HASH_BASE)
+        inverse = np.uint64(pow(HASH_BASE, -1, 2**64))
+        # powers[i] = base**i and inv_powers[i] = base**-i, mod 2**64
+        self.powers = np.cumprod(np.full(n + 1, base, dtype = np.uint64))
+        self.powers = np.concatenate(([np.uint64(1)], self.powers[:-1]))
+        inv_powers = np.cumprod(np.full(n, inverse, dtype = np.uint64))
+        inv_powers = np.concatenate(([np.uint64(1)], inv_powers[:-1]))
+        # prefix[i] = sum over j < i of (sequence[j] + 1) * base**-j
+        terms = (sequence.astype(np.uint64) + np.uint64(1)) * inv_powers
+        self.prefix = np.concatenate(([np.uint64(0)], np.cumsum(terms,
+                                                        dtype = np.uint64)))
+
+    def hashes(self, starts, length):
+        """ Position independent hash of sequence[s:s+length] per start s. """
+        return (self.prefix[starts + length] - self.prefix[starts]) * \
+               self.powers[starts]
+
+def _longest_frequent_length(hasher, n, max_subseq_len, min_frequency_thresh):
+    """
+    Longest length that has a window repeated min_frequency_thresh times,
+    ignoring coverage.  Every occurrence of a window has a distinct prefix
+    occurrence one shorter, so this is monotone and can be bisected.  A hash
+    collision can only make the answer too long, which costs time, not
+    correctness.
+    """
+    def frequent(length):
+        starts = np.arange(n - length + 1)
+        counts = np.unique(hasher.hashes(starts, length),
+                           return_counts = True)[1]
+        return counts.max() >= min_frequency_thresh
+
+    lo, hi = 1, min(max_subseq_len, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if frequent(mid):
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _split_equal_windows(sequence, starts, length):
+    """ Group starts (sorted) by the exact content of their windows. """
+    windows = np.lib.stride_tricks.sliding_window_view(sequence, length)
+    first = windows[starts[0]]
+    if (windows[starts] == first).all():
+        return [starts]
+    groups = defaultdict(list)
+    for start in starts.tolist():
+        groups[sequence[start:start + length].tobytes()].append(start)
+    return [np.array(group) for group in groups.values()]
+
+def get_subsequences_hash(sequence, max_subseq_len, min_frequency_thresh):
+    """
+    Vectorized rolling hash version of get_subsequences.  Returns the same
+    subsequence_freq, subsequence_coverage and taken_ranges.
+    min_frequency_thresh must be at least 2, as in get_subsequences.
+    """
+    if min_frequency_thresh < 2:
+        raise ValueError("min_frequency_thresh must be at least 2, got %s" %
+                         min_frequency_thresh)
+
+    sequence = np.array(sequence, dtype=np.dtype('B'))
+    n = len(sequence)
+    subsequence_freq = dict()
+    groups = [] # (key, starts) of every subsequence, for the store
+    if n < 2:
+        return subsequence_freq, OccurrenceStore.fromGroups(groups), []
+
+    hasher = _WindowHasher(sequence)
+    top_length = _longest_frequent_length(hasher, n, max_subseq_len,
+                                          min_frequency_thresh)
+
+    # tells, for every window at once, whether one taken range holds it
+    taken_ranges = lib.coverage.CoverageIndex(n)
+    windows = skipped = 0 # for lib.instrument
+
+    for target_length in range(top_length, 1, -1):
+        starts = np.flatnonzero(~taken_ranges.coveredWindows(target_length))
+        windows += len(starts)
+        skipped += n - target_length + 1 - len(starts)
+        if len(starts) < min_frequency_thresh:
+            continue
+
+        keys, inverse, counts = np.unique(hasher.hashes(starts, target_length),
+                                          return_inverse = True,
+                                          return_counts = True)
+        frequent = counts >= min_frequency_thresh
+        if not frequent.any():
+            continue
+
+        # starts of the frequent keys, grouped by key and sorted within each
+        in_hit = frequent[inverse]
+        hit_starts = starts[in_hit]
+        hit_keys = inverse[in_hit]
+        order = np.argsort(hit_keys, kind = 'stable')
+        hit_starts = hit_starts[order]
+        bounds = np.flatnonzero(np.diff(hit_keys[order])) + 1
+
+        hits = []
+        for group in np.split(hit_starts, bounds):
+            for alive in _split_equal_windows(sequence, group, target_length):
+                if len(alive) >= min_frequency_thresh:
+                    hits.append(alive)
+        if not hits:
+            continue
+
+        # get_subsequences records a key when its min_frequency_thresh-th
+        # occurrence is scanned
+        hits.sort(key = lambda alive: alive[min_frequency_thresh - 1])
+        for alive in hits:
+            key = tuple(sequence[alive[0]:alive[0] + target_length])
+            subsequence_freq[key] = len(alive)
+            groups.append((key, alive))
+            taken_ranges.add(alive, alive + target_length)
+
+    lib.instrument.count('windows examined', windows)
+    lib.instrument.count('windows skipped', skipped)
+    lib.instrument.count('keys emitted', len(subsequence_freq))
+
+    return subsequence_freq, OccurrenceStore.fromGroups(groups), \
+           taken_ranges.ranges()
+
+# ======  End of rolling hash engine.  =======
+
+
+# ===================================
+# =       run-length mode.          =
+# ===================================
+
+# Cluster sequences are mostly long runs of one state, which merge_stable
+# collapses to (state, log10 run length bucket) pairs after mining anyway.
+# In run-length mode the sequence is collapsed first: each maximal run becomes
+# one symbol, its (state, bucket) pair, and any engine mines the much shorter
+# symbol sequence.  The subsequences come back keyed like merge_stable's
+# output, with their ranges mapped back to sample indices, so coverage stays
+# comparable with the expanded mode.  Lengths (max_subseq_len) count runs.
+
+MAX_RUN_BUCKETS = 19 # ceil(log10) of any int64 run length is below this
+
+def run_length_encode(sequence):
+    """ (states, lengths, starts) of the maximal runs of sequence. """
+    sequence = np.asarray(sequence)
+    if not len(sequence):
+        empty = np.zeros(0, dtype = np.int64)
+        return sequence[:0], empty, empty
+    starts = np.concatenate(([0], np.flatnonzero(sequence[1:] !=
+                                                 sequence[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(sequence)))
+    return sequence[starts], lengths, starts
+
+def run_buckets(lengths):
+    """ ceil(log10(length)) of every run length, as merge_stable buckets. """
+    powers = 10 ** np.arange(MAX_RUN_BUCKETS, dtype = np.int64)
+    return np.searchsorted(powers, lengths, side = 'left')
+
+class RunLengthSequence(object):
+    """
+    A cluster sequence as one uint8 code per run, for the engines, and the
+    (state, bucket) pair and first sample of every code and run.
+    """
+    def __init__(self, sequence):
+        states, lengths, starts = run_length_encode(sequence)
+        pairs = states.astype(np.int64) * MAX_RUN_BUCKETS + \
+                run_buckets(lengths)
+        pairs, codes = np.unique(pairs, return_inverse = True)
+        if len(pairs) > 256:
+            raise ValueError("%d distinct (state, run length) symbols, the "
+                             "engines take at most 256" % len(pairs))
+        self.codes = codes.astype(np.dtype('B'))
+        self.symbols = [(int(pair // MAX_RUN_BUCKETS),
+                         int(pair % MAX_RUN_BUCKETS)) for pair in pairs]
+        # run i is samples bounds[i] up to bounds[i + 1]
+        self.bounds = np.append(starts, lengths.sum()).tolist()
+        self.lengths = lengths
+
+    def mine(self, mine, max_subseq_len, min_frequency_thresh):
+        """
+        Mine the runs with mine(max_subseq_len, min_frequency_thresh), an
+        engine on self.codes, and map the result to samples.  Returns
+        (subsequence_freq, subsequence_coverage, taken_ranges) keyed by
+        tuples of (state, bucket) pairs, ranges in samples.
+        """
+        n = len(self.codes)
+        subsequence_freq, subsequence_coverage, taken_ranges = \
+                mine(min(max_subseq_len, n - 1), min_frequency_thresh)
+        # run keys are few, and the single runs below are added to them
+        subsequence_coverage = dict(subsequence_coverage)
+
+        # single runs, which the engines never mine: the expanded mode finds
+        # them as windows inside a run.  Count the runs no taken range holds.
+        # A window of one state occurs there at every offset of a run, so a
+        # run of length L counts as the L - 1 windows of length 2 it holds,
+        # the shortest the miners take; the threshold keeps its scale.
+        coverage = lib.coverage.CoverageIndex(n)
+        if taken_ranges:
+            coverage.add(*lib.coverage.rangeArray(taken_ranges).T)
+        free = np.flatnonzero(~coverage.coveredWindows(1))
+        windows = np.bincount(self.codes[free], self.lengths[free] - 1,
+                              minlength = len(self.symbols))
+        new_taken = []
+        for code in np.flatnonzero(windows >= min_frequency_thresh).tolist():
+            ranges = [(i, i + 1) for i in free[self.codes[free] == code]
+                                          .tolist()]
+            # on the scale the threshold tested, not the number of runs
+            subsequence_freq[(code,)] = int(windows[code])
+            subsequence_coverage[(code,)] = ranges
+            new_taken.extend(ranges)
+        if new_taken:
+            taken_ranges = sorted(list(taken_ranges) + new_taken,
+                                  key = lambda tup: (tup[0], -tup[1]))
+
+        return self.expand(subsequence_freq, subsequence_coverage,
+                           taken_ranges)
+
+    def expand(self, subsequence_freq, subsequence_coverage, taken_ranges):
+        """ Results mined from self.codes, in (state, bucket) and samples. """
+        bounds = self.bounds
+        freq, coverage = {}, {}
+        for key, value in subsequence_freq.items():
+            new_key = tuple(self.symbols[code] for code in key)
+            freq[new_key] = value
+            coverage[new_key] = [(bounds[start], bounds[end])
+                                 for start, end in subsequence_coverage[key]]
+        taken = [(bounds[start], bounds[end]) for start, end in taken_ranges]
+        return freq, coverage, taken
+
+def get_subsequences_rle(sequence, max_subseq_len, min_frequency_thresh,
+                         engine = 'suffix'):
+    """
+    get_subsequences in run-length mode, mining with engine.  Returns the
+    subsequences keyed like merge_stable's output (merge them with
+    merge_rle), ranges in samples and max_subseq_len in runs.
+    """
+    runs = RunLengthSequence(sequence)
+    return runs.mine(lambda max_len, thresh:
+                     SUBSEQUENCE_ENGINES[engine](runs.codes, max_len, thresh),
+                     max_subseq_len, min_frequency_thresh)
+
+# ======  End of run-length mode.  =======
+
+
+SUBSEQUENCE_ENGINES = {
+    'reference' : get_subsequences,
+    'suffix' : get_subsequences_sa,
+    'hash' : get_subsequences_hash
+}
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# Synthetic switch traces from a Markov chain, for benchmarks and tests at
+# any size.  Each state has a fixed mean utilization per switch; the chain
+# stays in a state for a geometric number of samples (mean dwell) and then
+# jumps to one of the other states uniformly.  Samples are the state's mean
+# plus Gaussian noise relative to it, as non-negative integer counters like
+# data/*.data.
+
+import argparse
+import numpy as np
+
+import lib.tracefile
+
+
+CHUNK_SAMPLES = 2**20 # generated at a time
+COUNTER_SCALE = 10**4 # largest mean counter value
+
+
+class MarkovTrace(object):
+    """ A random Markov chain trace generator; same seed, same trace. """
+    def __init__(self, nSwitches = 4, nStates = 4, dwell = 100.0,
+                 noise = 0.05, seed = 1):
+        if nStates < 2:
+            raise ValueError("need at least 2 states")
+        self.nSwitches = nSwitches
+        self.nStates = nStates
+        self.dwell = dwell
+        self.noise = noise
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        self.means = rng.random_sample((nStates, nSwitches)) * COUNTER_SCALE
+
+    def iterChunks(self, n, chunk = CHUNK_SAMPLES):
+        """ (samples, labels) of an n sample trace, chunk samples at a time. """
+        rng = np.random.RandomState(self.seed + 1)
+        p = 1.0 / self.dwell
+        # the state the chain is in and how many more samples it stays
+        state, left = rng.randint(self.nStates), rng.geometric(p)
+        for start in range(0, n, chunk):
+            m = min(chunk, n - start)
+            runs, labels = [np.array([left])], [np.array([state])]
+            total = left
+            while total < m:
+                k = int((m - total) / self.dwell * 1.2) + 16
+                runs.append(rng.geometric(p, k))
+                # every jump goes to one of the other states
+                labels.append((labels[-1][-1] +
+                               np.cumsum(rng.randint(1, self.nStates, k))) %
+                              self.nStates)
+                total += runs[-1].sum()
+            runs, labels = np.concatenate(runs), np.concatenate(labels)
+            ends = np.cumsum(runs)
+            last = np.searchsorted(ends, m) # the run sample m - 1 is in
+            y = np.repeat(labels[:last + 1], runs[:last + 1])[:m]
+            state, left = labels[last], ends[last] - m
+
+            X = self.means[y]
+            X = X + rng.standard_normal(X.shape) * X * self.noise
+            yield np.maximum(np.rint(X), 0).astype(np.int64), y
+
+    def generate(self, n):
+        """ (samples, labels) of an n sample trace. """
+        chunks = list(self.iterChunks(n))
+        return np.concatenate([X for X, y in chunks]), \
+               np.concatenate([y for X, y in chunks])
+
+    def writeText(self, filename, n):
+        """ Write an n sample trace in the data/*.data text format. """
+        with open(filename, 'w') as out:
+            for X, y in self.iterChunks(n):
+                np.savetxt(out, X, fmt = '%d')
+
+    def writeTrace(self, filename, n, labelfile = None):
+        """
+        Write an n sample trace as a trace file (lib.tracefile) and, with
+        labelfile, its labels as a one column trace file.
+        """
+        with lib.tracefile.TraceWriter(filename, self.nSwitches,
+                                       np.int64) as writer:
+            if labelfile is None:
+                for X, y in self.iterChunks(n):
+                    writer.append(X)
+                return
+            with lib.tracefile.TraceWriter(labelfile, 1,
+                                           np.int64) as labelWriter:
+                for X, y in self.iterChunks(n):
+                    writer.append(X)
+                    labelWriter.append(y[:, None])
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('outfile', type=str,
+                        help='output trace: a trace file if it ends in ' \
+                             '.trace, else text like data/*.data.')
+    parser.add_argument('--samples', type=float, default=1e5,
+                        help='samples in the trace.')
+    parser.add_argument('--switches', type=int, default=4,
+                        help='counters per sample.')
+    parser.add_argument('--states', type=int, default=4,
+                        help='states of the Markov chain.')
+    parser.add_argument('--dwell', type=float, default=100.0,
+                        help='mean samples spent in a state per visit.')
+    parser.add_argument('--noise', type=float, default=0.05,
+                        help='standard deviation of a counter, relative ' \
+                             'to its mean.')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args()
+
+def main():
+    args = argParser()
+
+    gen = MarkovTrace(args.switches, args.states, args.dwell, args.noise,
+                      args.seed)
+    n = int(args.samples)
+    if args.outfile.endswith('.trace'):
+        gen.writeTrace(args.outfile, n)
+    else:
+        gen.writeText(args.outfile, n)
+    print ("wrote %s: %d samples x %d switches, %d states, dwell %g, "
+           "noise %g" % (args.outfile, n, args.switches, args.states,
+                         args.dwell, args.noise))
+
+
+if __name__ == '__main__':
+    main()
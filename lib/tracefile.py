@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+# Binary trace container.  A 64 byte header, the sample matrix (samples x
+# switches, C order) at DATA_OFFSET and, optionally, one float64 timestamp per
+# sample right after it.  Opening a trace memory-maps the matrix, so repeat
+# analyses of the same trace skip parsing entirely.
+#
+# Header (little endian):
+#     magic        8s   TRACE_MAGIC
+#     version      H
+#     flags        H    FLAG_TIMESTAMPS
+#     nSwitches    I
+#     nSamples     Q
+#     dtype        8s   numpy dtype string of the samples, e.g. '<i8'
+#     dataOffset   Q
+#     tsOffset     Q    0 without timestamps
+
+import argparse
+import numpy as np
+import os
+import struct
+import tempfile
+import warnings
+
+import lib.parsing
+
+
+TRACE_MAGIC = b'TPPTRACE'
+TRACE_VERSION = 1
+FLAG_TIMESTAMPS = 1
+HEADER = struct.Struct('<8sHHIQ8sQQ16x')
+DATA_OFFSET = 64 # keeps the matrix cache line aligned
+
+
+def isTraceFile(filename):
+    """ True if filename is a binary trace container. """
+    with open(filename, 'rb') as f:
+        return f.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+
+def readHeader(filename):
+    with open(filename, 'rb') as f:
+        (magic, version, flags, nSwitches, nSamples, dtype, dataOffset,
+         tsOffset) = HEADER.unpack(f.read(HEADER.size))
+    if magic != TRACE_MAGIC:
+        raise ValueError("%s is not a trace file" % filename)
+    if version > TRACE_VERSION:
+        raise ValueError("%s has trace version %d, newest supported is %d" %
+                         (filename, version, TRACE_VERSION))
+    return {'nSwitches' : nSwitches, 'nSamples' : nSamples,
+            'dtype' : np.dtype(dtype.rstrip(b'\0').decode()),
+            'dataOffset' : dataOffset,
+            'tsOffset' : tsOffset if flags & FLAG_TIMESTAMPS else None}
+
+def openTrace(filename, mode = 'r'):
+    """
+    Memory-map a trace file.  Returns (samples, timestamps); timestamps is
+    None if the trace has none.  No data is read until it is used.
+    """
+    header = readHeader(filename)
+    shape = (header['nSamples'], header['nSwitches'])
+    if header['nSamples'] == 0:
+        samples = np.empty(shape, dtype = header['dtype'])
+    else:
+        samples = np.memmap(filename, dtype = header['dtype'], mode = mode,
+                            offset = header['dataOffset'], shape = shape)
+    timestamps = None
+    if header['tsOffset'] is not None and header['nSamples']:
+        timestamps = np.memmap(filename, dtype = np.float64, mode = mode,
+                               offset = header['tsOffset'],
+                               shape = (header['nSamples'],))
+    return samples, timestamps
+
+def loadTrace(filename, progress = False):
+    """
+    Samples of a trace in any supported format: a memory-mapped binary trace
+    file, or a parsed text trace.
+    """
+    if isTraceFile(filename):
+        print("mapping trace file: %s" % filename)
+        return openTrace(filename)[0]
+    return lib.parsing.loadSwitchTrace(filename, progress = progress)
+
+class TraceWriter(object):
+    """
+    Write a trace file chunk by chunk, without knowing the number of samples
+    up front.  Timestamps go to a side file until close().
+    """
+    def __init__(self, filename, nSwitches, dtype, timestamps = False):
+        self.filename = filename
+        self.nSwitches = nSwitches
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.nSamples = 0
+        self.out = open(filename, 'wb')
+        self.out.write(b'\0' * DATA_OFFSET)
+        self.tsOut = tempfile.TemporaryFile() if timestamps else None
+
+    def append(self, samples, timestamps = None):
+        samples = np.ascontiguousarray(samples, dtype = self.dtype)
+        if samples.ndim != 2 or samples.shape[1] != self.nSwitches:
+            raise ValueError("expected samples x %d switches, got %s" %
+                             (self.nSwitches, samples.shape))
+        if (timestamps is None) != (self.tsOut is None):
+            raise ValueError("timestamps must be given for every chunk or "
+                             "for none")
+        self.out.write(samples.tobytes())
+        if self.tsOut is not None:
+            timestamps = np.ascontiguousarray(timestamps, dtype = '<f8')
+            if len(timestamps) != len(samples):
+                raise ValueError("got %d timestamps for %d samples" %
+                                 (len(timestamps), len(samples)))
+            self.tsOut.write(timestamps.tobytes())
+        self.nSamples += len(samples)
+
+    def close(self):
+        flags = 0
+        tsOffset = 0
+        if self.tsOut is not None:
+            flags |= FLAG_TIMESTAMPS
+            tsOffset = self.out.tell()
+            self.tsOut.seek(0)
+            while True:
+                block = self.tsOut.read(2**24)
+                if not block:
+                    break
+                self.out.write(block)
+            self.tsOut.close()
+        self.out.seek(0)
+        self.out.write(HEADER.pack(TRACE_MAGIC, TRACE_VERSION, flags,
+                                   self.nSwitches, self.nSamples,
+                                   self.dtype.str.encode(), DATA_OFFSET,
+                                   tsOffset))
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None:
+            self.close()
+        else:
+            self.out.close()
+            os.remove(self.filename)
+
+def writeTrace(filename, samples, timestamps = None):
+    """ Write an in-memory trace to a trace file. """
+    samples = np.asarray(samples)
+    with TraceWriter(filename, samples.shape[1], samples.dtype,
+                     timestamps is not None) as writer:
+        writer.append(samples, timestamps)
+
+# ===================================
+# =           converters.           =
+# ===================================
+
+def convertText(src, dst, dtype = np.int64, progress = False):
+    """ Convert a text trace (data/*.data, optionally compressed). """
+    chunks = lib.parsing.iterSwitchTrace(src, dtype, progress = progress)
+    first = next(chunks, None)
+    if first is None:
+        raise ValueError("%s has no samples" % src)
+    # a parse error in a later chunk removes dst
+    with TraceWriter(dst, first.shape[1], dtype) as writer:
+        writer.append(first)
+        for chunk in chunks:
+            writer.append(chunk)
+
+def iterSnapGrepCsv(src, dtype = np.float64, numSwitches = None,
+                    chunkBytes = lib.parsing.CHUNK_BYTES):
+    """
+    Parse a snapGrep CSV trace in chunks of (samples, ids).  As snapGrep.cpp,
+    a sample is the numSwitches fields after the snapshot id.  Without
+    numSwitches, it is every field after the id, but for a switch count
+    column (as snapGrep/updateData.py writes): a second field equal to the
+    number of values on every line of the first chunk, then required on
+    every line.
+    """
+    nFields = None
+    countColumn = False
+    with lib.parsing.openText(src) as csv_file:
+        tail = ''
+        nSamples = 0
+        while True:
+            text = csv_file.read(chunkBytes)
+            if not text:
+                text, tail = tail, ''
+                if not text.strip():
+                    break
+            else:
+                # only parse whole lines, carry the rest to the next chunk
+                cut = text.rfind('\n') + 1
+                text, tail = tail + text[:cut], text[cut:]
+                if not text.strip():
+                    continue
+
+            lines = text.split()
+            counts = lib.parsing.lineFieldCounts(text, ',')
+            if nFields is None:
+                nFields = int(counts[0])
+                if numSwitches is not None and nFields < numSwitches + 1:
+                    raise ValueError("%s: expected snapshot id and %d switch "
+                                     "values" % (src, numSwitches))
+                if nFields < 2:
+                    raise ValueError("%s: expected snapshot id and switch "
+                                     "values" % src)
+            bad = np.flatnonzero(counts != nFields)
+            if len(bad) or len(counts) != len(lines):
+                raise ValueError("%s: expected %d fields on every line after "
+                                 "sample %d" % (src, nFields, nSamples +
+                                                (bad[0] if len(bad) else 0)))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                values = np.fromstring(','.join(lines), dtype = np.float64,
+                                       sep = ',')
+            if values.size != len(lines) * nFields:
+                raise ValueError("%s: malformed value after sample %d" %
+                                 (src, nSamples))
+            values = values.reshape(len(lines), nFields)
+            if numSwitches is not None:
+                samples = values[:, 1:1 + numSwitches]
+            else:
+                isCount = values[:, 1] == nFields - 2
+                if nSamples == 0:
+                    countColumn = nFields > 2 and isCount.all()
+                elif countColumn and not isCount.all():
+                    raise ValueError("%s: switch count is not %d after "
+                                     "sample %d" % (src, nFields - 2,
+                                                    nSamples +
+                                                    np.argmin(isCount)))
+                samples = values[:, 2:] if countColumn else values[:, 1:]
+            nSamples += len(lines)
+            yield samples.astype(dtype), values[:, 0]
+
+def convertSnapGrepCsv(src, dst, dtype = np.float64, numSwitches = None):
+    """ Convert a snapGrep CSV trace, keeping snapshot ids as timestamps. """
+    chunks = iterSnapGrepCsv(src, dtype, numSwitches)
+    first = next(chunks, None)
+    if first is None:
+        raise ValueError("%s has no samples" % src)
+    # a parse error in a later chunk removes dst
+    with TraceWriter(dst, first[0].shape[1], dtype,
+                     timestamps = True) as writer:
+        writer.append(*first)
+        for samples, ids in chunks:
+            writer.append(samples, ids)
+
+def exportSnapGrepCsv(src, dst):
+    """
+    Write a trace file in the snapGrep CSV format, for snapGrep: snapshot id
+    and switch values, without a switch count column.
+    """
+    samples, timestamps = openTrace(src)
+    with open(dst, 'w') as out:
+        for start in range(0, len(samples), 2**16):
+            block = samples[start:start + 2**16]
+            if timestamps is not None:
+                ids = timestamps[start:start + len(block)].astype(np.int64)
+            else:
+                ids = np.arange(start + 1, start + len(block) + 1)
+            lines = [str(i) + ',' + ','.join(str(v) for v in row)
+                     for i, row in zip(ids.tolist(), block.tolist())]
+            out.write('\n'.join(lines) + '\n')
+
+# ======  End of converters.  =======
+
+def argParser():
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('src', type=str, help='The input trace.')
+    parser.add_argument('dst', type=str, help='The output trace.')
+    parser.add_argument('--format', type=str, default='auto',
+                        choices=['auto', 'data', 'csv'],
+                        help='format of src: whitespace separated text ' \
+                             '(data), snapGrep CSV (csv), or auto to ' \
+                             'guess from the extension.')
+    parser.add_argument('--dtype', type=str,
+                        help='sample dtype in the trace file. Default is ' \
+                             'int64 for data and float64 for csv.')
+    parser.add_argument('--switches', type=int,
+                        help='number of switches in each csv sample, the ' \
+                             'fields after the snapshot id as snapGrep ' \
+                             'reads them. Default is every field after ' \
+                             'the id and a switch count column, if any.')
+    parser.add_argument('--tocsv', action='store_true',
+                        help='write src, a trace file, as snapGrep CSV.')
+    return parser.parse_args()
+
+def main():
+    args = argParser()
+
+    if args.tocsv:
+        exportSnapGrepCsv(args.src, args.dst)
+        return
+
+    fmt = args.format
+    if fmt == 'auto':
+        name = args.src
+        for ext in ('.gz', '.zst'):
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+        fmt = 'csv' if name.endswith('.csv') else 'data'
+    if fmt == 'csv':
+        convertSnapGrepCsv(args.src, args.dst, args.dtype or np.float64,
+                           args.switches)
+    else:
+        convertText(args.src, args.dst, args.dtype or np.int64,
+                    progress = True)
+
+    header = readHeader(args.dst)
+    print("wrote %s: %d samples x %d switches, %s%s" %
+          (args.dst, header['nSamples'], header['nSwitches'],
+           header['dtype'].name,
+           ", with timestamps" if header['tsOffset'] is not None else ""))
+
+
+if __name__ == '__main__':
+    main()
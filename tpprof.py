@@ -1,56 +1,474 @@
 #!/usr/bin/python3
+#
+# tpprof.py [run] <datafile>       every stage, as before
+# tpprof.py parse <datafile>       convert a text trace to a trace file
+# tpprof.py cluster <datafile>     cluster (or label with --model)
+# tpprof.py subsequence <datafile> cluster, then mine subsequences
+# tpprof.py plot <datafile>        draw the profile from the result files
+# tpprof.py summary <datafile>     print the profile from the result files
+#
+# Heavy dependencies (sklearn, hyperopt, matplotlib) are imported by the
+# stages that use them, so cached runs, plot and summary start quickly.
 
 from lib.common import *
-import lib.drawing
-import lib.clustering
-import lib.parsing
+import lib.cache
+import lib.instrument
+import lib.model
+import lib.occurrences
+import lib.results
 import lib.subsequencing
-from lib.subsequence_objective import function as subsequence_objective
+import lib.tracefile
 
 import argparse
 import errno
-from hyperopt import fmin, tpe, hp, Trials, STATUS_OK
-if PARALLEL:
-    from hyperopt.mongoexp import MongoTrials
 import numpy as np
 import pickle
 import os
 import sys
+import time
+
+
+COMMANDS = ['run', 'parse', 'cluster', 'subsequence', 'plot', 'summary']
+MAX_SUMMARY_SUBSEQUENCES = 10 # printed by summary
 
 
 def argParser():
+    # options shared by the subcommands
+    trace = argparse.ArgumentParser(add_help=False)
+    trace.add_argument('datafile', type=str, help='The raw data file.')
+    trace.add_argument('--resultprefix', type=str,
+                       help='The prefix of result files. Default is ' \
+                            'tmp/ + datafile between the last / and .')
+    trace.add_argument('--instrument', type=str, metavar='FILE',
+                       help='write the wall time, CPU time and peak RSS of ' \
+                            'every stage, and the miner counters, to FILE ' \
+                            'as JSON.')
+    trace.add_argument('--chrometrace', action='store_true',
+                       help='write --instrument FILE as a Chrome trace ' \
+                            '(chrome://tracing, Perfetto) instead.')
+
+    clustering = argparse.ArgumentParser(add_help=False)
+    clustering.add_argument('--model', type=str,
+                            help='label the trace with this model file, ' \
+                                 'e.g. the <NAME>.model of an earlier run, ' \
+                                 'instead of fitting a new model.')
+    clustering.add_argument('--cachedir', type=str, default=CACHE_DIR,
+                            help='directory of cached stage results.')
+    clustering.add_argument('--nocache', action='store_true',
+                            help='recompute every stage, ignoring and not ' \
+                                 'updating the cache.')
+
+    subsequencing = argparse.ArgumentParser(add_help=False)
+    subsequencing.add_argument('--seed', type=int, help='seed for hyperopt')
+    subsequencing.add_argument('--engine', type=str,
+                               default=SUBSEQUENCE_ENGINE,
+                               choices=sorted(
+                                   lib.subsequencing.SUBSEQUENCE_ENGINES),
+                               help='subsequence miner.')
+    subsequencing.add_argument('--search', type=str,
+                               default=SUBSEQUENCE_SEARCH,
+                               choices=['sweep', 'hyperopt'],
+                               help='how to pick min_frequency_thresh.')
+    subsequencing.add_argument('--trials', type=str,
+                               default=SUBSEQUENCE_TRIALS,
+                               choices=['serial', 'local', 'mongo'],
+                               help='where hyperopt trials run: in this ' \
+                                    'process, on a local process pool, or ' \
+                                    'on hyperopt.sh workers through ' \
+                                    'MongoDB.')
+    subsequencing.add_argument('--rle', dest='rle', action='store_true',
+                               help='mine the run-length encoded sequence, ' \
+                                    'one (state, log10 run length) symbol ' \
+                                    'per run.')
+    subsequencing.add_argument('--norle', dest='rle', action='store_false',
+                               help='mine every sample.')
+    subsequencing.set_defaults(rle=SUBSEQUENCE_RLE)
+    subsequencing.add_argument('--jobs', type=int, default=SUBSEQUENCE_JOBS,
+                               help='concurrent trials with --trials ' \
+                                    'local. Default is one per core.')
+
+    plotting = argparse.ArgumentParser(add_help=False)
+    plotting.add_argument('--plot', dest='plot', action='store_true',
+                          help='whether to open the plot at the end.')
+    plotting.add_argument('--noplot', dest='plot', action='store_false',
+                          help='whether to open the plot at the end.')
+    plotting.set_defaults(plot=True)
+
     parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                    description='Without a command, runs every stage.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    for name, parents, help in [
+            ('run', [trace, clustering, subsequencing, plotting],
+             'every stage (the default).'),
+            ('parse', [trace], 'convert a text trace to a trace file, ' \
+                               '<NAME>.trace, to map instead of parse.'),
+            ('cluster', [trace, clustering],
+             'cluster the trace, or label it with --model.'),
+            ('subsequence', [trace, clustering, subsequencing],
+             'cluster, then mine subsequences.'),
+            ('plot', [trace, plotting],
+             'draw the profile from the result files.'),
+            ('summary', [trace],
+             'print the profile from the result files.')]:
+        commands.add_parser(name, parents=parents, help=help,
                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('datafile', type=str, help='The raw data file.')
-    parser.add_argument('--resultprefix', type=str,
-                        help='The prefix of result files. Default is ' \
-                             'tmp/ + datafile between the last / and .')
-    parser.add_argument('--seed', type=int, help='seed for hyperopt')
-    parser.add_argument('--plot', dest='plot', action='store_true',
-                        help='whether to open the plot at the end.')
-    parser.add_argument('--noplot', dest='plot', action='store_false',
-                        help='whether to open the plot at the end.')
-    parser.set_defaults(plot=True)
-
-    return parser.parse_args()
-
-def main():
-    args = argParser()
 
-    datafile = args.datafile
+    argv = sys.argv[1:]
+    if argv and argv[0] not in COMMANDS + ['-h', '--help']:
+        argv = ['run'] + argv
+    return parser.parse_args(argv)
+
+def merge_subsequences(subsequence_freq, subsequence_coverage, rle):
+    """
+    merged_freq, coverage_sum and, in expanded mode, the occurrence store of
+    mined subsequences, as a dict.
+    """
+    merge = lib.subsequencing.merge_rle if rle \
+            else lib.subsequencing.merge_stable
+    with lib.instrument.span('merge'):
+        merged_freq, coverage_sum = merge(subsequence_freq,
+                                          subsequence_coverage)
+    merged = {'merged_freq': merged_freq, 'coverage_sum': coverage_sum}
+    if isinstance(subsequence_coverage, lib.occurrences.OccurrenceStore):
+        merged['occurrences'] = subsequence_coverage
+    return merged
+
+def sweep_subsequences(cluster_results, engine, rle = False):
+    """ Pick min_frequency_thresh by scoring every threshold of the sweep. """
+    clustered_pts = cluster_results['clustered_pts']
+    thresholds = lib.subsequencing.sweep_thresholds(*SUBSEQUENCE_SWEEP)
+
+    with lib.instrument.span('sweep', thresholds = len(thresholds)):
+        scores, (min_frequency_thresh, subsequence_freq,
+                 subsequence_coverage) = \
+                lib.subsequencing.sweep_total_coverage(clustered_pts,
+                                                       len(clustered_pts) - 1,
+                                                       thresholds, engine, rle)
+    print("Threshold sweep (threshold: coverage): " + str(scores))
+
+    subsequences = {'min_frequency_thresh': min_frequency_thresh}
+    subsequences.update(merge_subsequences(subsequence_freq,
+                                           subsequence_coverage, rle))
+    return subsequences
+
+def hyperopt_subsequences(cluster_results, engine, rstate, backend, jobs,
+                          rle = False):
+    """ Pick min_frequency_thresh with SUBSEQUENCE_EVALS hyperopt trials. """
+    from hyperopt import fmin, tpe, hp, Trials
+    from lib.subsequence_objective import function as subsequence_objective
+    from lib.subsequence_objective import shared_function as \
+            shared_subsequence_objective
+
+    space = {
+        'min_frequency_thresh': hp.qlognormal('min_frequency_thresh',
+                                              4, 0.6, 1),
+        'engine': engine,
+        'rle': rle
+    }
+
+    if backend == 'local':
+        from lib.clustering import SharedXPool
+        from lib.local_trials import fmin_local
+        # the pool's workers get the cluster sequence once, in shared memory
+        clustered_pts = cluster_results['clustered_pts']
+        jobs = min(jobs or os.cpu_count(), SUBSEQUENCE_EVALS)
+        with SharedXPool(clustered_pts, jobs) as pool, \
+             lib.instrument.span('hyperopt', trials = backend):
+            best, trials = fmin_local(
+                    shared_subsequence_objective, space, SUBSEQUENCE_EVALS,
+                    pool, jobs, rstate)
+    else:
+        if backend == 'mongo':
+            from hyperopt.mongoexp import MongoTrials
+            # mongo workers only see the space, so it carries the sequence
+            space['clustered_pts'] = \
+                    pickle.dumps(np.array(cluster_results['clustered_pts']))
+            trials = MongoTrials('mongo://localhost:45555/db/jobs',
+                                 exp_key='tpprof1')
+        else:
+            space['clustered_pts'] = cluster_results['clustered_pts']
+            trials = Trials()
 
-    resultprefix = 'tmp/' + args.datafile.rpartition('/')[2].rpartition('.')[0]
-    if args.resultprefix:
-        resultprefix = args.resultprefix
+        with lib.instrument.span('hyperopt', trials = backend):
+            best = fmin(fn = subsequence_objective, space = space,
+                        algo = tpe.suggest, max_evals = SUBSEQUENCE_EVALS,
+                        trials = trials, rstate = rstate)
+    best_trial = trials.trials[np.argmin([r['loss'] for r in trials.results])]
+    subsequence_freq = pickle.loads(
+                trials.trial_attachments(best_trial)['subsequence_freq'])
+    subsequence_coverage = lib.occurrences.loads(
+                trials.trial_attachments(best_trial)['subsequence_coverage'])
+
+    best.update(merge_subsequences(subsequence_freq, subsequence_coverage,
+                                   rle))
+    return best
+
+def result_files(datafile, resultprefix = None):
+    """ The cluster, subsequence, graph and model files of a trace. """
+    if not resultprefix:
+        resultprefix = 'tmp/' + datafile.rpartition('/')[2].rpartition('.')[0]
     # mod: include clustering method in clustering filename. 
-    cluster_file = resultprefix + '.cluster'
-    subsequence_file = resultprefix + '.subsequence'
-    graph_file = resultprefix + '.pdf'
+    return (resultprefix + '.cluster', resultprefix + '.subsequence',
+            resultprefix + '.pdf', resultprefix + '.model')
+
+def occurrence_file(subsequence_file):
+    """ Where the occurrence store of a subsequence file goes. """
+    return subsequence_file.rpartition('.')[0] + '.occurrences'
+
+def make_result_dir(result_file):
+    if os.path.dirname(result_file) and \
+       not os.path.exists(os.path.dirname(result_file)):
+        try:
+            os.makedirs(os.path.dirname(result_file))
+        except OSError as exc: # Guard against race condition
+            if exc.errno != errno.EEXIST:
+                print("problem here: ", result_file, " ",
+                      os.path.dirname(result_file))
+                raise
+
+def cluster_cache_key(datafile, model_file = None):
+    """
+    Cache key of the cluster results of a trace.  Results are cached under a
+    hash of what they are computed from, so a changed trace, config, model
+    file or library version never reuses an old result.
+    """
+    if model_file:
+        return lib.cache.cacheKey('predict', lib.cache.hashFile(datafile),
+                                  lib.cache.hashFile(model_file))
+    return lib.cache.cacheKey('cluster', lib.cache.hashFile(datafile),
+                              bGmmConf,
+                              lib.cache.packageVersions('numpy',
+                                                        'scikit-learn'))
+
+def subsequence_cache_key(cluster_key, search, seed, rle = False):
+    """
+    Cache key of the subsequences mined from cluster results.  Every engine
+    mines the same subsequences, so the engine is not part of the key.
+    """
+    parts = ['subsequence', cluster_key, search,
+             SUBSEQUENCE_SWEEP if search == 'sweep'
+             else (SUBSEQUENCE_EVALS, seed)]
+    if rle: # expanded mode keys stay as they were
+        parts.append('rle')
+    return lib.cache.cacheKey(*parts)
+
+def run_clustering(datafile, cache = None, cluster_key = None,
+                   model_file = None):
+    """
+    Cluster results of a trace, from the cache if it has them.  With a
+    model_file the trace is only labelled, by that model, instead of fitting
+    a new one.  Returns (cluster_results, whether they came from the cache).
+    """
+    cluster_results = None if cache is None \
+                      else cache.get(cluster_key, lib.results.CLUSTER_ENTRIES)
+
+    if cluster_results is not None:
+        print("Loading cached clustering...")
+
+        long_keys = ["original_pts", "clustered_pts", "model"]
+        printable_results = {k : v for k, v in cluster_results.items() \
+                                       if k not in long_keys}
+        print("Loaded clustering with parameters: " + str(printable_results))
+        return cluster_results, True
+
+    print("Generating clustering...")
+
+    # get data
+    with lib.instrument.span('load trace'):
+        input_data = lib.tracefile.loadTrace(datafile, progress = True)
+
+    # clustering
+    X = input_data
+    if model_file:
+        model = lib.model.StateModel.load(model_file)
+        print("labelling with model %s (%d states)" % (model_file,
+                                                       model.nStates))
+        with lib.instrument.span('predict'):
+            Y = model.predict(X, bGmmConf["predictChunk"])
+    else:
+        from lib.clustering import fitPipeline
+        Y, fitted = fitPipeline(bGmmConf, X)
+        model = lib.model.StateModel.fromFitted(fitted)
+    cluster_results = {}
+    cluster_results['original_pts'] = input_data
+    cluster_results['clustered_pts'] = Y
+    # labels new samples, e.g. for lib.streaming or --model
+    cluster_results['model'] = model
+
+    if cache is not None:
+        cache.put(cluster_key, cluster_results, lib.results.CLUSTER_ENTRIES)
+    return cluster_results, False
+
+def run_subsequencing(cluster_results, search, engine, rstate, trials, jobs,
+                      cache = None, subsequence_key = None, rle = False):
+    """
+    Subsequences of a clustered trace, from the cache if it has them.
+    Returns (subsequences, whether they came from the cache).
+    """
+    subsequences = None if cache is None \
+                   else cache.get(subsequence_key,
+                                  lib.results.SUBSEQUENCE_ENTRIES)
+
+    if subsequences is not None:
+        print("Loading cached subsequences...")
+
+        long_keys = ["merged_freq", "coverage_sum", "occurrences"]
+        printable_results = {k : v for k, v in subsequences.items() \
+                                       if k not in long_keys}
+        print("Loaded subsequences with parameters: " + str(printable_results))
+        return subsequences, True
+
+    print("Generating subsequences...")
+
+    if search == 'sweep':
+        subsequences = sweep_subsequences(cluster_results, engine, rle)
+    else:
+        subsequences = hyperopt_subsequences(cluster_results, engine, rstate,
+                                             trials, jobs, rle)
+
+    if cache is not None:
+        cache.put(subsequence_key, subsequences,
+                  lib.results.SUBSEQUENCE_ENTRIES)
+    return subsequences, False
+
+# ===================================
+# =             stages.             =
+# ===================================
+
+def cluster_stage(datafile, resultprefix = None, cache = None,
+                  model_file = None):
+    """
+    Cluster a trace and write its cluster file, and its model file if one
+    was fitted.  Returns (cluster_results, cache key, stage), stage holding
+    the seconds it took and whether it came from the cache.
+    """
+    cluster_file, subsequence_file, graph_file, model_out = \
+            result_files(datafile, resultprefix)
+    make_result_dir(cluster_file)
+
+    start = time.time()
+    with lib.instrument.span('cluster'):
+        cluster_key = None
+        if cache is not None:
+            cluster_key = cluster_cache_key(datafile, model_file)
+        cluster_results, cached = run_clustering(datafile, cache, cluster_key,
+                                                 model_file)
+        lib.results.saveCluster(cluster_file, cluster_results)
+        if not model_file:
+            cluster_results['model'].save(model_out)
+    return cluster_results, cluster_key, \
+           {'seconds' : time.time() - start, 'cached' : cached}
+
+def subsequence_stage(datafile, cluster_results, cluster_key,
+                      resultprefix = None, cache = None, seed = None,
+                      engine = SUBSEQUENCE_ENGINE, search = SUBSEQUENCE_SEARCH,
+                      trials = SUBSEQUENCE_TRIALS, jobs = SUBSEQUENCE_JOBS,
+                      rle = SUBSEQUENCE_RLE):
+    """
+    Mine the subsequences of a clustered trace and write its subsequence
+    file, and in expanded mode its occurrence file.  Returns (subsequences,
+    stage); the occurrences are left out of subsequences and its file.
+    """
+    subsequence_file = result_files(datafile, resultprefix)[1]
+    rstate = np.random.RandomState(seed) if seed else None
+
+    start = time.time()
+    with lib.instrument.span('subsequence'):
+        subsequence_key = None
+        if cache is not None:
+            subsequence_key = subsequence_cache_key(cluster_key, search, seed,
+                                                    rle)
+        subsequences, cached = run_subsequencing(cluster_results, search,
+                                                 engine, rstate, trials, jobs,
+                                                 cache, subsequence_key, rle)
+        occurrences = subsequences.pop('occurrences', None)
+        if occurrences is not None:
+            occurrences.save(occurrence_file(subsequence_file))
+        elif os.path.exists(occurrence_file(subsequence_file)):
+            os.remove(occurrence_file(subsequence_file)) # an older run's
+        lib.results.saveSubsequences(subsequence_file, subsequences)
+    return subsequences, {'seconds' : time.time() - start, 'cached' : cached}
+
+def draw_stage(cluster_results, subsequences, graph_file, show = True):
+    """ Draw the profile to graph_file, opening it if show. """
+    from lib.drawing import plot
+    print("Drawing profile...")
+
+    start = time.time()
+    with lib.instrument.span('draw'):
+        plot(cluster_results['original_pts'],
+             cluster_results['clustered_pts'],
+             subsequences['merged_freq'], subsequences['coverage_sum'],
+             graph_file, show)
+    return {'seconds' : time.time() - start, 'cached' : False}
+
+def load_results(datafile, resultprefix = None):
+    """ (cluster_results, subsequences) from the result files of a trace. """
+    cluster_file, subsequence_file, graph_file, model_file = \
+            result_files(datafile, resultprefix)
+    for filename in (cluster_file, subsequence_file):
+        if not os.path.exists(filename):
+            sys.exit("%s not found, run tpprof.py on %s first" %
+                     (filename, datafile))
+    return lib.results.loadCluster(cluster_file), \
+           lib.results.loadSubsequences(subsequence_file)
+
+# ======  End of stages.  =======
+
+def open_cache(cachedir):
+    """ The result cache in cachedir, None for no cache. """
+    if cachedir is None:
+        return None
+    return lib.cache.ResultCache(cachedir, CACHE_MAX_BYTES)
+
+def profile_trace(datafile, resultprefix = None, seed = None,
+                  engine = SUBSEQUENCE_ENGINE, search = SUBSEQUENCE_SEARCH,
+                  trials = SUBSEQUENCE_TRIALS, jobs = SUBSEQUENCE_JOBS,
+                  cachedir = CACHE_DIR, draw = True, show = True,
+                  model_file = None, rle = SUBSEQUENCE_RLE):
+    """
+    Cluster a trace, mine its subsequences and draw its profile, writing the
+    result files.  cachedir None disables the cache; show opens the drawn
+    profile; a model_file labels the trace instead of fitting a model; rle
+    mines the run-length encoded sequence.
+    Returns (cluster_results, subsequences, stages), stages holding the
+    seconds each stage took and whether it came from the cache.
+    """
+    cache = open_cache(cachedir)
+    stages = {}
+
+    # run clustering
+    cluster_results, cluster_key, stages['cluster'] = \
+            cluster_stage(datafile, resultprefix, cache, model_file)
+
+    # run subsequencing
+    subsequences, stages['subsequence'] = \
+            subsequence_stage(datafile, cluster_results, cluster_key,
+                              resultprefix, cache, seed, engine, search,
+                              trials, jobs, rle)
+
+    if draw:
+        graph_file = result_files(datafile, resultprefix)[2]
+        stages['draw'] = draw_stage(cluster_results, subsequences,
+                                    graph_file, show)
+    else:
+        print('Drawing disabled')
+
+    return cluster_results, subsequences, stages
+
+# ===================================
+# =            commands.            =
+# ===================================
+
+def run(args):
+    datafile = args.datafile
+    cluster_file, subsequence_file, graph_file, model_file = \
+            result_files(datafile, args.resultprefix)
+    resultprefix = cluster_file.rpartition('.')[0]
 
-    rstate = None
     seed_desc = "UNSET"
     if args.seed:
-        rstate = np.random.RandomState(args.seed)
         seed_desc = str(args.seed)
 
     plot = args.plot
@@ -60,105 +478,103 @@ def main():
     print ('\tinput file: %s' % datafile)
     print ('\tresult prefix: %s' % resultprefix)
     print ('\tgraph_file: %s' % graph_file)
-    print ('\tsaved cluster results: %s' % os.path.isfile(cluster_file))
-    print ('\tsaved subsequence results: %s' % os.path.isfile(subsequence_file))
+    print ('\tmodel: %s' % (args.model if args.model
+                            else "fit, saved to " + model_file))
+    print ('\tcache: %s' % ("disabled" if args.nocache else args.cachedir))
     print ('\tseed: %s' % seed_desc)
-    print ('\tparallel: %s' % ("Yes" if PARALLEL else "No"))
+    print ('\tsubsequence engine: %s%s' % (args.engine,
+                                           " (run-length mode)" if args.rle
+                                           else ""))
+    print ('\tthreshold search: %s' % args.search)
+    print ('\thyperopt trials: %s' % args.trials)
     print ('\tplot: %s' % ("Yes" if plot else "No"))
     print ("--------------------")
 
-
-    # run clustering
-    new_cluster = False
-
-    if os.path.isfile(cluster_file):
-        print("Loading previous clustering...")
-
-        cluster_results = pickle.load(open(cluster_file, 'rb'))
-
-        long_keys = ["original_pts", "clustered_pts"]
-        printable_results = {k : v for k, v in cluster_results.items() \
-                                       if k not in long_keys}
-        print("Loaded clustering with parameters: " + str(printable_results))
+    profile_trace(datafile, resultprefix, args.seed, args.engine, args.search,
+                  args.trials, args.jobs,
+                  None if args.nocache else args.cachedir, plot, plot,
+                  args.model, args.rle)
+
+def parse(args):
+    trace_file = result_files(args.datafile,
+                              args.resultprefix)[0].rpartition('.')[0] + \
+                 '.trace'
+    make_result_dir(trace_file)
+    name = args.datafile
+    for ext in ('.gz', '.zst'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    if name.endswith('.csv'):
+        lib.tracefile.convertSnapGrepCsv(args.datafile, trace_file)
     else:
-        print("Generating clustering...")
-
-        # get data
-        input_data = lib.parsing.parseSwitchTrace(datafile)
-        np_input_data = np.array(input_data)
-
-        # clustering
-        X = np_input_data
-        Y = lib.clustering.runPipeline(bGmmConf, X)
-        cluster_results = {}
-        cluster_results['original_pts'] = input_data
-        cluster_results['clustered_pts'] = pickle.dumps(Y)
-
-        if not os.path.exists(os.path.dirname(cluster_file)):
-            try:
-                os.makedirs(os.path.dirname(cluster_file))
-            except OSError as exc: # Guard against race condition
-                if exc.errno != errno.EEXIST:
-                    print("problem here: ", cluster_file, " ",
-                          os.path.dirname(cluster_file))
-                    raise
-        pickle.dump(cluster_results, open(cluster_file, 'wb'))
-        new_cluster = True
+        lib.tracefile.convertText(args.datafile, trace_file, progress = True)
+    header = lib.tracefile.readHeader(trace_file)
+    print("wrote %s: %d samples x %d switches" %
+          (trace_file, header['nSamples'], header['nSwitches']))
+
+def cluster(args):
+    cluster_results, cluster_key, stage = \
+            cluster_stage(args.datafile, args.resultprefix,
+                          open_cache(None if args.nocache else args.cachedir),
+                          args.model)
+    print("clustering %s in %.2fs" % ("loaded" if stage['cached']
+                                      else "computed", stage['seconds']))
+
+def subsequence(args):
+    cache = open_cache(None if args.nocache else args.cachedir)
+    cluster_results, cluster_key, stage = \
+            cluster_stage(args.datafile, args.resultprefix, cache, args.model)
+    subsequences, stage = \
+            subsequence_stage(args.datafile, cluster_results, cluster_key,
+                              args.resultprefix, cache, args.seed,
+                              args.engine, args.search, args.trials,
+                              args.jobs, args.rle)
+    print("subsequences %s in %.2fs" % ("loaded" if stage['cached']
+                                        else "computed", stage['seconds']))
+
+def plot(args):
+    cluster_results, subsequences = load_results(args.datafile,
+                                                 args.resultprefix)
+    graph_file = result_files(args.datafile, args.resultprefix)[2]
+    draw_stage(cluster_results, subsequences, graph_file, args.plot)
+
+def summary(args):
+    from lib.statestats import StateStats
+    cluster_results, subsequences = load_results(args.datafile,
+                                                 args.resultprefix)
+    stats = StateStats(cluster_results['clustered_pts'])
+    print("%s: %d samples, %d states" % (args.datafile, stats.nSamples,
+                                         len(stats.ordered())))
+    for k in stats.ordered():
+        print("\tstate %d: %.1f%% of time, %.1f%% stable" %
+              (k, 100 * stats.frequencies[k], 100 * stats.stability[k]))
+
+    coverage = subsequences['coverage_sum']
+    top = sorted(coverage, key = coverage.get, reverse = True)
+    print("%d subsequences (min_frequency_thresh %s) by coverage, as " \
+          "state^(log10 of its run length):" %
+          (len(top), subsequences['min_frequency_thresh']))
+    for seq in top[:MAX_SUMMARY_SUBSEQUENCES]:
+        print("\t%5.1f%%  %s" % (100.0 * coverage[seq] / stats.nSamples,
+                                 ' '.join('%d^%d' % run for run in seq)))
+
+# ======  End of commands.  =======
 
-
-    # run subsequencing
-    if not new_cluster and os.path.isfile(subsequence_file):
-        print("Loading previous subsequences...")
-
-        subsequences = pickle.load(open(subsequence_file, 'rb'))
-
-        long_keys = ["merged_freq", "coverage_sum"]
-        printable_results = {k : v for k, v in subsequences.items() \
-                                       if k not in long_keys}
-        print("Loaded subsequences with parameters: " + str(printable_results))
-    else:
-        print("Generating subsequences...")
-
-        space = {
-            'min_frequency_thresh': hp.qlognormal('min_frequency_thresh',
-                                                  4, 0.6, 1),
-            'clustered_pts': cluster_results['clustered_pts']
-        }
-
-        if PARALLEL:
-            trials = MongoTrials('mongo://localhost:45555/db/jobs',
-                                 exp_key='tpprof1')
-        else:
-            trials = Trials()
-
-        best = fmin(fn = subsequence_objective, space = space,
-                    algo = tpe.suggest, max_evals = SUBSEQUENCE_EVALS,
-                    trials = trials, rstate = rstate)
-        best_trial = trials.trials[np.argmin([r['loss'] for r in trials.results])]
-        subsequence_freq = pickle.loads(
-                    trials.trial_attachments(best_trial)['subsequence_freq'])
-        subsequence_coverage = pickle.loads(
-                    trials.trial_attachments(best_trial)['subsequence_coverage'])
-
-        merged_freq, coverage_sum = \
-                lib.subsequencing.merge_stable(subsequence_freq,
-                                               subsequence_coverage)
-        best['merged_freq'] = merged_freq
-        best['coverage_sum'] = coverage_sum
-
-        subsequences = best
-        pickle.dump(subsequences, open(subsequence_file, 'wb'))
-
-    if plot:
-        print("Drawing profile...")
-
-        lib.drawing.plot(cluster_results['original_pts'],
-                         pickle.loads(cluster_results['clustered_pts']),
-                         subsequences['merged_freq'],
-                         subsequences['coverage_sum'],
-                         graph_file, plot)
-    else:
-        print('Drawing disabled')
+def main():
+    args = argParser()
+    if args.command is None:
+        sys.exit("usage: tpprof.py [command] <datafile>, see tpprof.py -h")
+    if args.instrument:
+        lib.instrument.enable()
+    try:
+        with lib.instrument.span(args.command):
+            {'run' : run, 'parse' : parse, 'cluster' : cluster,
+             'subsequence' : subsequence, 'plot' : plot,
+             'summary' : summary}[args.command](args)
+    finally:
+        if args.instrument:
+            lib.instrument.write(args.instrument, args.chrometrace)
+            print("wrote %s" % args.instrument)
 
 
 if __name__ == '__main__':